@@ -4,21 +4,54 @@
 """
 
 import os
+import re
+import time
 import base64
+import hashlib
+import inspect
+import asyncio
+import tempfile
+import uuid
+import sqlite3
 import threading
 import json
 import logging
-from dataclasses import dataclass
-from typing import Optional, List, Dict, Any, Generator
+import functools
+import io
+import gzip
+import math
+import bisect
+import socket
+import contextvars
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import (
+    FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait as futures_wait
+)
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Any, Generator, Tuple, Callable, Awaitable, Set, Union
 from pathlib import Path
 
-from flask import Flask, render_template, request, Response
-from openai import OpenAI
+from flask import Flask, render_template, request, Response, send_file, abort
+from openai import (
+    OpenAI, AsyncOpenAI, APIStatusError, APITimeoutError, APIConnectionError, 
+    DefaultHttpxClient, DefaultAsyncHttpxClient
+)
 from dotenv import load_dotenv
+import httpx
+import anyio
+
+try:
+    from PIL import Image
+except ImportError:  # 未安装 Pillow 时不生成缩略图
+    Image = None
 
 # 加载环境变量（可选，用于服务器端配置默认值）
 load_dotenv()
 
+SILICONFLOW_BASE_URL = os.getenv("SILICONFLOW_BASE_URL", "https://api.siliconflow.cn/v1")
+
 # ==================== 系统提示词 ====================
 
 NAHIDA_SYSTEM_PROMPT = """你现在是《原神》中的角色纳西妲。请你以纳西妲的身份和知识库进行回答。
@@ -64,6 +97,14 @@ Follow this professional workflow:
 * **DO NOT** use bullet points, labels, or any explanations. Combine all chosen elements into one powerful prompt.
 """
 
+SUMMARY_SYSTEM_PROMPT = """你负责为纳西妲与旅行者之间的长对话维护一份滚动摘要。
+
+要求：
+- 在已有摘要的基础上合并新增对话，输出一份完整的新摘要
+- 保留旅行者透露的个人信息、偏好、提过的问题，以及双方的约定和未完成的话题
+- 省略寒暄和重复内容，用第三人称简洁叙述
+- 只输出摘要正文，不超过 300 字"""
+
 # ==================== 工具函数 ====================
 
 def encode_audio_to_base64(file_path: str) -> Optional[str]:
@@ -94,269 +135,4947 @@ def create_sse_message(data: Dict[str, Any]) -> str:
     return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 
-# ==================== 用户配置类 ====================
+def prune_directory(directory: Path, patterns: Union[str, Tuple[str, ...]], max_bytes: float, ttl: float) -> None:
+    """删除目录中过期的文件，总大小超出上限时按修改时间从旧到新删除；patterns 可以是多个通配符"""
+    if isinstance(patterns, str):
+        patterns = (patterns,)
+    files = []
+    for pattern in patterns:
+        for path in directory.glob(pattern):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+    
+    total = sum(size for _, size, _ in files)
+    expire_before = time.time() - ttl
+    for mtime, size, path in files:
+        if mtime >= expire_before and total <= max_bytes:
+            break
+        try:
+            path.unlink()
+            total -= size
+        except OSError:
+            pass
 
-@dataclass
-class UserConfig:
-    """用户配置，从请求头中读取"""
-    api_key: str
-    chat_model: str = "deepseek-ai/DeepSeek-V3.1"
-    prompt_engineer_model: str = "zai-org/GLM-4.5"
-    image_model: str = "Qwen/Qwen-Image"
-    tts_model: str = "IndexTeam/IndexTTS-2"
-    max_tokens: int = 2048
-    temperature: float = 0.7
-    image_size: str = "928x1664"
+
+# 写入中断（进程被杀、磁盘写满）留下的临时文件，超过该时间仍未改名的视为孤儿
+ORPHAN_TMP_TTL = 3600.0
+
+
+def prune_orphan_tmp(directory: Path) -> None:
+    """删除写入中断后遗留的 *.tmp 文件"""
+    prune_directory(directory, "*.tmp", math.inf, ORPHAN_TMP_TTL)
+
+
+def normalize_history(history: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """把前端保存的历史记录转换为模型可用的消息格式
+
+    前端以 {"text": ..., "image_url": ...} 保存消息内容，这里只保留文本，
+    并丢弃 system 等非对话消息。
+    """
+    messages = []
+    for msg in history:
+        role = msg.get("role")
+        content = msg.get("content")
+        if isinstance(content, dict):
+            content = content.get("text")
+        if role in ("user", "assistant") and isinstance(content, str) and content:
+            messages.append({"role": role, "content": content})
+    return messages
+
+
+# ==================== 监控指标 ====================
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _CounterValue:
+    __slots__ = ("value", "_lock")
     
-    @classmethod
-    def from_headers(cls, headers) -> "UserConfig":
-        """从请求头中读取配置"""
-        api_key = headers.get("X-API-Key", "")
-        
-        # 如果没有提供 API Key，尝试从环境变量读取（服务器端配置）
-        if not api_key:
-            api_key = os.getenv("SILICONFLOW_API_KEY", "")
-        
-        return cls(
-            api_key=api_key,
-            chat_model=headers.get("X-Chat-Model", "deepseek-ai/DeepSeek-V3.1"),
-            image_model=headers.get("X-Image-Model", "Qwen/Qwen-Image"),
-            tts_model=headers.get("X-TTS-Model", "IndexTeam/IndexTTS-2"),
-            temperature=float(headers.get("X-Temperature", 0.7)),
-            max_tokens=int(headers.get("X-Max-Tokens", 2048)),
-        )
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
     
-    def validate(self) -> Optional[str]:
-        """验证配置是否有效"""
-        if not self.api_key:
-            return "请先配置 SiliconFlow API Key"
-        if not self.api_key.startswith("sk-"):
-            return "API Key 格式不正确，应以 sk- 开头"
-        return None
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+    
+    def dec(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value -= amount
+    
+    def set(self, value: float) -> None:
+        self.value = value
 
 
-# ==================== AI 服务类 ====================
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+    
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # 最后一格对应 +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
 
-class AIService:
-    """AI 服务管理类"""
+
+class Metric:
+    """带标签的指标
+
+    每组标签值对应一个子序列，第一次使用时创建，之后只做一次字典查找；
+    热点路径可以预先取出子序列（labels(...)）保存下来，记录时不再分配对象。
+    每个子序列自带一把锁，不同序列之间互不争用。
+    """
     
-    def __init__(self, config: UserConfig):
-        self.config = config
-        self.client = OpenAI(
-            api_key=config.api_key, 
-            base_url="https://api.siliconflow.cn/v1"
-        )
-        self.reference_audio_base64 = self._load_reference_audio()
+    TYPE = ""
     
-    def _load_reference_audio(self) -> Optional[str]:
-        """加载参考音频"""
-        # 优先从环境变量获取路径，否则使用默认路径
-        audio_path = os.getenv("REFERENCE_AUDIO_PATH", "Ref_audio.mp3")
-        audio_base64 = encode_audio_to_base64(audio_path)
-        if audio_base64:
-            logging.info("✅ 参考音频加载成功")
-        return audio_base64
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+        if not labelnames:
+            self._default = self.labels()
     
-    def generate_chat_response(
-        self, 
-        user_message: str, 
-        history: List[Dict[str, str]]
-    ) -> str:
-        """生成对话回复"""
-        messages = [
-            {"role": "system", "content": NAHIDA_SYSTEM_PROMPT}
-        ] + [
-            msg for msg in history if isinstance(msg.get("content"), str)
-        ] + [
-            {"role": "user", "content": user_message}
+    def _new_child(self):
+        return _CounterValue()
+    
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+    
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+            for values, child in list(self._children.items())
         ]
-        
-        logging.info(f"🤖 调用对话模型: {self.config.chat_model}")
-        
-        response = self.client.chat.completions.create(
-            model=self.config.chat_model,
-            messages=messages,
-            max_tokens=self.config.max_tokens,
-            temperature=self.config.temperature,
-        )
-        
-        content = response.choices[0].message.content.strip()
-        if not content:
-            raise ValueError("对话模型返回了空回复")
-        
-        return content
     
-    def generate_image_prompt(self, user_message: str, nahida_reply: str) -> Optional[str]:
-        """生成图像提示词"""
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.TYPE}",
+            *self.samples(),
+        ]
+
+
+class Counter(Metric):
+    TYPE = "counter"
+    
+    def inc(self, amount: float = 1.0) -> None:
+        self._default.inc(amount)
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+    
+    def inc(self, amount: float = 1.0) -> None:
+        self._default.inc(amount)
+    
+    def dec(self, amount: float = 1.0) -> None:
+        self._default.dec(amount)
+    
+    def set(self, value: float) -> None:
+        self._default.set(value)
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+    
+    def __init__(
+        self, 
+        name: str, 
+        documentation: str, 
+        labelnames: Tuple[str, ...] = (), 
+        buckets: Tuple[float, ...] = ()
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+    
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+    
+    def observe(self, value: float) -> None:
+        self._default.observe(value)
+    
+    def samples(self) -> List[str]:
+        lines = []
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class CallbackMetric(Metric):
+    """抓取时才读取的指标，适合已有的统计对象，记录路径上没有任何开销"""
+    
+    def __init__(
+        self, 
+        name: str, 
+        documentation: str, 
+        labelnames: Tuple[str, ...], 
+        callback: Callable[[], List[Tuple[Tuple[str, ...], float]]], 
+        metric_type: str = "gauge"
+    ):
+        self.callback = callback
+        self.TYPE = metric_type
+        super().__init__(name, documentation, labelnames)
+    
+    def samples(self) -> List[str]:
         try:
-            prompt_input = f'User: "{user_message}"\nNahida: "{nahida_reply}"'
-            messages = [
-                {"role": "system", "content": PROMPT_ENGINEER_SYSTEM_PROMPT},
-                {"role": "user", "content": prompt_input}
+            return [
+                f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}"
+                for values, value in self.callback()
             ]
-            
-            response = self.client.chat.completions.create(
-                model=self.config.prompt_engineer_model,
-                messages=messages,
-                max_tokens=200,
-                temperature=0.5,
-            )
-            
-            prompt = response.choices[0].message.content.strip()
-            logging.info(f"🎨 生成的图像提示词: {prompt[:100]}...")
-            return prompt
         except Exception as e:
-            logging.error(f"❌ 生成图像提示词失败: {e}")
-            return None
+            logging.warning(f"⚠️ 读取指标 {self.name} 失败: {e}")
+            return []
+
+
+class MetricsRegistry:
+    """进程内指标注册表，以 Prometheus 文本格式导出"""
     
-    def generate_image(self, prompt: str) -> Optional[str]:
-        """生成图像"""
-        try:
-            response = self.client.images.generate(
-                model=self.config.image_model,
-                prompt=prompt,
-                n=1,
-                extra_body={"image_size": self.config.image_size}
-            )
-            return response.data[0].url if response.data else None
-        except Exception as e:
-            logging.error(f"❌ 生成图像失败: {e}")
-            return None
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
     
-    def generate_speech(self, text: str) -> Optional[str]:
-        """生成语音"""
+    def __init__(self):
+        self._metrics: List[Metric] = []
+    
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+    
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+    
+    def histogram(
+        self, 
+        name: str, 
+        documentation: str, 
+        labelnames: Tuple[str, ...] = (), 
+        buckets: Tuple[float, ...] = ()
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+    
+    def callback(
+        self, 
+        name: str, 
+        documentation: str, 
+        labelnames: Tuple[str, ...], 
+        callback: Callable[[], List[Tuple[Tuple[str, ...], float]]], 
+        metric_type: str = "gauge"
+    ) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, labelnames, callback, metric_type))
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+UPSTREAM_LATENCY = metrics.histogram(
+    "nahida_upstream_latency_seconds",
+    "上游调用延迟（流式对话按首段文本计算）",
+    ("stage", "model"),
+    LATENCY_BUCKETS,
+)
+UPSTREAM_ERRORS = metrics.counter(
+    "nahida_upstream_errors_total",
+    "上游调用失败次数，status 为 HTTP 状态码或 timeout / connection / deadline / empty / other",
+    ("stage", "status"),
+)
+SSE_FIRST_EVENT = metrics.histogram(
+    "nahida_sse_time_to_first_event_seconds",
+    "从收到请求到发出第一条 SSE 事件的时间",
+    buckets=LATENCY_BUCKETS,
+)
+SSE_FIRST_AUDIO = metrics.histogram(
+    "nahida_sse_time_to_audio_seconds",
+    "从收到请求到发出第一段可播放音频的时间",
+    buckets=LATENCY_BUCKETS,
+)
+INFLIGHT_REQUESTS = metrics.gauge("nahida_inflight_requests", "正在处理的 /chat 请求数")
+PAYLOAD_BYTES = metrics.histogram(
+    "nahida_payload_bytes",
+    "载荷大小：request 为 /chat 请求体，audio 为合成的语音，image 为镜像的图像",
+    ("kind",),
+    SIZE_BUCKETS,
+)
+REQUEST_PAYLOAD_BYTES = PAYLOAD_BYTES.labels("request")
+AUDIO_PAYLOAD_BYTES = PAYLOAD_BYTES.labels("audio")
+IMAGE_PAYLOAD_BYTES = PAYLOAD_BYTES.labels("image")
+
+
+class ResponseTimer:
+    """记录单次对话的首个事件和首段音频的发出时间"""
+    
+    __slots__ = ("started", "first_event", "first_audio", "timing")
+    
+    def __init__(self, timing: Optional["RequestTiming"] = None):
+        self.timing = timing
+        self.started = timing.started if timing else time.monotonic()
+        self.first_event = False
+        self.first_audio = False
+    
+    def observe(self, event: Dict[str, Any]) -> None:
+        if not self.first_event:
+            self.first_event = True
+            self._mark("first_event", SSE_FIRST_EVENT)
+        if not self.first_audio and event.get("audio_url"):
+            self.first_audio = True
+            self._mark("first_audio", SSE_FIRST_AUDIO)
+    
+    def _mark(self, name: str, histogram: Histogram) -> None:
+        now = time.monotonic()
+        histogram.observe(now - self.started)
+        if self.timing:
+            self.timing.mark(name, now)
+
+
+# ==================== 请求计时 ====================
+
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+def request_id_from(headers) -> Optional[str]:
+    """沿用上游代理传入的 X-Request-Id，格式不合法时忽略"""
+    request_id = headers.get("X-Request-Id", "").strip()
+    return request_id if REQUEST_ID_PATTERN.match(request_id) else None
+
+
+class RequestTiming:
+    """记录单次请求各阶段的起止时间，用于定位慢请求
+
+    时间均为相对请求开始的毫秒数。同一阶段可能执行多次（如分句语音、
+    草稿加修订的提示词），合并为最早开始到最晚结束的区间，并累计次数和耗时。
+    """
+    
+    def __init__(self, request_id: Optional[str] = None):
+        self.request_id = request_id or uuid.uuid4().hex[:16]
+        self.started = time.monotonic()
+        # 阶段 -> [开始, 结束, 次数, 累计耗时]
+        self._spans: Dict[str, List[float]] = {}
+        self._marks: Dict[str, float] = {}
+        self._lock = threading.Lock()
+    
+    def _ms(self, seconds: float) -> float:
+        return round(seconds * 1000, 1)
+    
+    def record(self, stage: str, start: float, end: float) -> None:
+        with self._lock:
+            span = self._spans.get(stage)
+            if span is None:
+                self._spans[stage] = [start, end, 1, end - start]
+            else:
+                span[0] = min(span[0], start)
+                span[1] = max(span[1], end)
+                span[2] += 1
+                span[3] += end - start
+    
+    @contextmanager
+    def span(self, stage: str):
+        start = time.monotonic()
         try:
-            if not self.reference_audio_base64:
-                logging.warning("⚠️ 参考音频未加载，跳过语音生成")
-                return None
-            
-            # 从环境变量获取参考音频文本，或使用默认文本
-            ref_text = os.getenv(
-                "TEXT_IN_REFERENCE_AUDIO",
-                "初次见面，我已经关注你很久了。我叫纳西妲，别看我像个孩子，我比任何一位大人都了解这个世界。所以，我可以用我的知识，换取你路上的见闻吗？"
-            )
-            
-            response = self.client.audio.speech.create(
-                model=self.config.tts_model,
-                input=text,
-                voice="",
-                response_format="mp3",
-                extra_body={
-                    "references": [{
-                        "audio": self.reference_audio_base64,
-                        "text": ref_text
-                    }]
+            yield
+        finally:
+            self.record(stage, start, time.monotonic())
+    
+    def mark(self, name: str, at: Optional[float] = None) -> None:
+        """记录某个时间点（如首个增量文本），只保留第一次"""
+        with self._lock:
+            self._marks.setdefault(name, at if at is not None else time.monotonic())
+    
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = {
+                stage: {
+                    "start": self._ms(start - self.started),
+                    "end": self._ms(end - self.started),
+                    "duration": self._ms(end - start),
+                    "count": int(count),
+                    "busy": self._ms(busy),
                 }
-            )
-            
-            return base64.b64encode(response.content).decode("utf-8")
-        except Exception as e:
-            logging.error(f"❌ 生成语音失败: {e}")
-            return None
+                for stage, (start, end, count, busy) in self._spans.items()
+            }
+            marks = {name: self._ms(at - self.started) for name, at in self._marks.items()}
+        return {
+            "request_id": self.request_id,
+            "total": self._ms(time.monotonic() - self.started),
+            "stages": stages,
+            "marks": marks,
+        }
+    
+    def server_timing(self) -> str:
+        """Server-Timing 响应头，只包含响应头发出前已经结束的阶段"""
+        with self._lock:
+            entries = [f"{stage};dur={self._ms(end - start)}" for stage, (start, end, _, _) in self._spans.items()]
+        entries.append(f"total;dur={self._ms(time.monotonic() - self.started)}")
+        return ", ".join(entries)
+    
+    def log(self, outcome: str) -> Dict[str, Any]:
+        """输出一行以请求 ID 为键的 JSON 日志，返回汇总结果"""
+        summary = self.summary()
+        summary["outcome"] = outcome
+        logging.info(f"⏱️ 请求 {self.request_id} 耗时 {json.dumps(summary, ensure_ascii=False)}")
+        return summary
 
 
-# ==================== Flask 应用 ====================
+# ==================== 录制回放 ====================
 
-def create_app() -> Flask:
-    """创建 Flask 应用"""
-    app = Flask(__name__)
+# 与 OpenAI SDK 默认的连接池设置一致
+UPSTREAM_CONNECTION_LIMITS = httpx.Limits(max_connections=1000, max_keepalive_connections=100)
+
+
+class Cassette:
+    """上游 HTTP 交互的录制与回放，用于可复现的压测和离线调试
+
+    录制模式下在 httpx 传输层记录每次请求的响应状态、响应头、首包延迟和
+    流式响应的各分片间隔，按请求方法、地址和请求体的哈希存入 gzip 压缩的
+    JSON Lines 文件；不保存任何请求头，API Key 不会落盘。回放模式下按相同
+    哈希返回录制的响应，并按原始（或缩放后的）节奏发送各分片，完全不访问网络。
+    同一请求录制了多次时依次循环使用。
+    """
     
-    # 配置日志
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s"
-    )
+    MODES = ("record", "replay")
     
-    @app.route("/")
-    def index():
-        return render_template("index.html")
+    def __init__(self, path: str, mode: str, time_scale: float = 1.0):
+        self.path = Path(path)
+        self.mode = mode
+        self.time_scale = time_scale
+        self._entries: Optional[Dict[str, List[Dict[str, Any]]]] = None
+        self._cursors: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        if mode == "record":
+            self.path.parent.mkdir(parents=True, exist_ok=True)
     
-    @app.route("/chat", methods=["POST"])
-    def chat():
-        # 从请求头中读取用户配置
-        config = UserConfig.from_headers(request.headers)
-        
-        # 验证配置
-        error = config.validate()
-        if error:
-            return Response(
-                create_sse_message({"type": "error", "content": error}),
-                mimetype="text/event-stream"
-            )
-        
-        # 创建 AI 服务实例
+    @staticmethod
+    def key(request: httpx.Request) -> str:
+        digest = hashlib.sha256(f"{request.method} {request.url}\n".encode("utf-8"))
+        digest.update(request.content)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def _kept_headers(headers: httpx.Headers) -> Dict[str, str]:
+        """只保留影响客户端行为的响应头"""
+        return {
+            name: value for name, value in headers.items()
+            # 录制的是传输层的原始字节，仍是压缩后的内容，回放时要靠 content-encoding 解压
+            if name in ("content-type", "content-encoding", "content-length", "retry-after") 
+            or name.startswith("x-ratelimit")
+        }
+    
+    def save(
+        self, 
+        request: httpx.Request, 
+        response: httpx.Response, 
+        latency: float, 
+        chunks: List[Tuple[float, bytes]]
+    ) -> None:
         try:
-            ai_service = AIService(config)
-        except Exception as e:
-            return Response(
-                create_sse_message({"type": "error", "content": f"初始化服务失败: {str(e)}"}),
-                mimetype="text/event-stream"
-            )
-        
-        data = request.json
-        user_message = data.get("message", "").strip()
-        history = data.get("history", [])
-        
-        if not user_message:
-            return Response(
-                create_sse_message({"type": "error", "content": "消息不能为空"}),
-                mimetype="text/event-stream"
+            body = [[round(delay, 4), chunk.decode("utf-8")] for delay, chunk in chunks]
+            encoding = "utf-8"
+        except UnicodeDecodeError:
+            # 多字节字符跨分片或二进制内容（音频、图像）
+            body = [[round(delay, 4), base64.b64encode(chunk).decode("ascii")] for delay, chunk in chunks]
+            encoding = "base64"
+        entry = {
+            "key": self.key(request),
+            "method": request.method,
+            "url": f"{request.url.host}{request.url.path}",
+            "status": response.status_code,
+            "headers": self._kept_headers(response.headers),
+            "latency": round(latency, 4),
+            "encoding": encoding,
+            "body": body,
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            # gzip 允许多个成员首尾相接，追加写入后仍可整体读取；
+            # 锁只在进程内有效，多个 worker 各写自己的文件，避免成员交错
+            with gzip.open(self._process_path(), "at", encoding="utf-8") as f:
+                f.write(line)
+    
+    @property
+    def _stem(self) -> str:
+        return self.path.name[:-len(".jsonl.gz")] if self.path.name.endswith(".jsonl.gz") else self.path.stem
+    
+    def _process_path(self) -> Path:
+        return self.path.with_name(f"{self._stem}.{os.getpid()}.jsonl.gz")
+    
+    def files(self) -> List[Path]:
+        """回放时读取的文件：<名称>.jsonl.gz 和各进程录制的 <名称>.<pid>.jsonl.gz"""
+        files = [self.path] if self.path.exists() else []
+        for path in sorted(self.path.parent.glob(f"{self._stem}.*.jsonl.gz")):
+            if path.name[len(self._stem) + 1:-len(".jsonl.gz")].isdigit():
+                files.append(path)
+        return files
+    
+    def _load(self) -> Dict[str, List[Dict[str, Any]]]:
+        entries: Dict[str, List[Dict[str, Any]]] = {}
+        files = self.files()
+        for path in files:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    entries.setdefault(entry["key"], []).append(entry)
+        logging.info(
+            f"📼 已加载录制文件 {self.path}（{len(files)} 个文件，{sum(map(len, entries.values()))} 条交互）"
+        )
+        return entries
+    
+    def lookup(self, request: httpx.Request) -> Optional[Dict[str, Any]]:
+        key = self.key(request)
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            recorded = self._entries.get(key)
+            if not recorded:
+                return None
+            cursor = self._cursors.get(key, 0)
+            self._cursors[key] = cursor + 1
+            return recorded[cursor % len(recorded)]
+    
+    def _chunks(self, entry: Dict[str, Any]) -> List[Tuple[float, bytes]]:
+        if entry["encoding"] == "base64":
+            return [(delay * self.time_scale, base64.b64decode(data)) for delay, data in entry["body"]]
+        return [(delay * self.time_scale, data.encode("utf-8")) for delay, data in entry["body"]]
+    
+    def replay(self, request: httpx.Request) -> Tuple[float, httpx.Response]:
+        """返回 (首包延迟, 响应)；没有匹配的录制时返回 404"""
+        entry = self.lookup(request)
+        if entry is None:
+            logging.warning(f"⚠️ 录制文件中没有匹配的请求: {request.method} {request.url}")
+            return 0.0, httpx.Response(
+                404, json={"message": f"cassette miss: {request.method} {request.url.path}"}, request=request
             )
-        
-        def event_stream() -> Generator[str, None, None]:
+        response = httpx.Response(
+            entry["status"], 
+            headers=entry["headers"], 
+            stream=_ReplayStream(self._chunks(entry)), 
+            request=request
+        )
+        return entry["latency"] * self.time_scale, response
+    
+
+
+class _ReplayStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """按录制时的间隔依次发送响应分片"""
+    
+    def __init__(self, chunks: List[Tuple[float, bytes]]):
+        self._chunks = chunks
+    
+    def __iter__(self):
+        for delay, chunk in self._chunks:
+            if delay > 0:
+                time.sleep(delay)
+            yield chunk
+    
+    async def __aiter__(self):
+        for delay, chunk in self._chunks:
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield chunk
+
+
+class _RecordingStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """转发上游响应分片并记录间隔，完整读取后写入录制文件；中途断开的响应不保存"""
+    
+    def __init__(self, cassette: Cassette, request: httpx.Request, response: httpx.Response, started: float):
+        self._cassette = cassette
+        self._request = request
+        self._response = response
+        self._stream = response.stream
+        self._latency = time.monotonic() - started
+        self._last = time.monotonic()
+        self._chunks: List[Tuple[float, bytes]] = []
+        self._complete = False
+    
+    def _record(self, chunk: bytes) -> None:
+        now = time.monotonic()
+        self._chunks.append((now - self._last, chunk))
+        self._last = now
+    
+    def _save(self) -> None:
+        if self._complete:
+            self._complete = False
             try:
-                # 1. 生成对话回复
-                nahida_reply = ai_service.generate_chat_response(user_message, history)
-                
-                # 2. 并行生成语音和图像
-                results: Dict[str, Any] = {}
-                
-                def generate_speech_task():
-                    results["audio_base64"] = ai_service.generate_speech(nahida_reply)
-                
-                def generate_image_task():
-                    prompt = ai_service.generate_image_prompt(user_message, nahida_reply)
-                    if prompt:
-                        results["image_url"] = ai_service.generate_image(prompt)
-                    else:
-                        results["image_url"] = None
-                
-                speech_thread = threading.Thread(target=generate_speech_task)
-                image_thread = threading.Thread(target=generate_image_task)
-                
-                speech_thread.start()
-                image_thread.start()
-                
-                # 等待语音完成并发送
-                speech_thread.join()
-                yield create_sse_message({
-                    "type": "content_start",
-                    "text": nahida_reply,
-                    "audio": results.get("audio_base64")
-                })
-                
-                # 等待图像完成并发送
-                image_thread.join()
-                if results.get("image_url"):
-                    yield create_sse_message({
-                        "type": "image",
-                        "payload": results["image_url"]
-                    })
-                
-                # 完成
-                yield create_sse_message({
-                    "type": "done",
-                    "full_response": nahida_reply
-                })
-                
+                self._cassette.save(self._request, self._response, self._latency, self._chunks)
             except Exception as e:
-                logging.error(f"❌ 处理请求时出错: {e}")
-                yield create_sse_message({
-                    "type": "error",
-                    "content": str(e)
-                })
-        
-        return Response(event_stream(), mimetype="text/event-stream")
+                logging.warning(f"⚠️ 写入录制文件失败: {e}")
+    
+    def __iter__(self):
+        for chunk in self._stream:
+            self._record(chunk)
+            yield chunk
+        self._complete = True
+    
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            self._record(chunk)
+            yield chunk
+        self._complete = True
+    
+    def close(self) -> None:
+        self._stream.close()
+        self._save()
+    
+    async def aclose(self) -> None:
+        await self._stream.aclose()
+        self._save()
+
+
+class CassetteTransport(httpx.BaseTransport):
+    """同步客户端的录制回放传输层"""
+    
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+        self._transport = (
+            httpx.HTTPTransport(limits=UPSTREAM_CONNECTION_LIMITS) if cassette.mode == "record" else None
+        )
+    
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        if self._transport is None:
+            latency, response = self.cassette.replay(request)
+            if latency > 0:
+                time.sleep(latency)
+            return response
+        
+        started = time.monotonic()
+        response = self._transport.handle_request(request)
+        return httpx.Response(
+            response.status_code, 
+            headers=response.headers, 
+            stream=_RecordingStream(self.cassette, request, response, started), 
+            extensions=response.extensions
+        )
+    
+    def close(self) -> None:
+        if self._transport is not None:
+            self._transport.close()
+
+
+class AsyncCassetteTransport(httpx.AsyncBaseTransport):
+    """异步客户端的录制回放传输层"""
+    
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+        self._transport = (
+            httpx.AsyncHTTPTransport(limits=UPSTREAM_CONNECTION_LIMITS) if cassette.mode == "record" else None
+        )
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        if self._transport is None:
+            latency, response = self.cassette.replay(request)
+            if latency > 0:
+                await asyncio.sleep(latency)
+            return response
+        
+        started = time.monotonic()
+        response = await self._transport.handle_async_request(request)
+        return httpx.Response(
+            response.status_code, 
+            headers=response.headers, 
+            stream=_RecordingStream(self.cassette, request, response, started), 
+            extensions=response.extensions
+        )
+    
+    async def aclose(self) -> None:
+        if self._transport is not None:
+            await self._transport.aclose()
+
+
+def create_cassette() -> Optional[Cassette]:
+    """CASSETTE_MODE=record/replay 时启用，默认关闭"""
+    mode = os.getenv("CASSETTE_MODE", "off").strip().lower()
+    if mode not in Cassette.MODES:
+        return None
+    directory = os.getenv("CASSETTE_DIR", os.path.join(".cache", "cassettes"))
+    name = os.getenv("CASSETTE_NAME", "default")
+    return Cassette(
+        os.path.join(directory, f"{name}.jsonl.gz"), 
+        mode, 
+        time_scale=float(os.getenv("CASSETTE_TIME_SCALE", 1.0)),
+    )
+
+
+cassette = create_cassette()
+
+
+# ==================== 上游调用取消 ====================
+
+class UpstreamCancelled(Exception):
+    """客户端已断开，本次对话的上游调用被取消"""
+    
+    def __init__(self):
+        super().__init__("客户端已断开，上游调用已取消")
+
+
+class UpstreamScope:
+    """一次对话（或一次被合并的上游调用）发起的上游请求
+
+    同步入口的上游调用在各阶段线程中阻塞读取，无法像协程那样直接取消。
+    客户端断开时 cancel() 关闭所有进行中响应的底层套接字，正在读取的线程
+    随即出错返回，上游也因连接断开停止生成；之后发起的请求不再发出。
+    只能中断已经收到响应头的请求，因此需要取消的调用（对话、提示词）使用流式响应。
+    """
+    
+    def __init__(self):
+        self._cancelled = False
+        self._responses: Set[httpx.Response] = set()
+        self._callbacks: List[Callable[[], int]] = []
+        self._lock = threading.Lock()
+    
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+    
+    def on_cancel(self, callback: Callable[[], int]) -> None:
+        """取消时调用 callback（返回它中断的响应数）；已经取消时立即调用"""
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+    
+    def track(self, response: httpx.Response) -> bool:
+        """登记进行中的响应；已经取消时返回 False"""
+        with self._lock:
+            if self._cancelled:
+                return False
+            self._responses.add(response)
+            return True
+    
+    def untrack(self, response: httpx.Response) -> None:
+        with self._lock:
+            self._responses.discard(response)
+    
+    def cancel(self) -> int:
+        """取消范围内的上游请求，返回被中断的进行中响应数"""
+        with self._lock:
+            if self._cancelled:
+                return 0
+            self._cancelled = True
+            responses, self._responses = self._responses, set()
+            callbacks, self._callbacks = self._callbacks, []
+        for response in responses:
+            _abort_response(response)
+        return len(responses) + sum(callback() for callback in callbacks)
+
+
+# 当前线程中上游请求所属的范围，由 AIService 和 SingleFlight 在发起调用时设置
+upstream_scope: contextvars.ContextVar[Optional[UpstreamScope]] = contextvars.ContextVar(
+    "upstream_scope", default=None
+)
+
+
+@contextmanager
+def bind_upstream(scope: Optional[UpstreamScope]):
+    token = upstream_scope.set(scope)
+    try:
+        yield
+    finally:
+        upstream_scope.reset(token)
+
+
+def _abort_response(response: httpx.Response) -> None:
+    """从其他线程中断响应：关闭底层套接字的读写，阻塞中的读取立即返回"""
+    network_stream = response.extensions.get("network_stream")
+    sock = network_stream.get_extra_info("socket") if network_stream is not None else None
+    if sock is None:
+        return
+    try:
+        # TLS 连接只关闭底层套接字，不动正在被读取线程使用的 SSL 对象
+        socket.socket.shutdown(sock, socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class _CancellableStream(httpx.SyncByteStream):
+    """读取中途被取消时抛出 UpstreamCancelled；关闭时从范围中注销"""
+    
+    def __init__(self, response: httpx.Response, scope: UpstreamScope):
+        self._response = response
+        self._scope = scope
+    
+    def __iter__(self):
+        try:
+            for chunk in self._response.stream:
+                if self._scope.cancelled:
+                    raise UpstreamCancelled()
+                yield chunk
+        except UpstreamCancelled:
+            raise
+        except Exception as e:
+            if self._scope.cancelled:
+                raise UpstreamCancelled() from e
+            raise
+    
+    def close(self) -> None:
+        try:
+            self._response.close()
+        finally:
+            self._scope.untrack(self._response)
+
+
+def _cancelled_response(request: httpx.Request) -> httpx.Response:
+    """已取消的请求不发往上游；x-should-retry 让 SDK 不再重试"""
+    return httpx.Response(
+        499, 
+        headers={"x-should-retry": "false"}, 
+        json={"error": {"message": str(UpstreamCancelled())}}, 
+        request=request
+    )
+
+
+class CancellableTransport(httpx.BaseTransport):
+    """把请求登记到当前的 UpstreamScope，范围已取消时不再发出请求"""
+    
+    def __init__(self, transport: httpx.BaseTransport):
+        self._transport = transport
+    
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        scope = upstream_scope.get()
+        if scope is None:
+            return self._transport.handle_request(request)
+        if scope.cancelled:
+            return _cancelled_response(request)
+        response = self._transport.handle_request(request)
+        if not scope.track(response):
+            response.close()
+            return _cancelled_response(request)
+        return httpx.Response(
+            response.status_code, 
+            headers=response.headers, 
+            stream=_CancellableStream(response, scope), 
+            extensions=response.extensions
+        )
+    
+    def close(self) -> None:
+        self._transport.close()
+
+
+# ==================== 自适应限流 ====================
+
+def key_fingerprint(api_key: str) -> str:
+    """API Key 的短指纹，用于日志和指标标签，不暴露 key 本身"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+
+
+def _header_float(headers: httpx.Headers, name: str) -> Optional[float]:
+    try:
+        return float(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+def rate_limit_remaining(headers: httpx.Headers) -> Optional[float]:
+    """x-ratelimit-* 响应头中剩余额度的比例（请求数和 token 数取较小者）"""
+    ratios = []
+    for kind in ("requests", "tokens"):
+        remaining = _header_float(headers, f"x-ratelimit-remaining-{kind}")
+        limit = _header_float(headers, f"x-ratelimit-limit-{kind}")
+        if remaining is not None and limit:
+            ratios.append(remaining / limit)
+    return min(ratios) if ratios else None
+
+
+def request_model(request: httpx.Request) -> Optional[str]:
+    """JSON 请求体中的模型名；不带模型的请求（如下载文件）返回 None"""
+    if not request.content.startswith(b"{"):
+        return None
+    try:
+        model = json.loads(request.content).get("model")
+    except ValueError:
+        return None
+    return model if isinstance(model, str) and model else None
+
+
+def retry_after_seconds(headers: httpx.Headers) -> Optional[float]:
+    retry_after_ms = _header_float(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    return _header_float(headers, "retry-after")
+
+
+class AdaptiveLimiter:
+    """单个 (API Key, 模型) 的 AIMD 并发上限
+
+    调用成功且名额已用满（或有人排队）时上限增加 1/上限，约每轮满载调用加 1；
+    收到 429 或剩余额度低于水位线时上限乘以 decrease_factor，同一冷却期内只降一次，
+    避免同一批请求的多个 429 把上限连续压到底。429 带 Retry-After 时暂停发放名额。
+    超出上限的调用排队等待，而不是发出去再失败；仍然收到 429 的调用由传输层
+    归还名额后重新排队、重发。
+    """
+    
+    def __init__(
+        self, 
+        name: str, 
+        initial: float, 
+        min_limit: float, 
+        max_limit: float, 
+        decrease_factor: float, 
+        cooldown: float, 
+        low_watermark: float
+    ):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.low_watermark = low_watermark
+        self.inflight = 0
+        self.waiting = 0
+        self.throttled = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self.last_used = time.monotonic()
+        self._cond = threading.Condition()
+        # 异步调用方的 (事件循环, Future)，名额变化时唤醒
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+    
+    def _try_acquire_locked(self, now: float) -> Optional[float]:
+        """取得名额返回 None，否则返回建议的等待时间（暂停中时为剩余暂停时间）"""
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.inflight < max(1, int(self.limit)):
+            self.inflight += 1
+            return None
+        return math.inf
+    
+    def _wake_locked(self) -> None:
+        self._cond.notify_all()
+        for loop, future in self._async_waiters:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+        self._async_waiters.clear()
+    
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._try_acquire_locked(now)
+                    if wait is None:
+                        return True
+                    if deadline is not None:
+                        if now >= deadline:
+                            return False
+                        wait = min(wait, deadline - now)
+                    self._cond.wait(None if math.isinf(wait) else wait)
+            finally:
+                self.waiting -= 1
+    
+    async def acquire_async(self, timeout: Optional[float] = None) -> bool:
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                wait = self._try_acquire_locked(now)
+                if wait is None:
+                    return True
+                if deadline is not None:
+                    if now >= deadline:
+                        return False
+                    wait = min(wait, deadline - now)
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+                self.waiting += 1
+            try:
+                await asyncio.wait({future}, timeout=None if math.isinf(wait) else wait)
+            finally:
+                with self._cond:
+                    self.waiting -= 1
+                    if (loop, future) in self._async_waiters:
+                        self._async_waiters.remove((loop, future))
+    
+    def release(self) -> None:
+        with self._cond:
+            self.inflight -= 1
+            self.last_used = time.monotonic()
+            self._wake_locked()
+    
+    def paused_for(self) -> float:
+        return max(0.0, self._paused_until - time.monotonic())
+    
+    def idle(self, now: float, ttl: float) -> bool:
+        return not self.inflight and not self.waiting and now - self.last_used > ttl
+    
+    def observe(self, response: httpx.Response) -> None:
+        """根据响应调整上限；5xx 与限流无关，不做调整"""
+        now = time.monotonic()
+        with self._cond:
+            if response.status_code == 429:
+                self.throttled += 1
+                retry_after = retry_after_seconds(response.headers)
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+                self._decrease_locked(now, "429")
+            elif response.status_code < 500:
+                remaining = rate_limit_remaining(response.headers)
+                if remaining is not None and remaining < self.low_watermark:
+                    self._decrease_locked(now, f"剩余额度 {remaining:.0%}")
+                elif self.inflight >= int(self.limit) or self.waiting:
+                    # 只在名额用满时试探上调，空闲时上限不会无限增长
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                    self._wake_locked()
+    
+    def _decrease_locked(self, now: float, reason: str) -> None:
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        previous = self.limit
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        logging.warning(f"⚠️ 上游限流（{reason}），{self.name} 并发上限 {previous:.1f} → {self.limit:.1f}")
+
+
+class AdaptiveLimiterRegistry:
+    """按 (API Key, 模型) 维护 AdaptiveLimiter"""
+    
+    def __init__(
+        self, 
+        enabled: bool = True, 
+        initial: float = 32, 
+        min_limit: float = 1, 
+        max_limit: float = 128, 
+        decrease_factor: float = 0.5, 
+        cooldown: float = 2.0, 
+        low_watermark: float = 0.1, 
+        idle_ttl: float = 600.0
+    ):
+        self.enabled = enabled
+        # 用户自带的 Key 各有一组限流器，长时间空闲的被回收，学到的上限随之丢弃
+        self.idle_ttl = idle_ttl
+        self._last_prune = time.monotonic()
+        self.options = dict(
+            initial=initial, 
+            min_limit=min_limit, 
+            max_limit=max_limit, 
+            decrease_factor=decrease_factor, 
+            cooldown=cooldown, 
+            low_watermark=low_watermark,
+        )
+        self._limiters: Dict[Tuple[str, str], AdaptiveLimiter] = {}
+        self._lock = threading.Lock()
+    
+    def get(self, api_key: str, model: str) -> AdaptiveLimiter:
+        key = (key_fingerprint(api_key), model)
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_prune > min(self.idle_ttl, 60.0):
+                self._prune_locked(now)
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limiter = self._limiters[key] = AdaptiveLimiter(f"{key[0]}/{model}", **self.options)
+            limiter.last_used = now
+            return limiter
+    
+    def _prune_locked(self, now: float) -> None:
+        self._last_prune = now
+        for key, limiter in list(self._limiters.items()):
+            if limiter.idle(now, self.idle_ttl):
+                del self._limiters[key]
+    
+    def for_request(self, request: httpx.Request) -> Optional[AdaptiveLimiter]:
+        """从请求头和 JSON 请求体中取出 key 和模型；不带模型的请求不限流"""
+        authorization = request.headers.get("authorization", "")
+        model = request_model(request)
+        if not authorization.startswith("Bearer ") or model is None:
+            return None
+        return self.get(authorization[len("Bearer "):], model)
+    
+    def items(self) -> List[Tuple[Tuple[str, str], AdaptiveLimiter]]:
+        with self._lock:
+            return list(self._limiters.items())
+
+
+def _pool_timeout(request: httpx.Request) -> Optional[float]:
+    """排队等待不超过本次调用的超时（SDK 按请求期限设置）"""
+    return request.extensions.get("timeout", {}).get("pool")
+
+
+# 本地限流队列等不到名额时生成的 429 带此响应头，与上游的 429 区分
+LOCAL_THROTTLE_HEADER = "x-nahida-local-throttle"
+
+
+def _local_throttle_response(request: httpx.Request, limiter: AdaptiveLimiter) -> httpx.Response:
+    """在限流队列中等待超时：这是本地背压，不是上游故障
+
+    抛出 httpx.PoolTimeout 会被 SDK 当作超时重试，再计入熔断器。改为返回带标记的 429，
+    x-should-retry 让 SDK 不再重试；429 不计入熔断器，Key 池也不据此暂停 Key。
+    """
+    return httpx.Response(
+        429, 
+        headers={"x-should-retry": "false", LOCAL_THROTTLE_HEADER: limiter.name}, 
+        json={"error": {"message": f"等待 {limiter.name} 并发名额超时"}}, 
+        request=request
+    )
+
+
+def is_local_throttle(error: Exception) -> bool:
+    """由本地限流队列超时产生的错误"""
+    return isinstance(error, APIStatusError) and LOCAL_THROTTLE_HEADER in error.response.headers
+
+
+def _time_left(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+def _buffered(response: httpx.Response) -> httpx.Response:
+    """已读完的响应（429 的错误信息），不再占用名额"""
+    return httpx.Response(
+        response.status_code, 
+        headers=response.headers, 
+        content=response.content, 
+        extensions=response.extensions
+    )
+
+
+class _ReleasingStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """响应读完或关闭时调用 holder.release()；流式回复在整个流期间占用名额"""
+    
+    def __init__(self, stream, holder):
+        self._stream = stream
+        self._holder = holder
+        self._released = False
+    
+    def _release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._holder.release()
+    
+    def __iter__(self):
+        yield from self._stream
+    
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+    
+    def close(self) -> None:
+        try:
+            self._stream.close()
+        finally:
+            self._release()
+    
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            self._release()
+
+
+def _hold_until_closed(response: httpx.Response, holder) -> httpx.Response:
+    return httpx.Response(
+        response.status_code, 
+        headers=response.headers, 
+        stream=_ReleasingStream(response.stream, holder), 
+        extensions=response.extensions
+    )
+
+
+class AdaptiveLimitTransport(httpx.BaseTransport):
+    """同步客户端的自适应限流传输层"""
+    
+    def __init__(self, limiters: AdaptiveLimiterRegistry, transport: httpx.BaseTransport):
+        self.limiters = limiters
+        self._transport = transport
+    
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        limiter = self.limiters.for_request(request)
+        if limiter is None:
+            return self._transport.handle_request(request)
+        timeout = _pool_timeout(request)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not limiter.acquire(timeout):
+            return _local_throttle_response(request, limiter)
+        while True:
+            try:
+                response = self._transport.handle_request(request)
+            except BaseException:
+                limiter.release()
+                raise
+            limiter.observe(response)
+            if response.status_code != 429:
+                return _hold_until_closed(response, limiter)
+            # 被限流：归还名额，按 Retry-After 和缩小后的上限重新排队，期限内拿到名额就重发
+            try:
+                response.read()
+            finally:
+                response.close()
+                limiter.release()
+            left = _time_left(deadline)
+            if left is not None and limiter.paused_for() >= left or not limiter.acquire(left):
+                return _buffered(response)
+            logging.info(f"⏭️ {limiter.name} 被限流，排队后重发")
+    
+    def close(self) -> None:
+        self._transport.close()
+
+
+class AsyncAdaptiveLimitTransport(httpx.AsyncBaseTransport):
+    """异步客户端的自适应限流传输层"""
+    
+    def __init__(self, limiters: AdaptiveLimiterRegistry, transport: httpx.AsyncBaseTransport):
+        self.limiters = limiters
+        self._transport = transport
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        limiter = self.limiters.for_request(request)
+        if limiter is None:
+            return await self._transport.handle_async_request(request)
+        timeout = _pool_timeout(request)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not await limiter.acquire_async(timeout):
+            return _local_throttle_response(request, limiter)
+        while True:
+            try:
+                response = await self._transport.handle_async_request(request)
+            except BaseException:
+                limiter.release()
+                raise
+            limiter.observe(response)
+            if response.status_code != 429:
+                return _hold_until_closed(response, limiter)
+            try:
+                await response.aread()
+            finally:
+                await response.aclose()
+                limiter.release()
+            left = _time_left(deadline)
+            if left is not None and limiter.paused_for() >= left or not await limiter.acquire_async(left):
+                return _buffered(response)
+            logging.info(f"⏭️ {limiter.name} 被限流，排队后重发")
+    
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+adaptive_limiters = AdaptiveLimiterRegistry(
+    enabled=os.getenv("ADAPTIVE_LIMIT", "true").lower() == "true",
+    initial=float(os.getenv("ADAPTIVE_LIMIT_INITIAL", 32)),
+    min_limit=float(os.getenv("ADAPTIVE_LIMIT_MIN", 1)),
+    max_limit=float(os.getenv("ADAPTIVE_LIMIT_MAX", 128)),
+    decrease_factor=float(os.getenv("ADAPTIVE_LIMIT_DECREASE", 0.5)),
+    cooldown=float(os.getenv("ADAPTIVE_LIMIT_COOLDOWN", 2.0)),
+    low_watermark=float(os.getenv("ADAPTIVE_LIMIT_LOW_WATERMARK", 0.1)),
+    idle_ttl=float(os.getenv("ADAPTIVE_LIMIT_IDLE_TTL", 600)),
+)
+
+
+def create_http_client(pooled_key: Optional["PooledKey"] = None) -> httpx.Client:
+    """OpenAI 客户端使用的 httpx 客户端：可选的录制回放和自适应限流，其余沿用 SDK 默认设置"""
+    transport = CassetteTransport(cassette) if cassette else httpx.HTTPTransport(limits=UPSTREAM_CONNECTION_LIMITS)
+    if adaptive_limiters.enabled:
+        transport = AdaptiveLimitTransport(adaptive_limiters, transport)
+    if pooled_key is not None:
+        # 最外层计数，在限流队列中等待的请求也算作该 Key 进行中的请求
+        transport = PooledKeyTransport(pooled_key, transport)
+    # 客户端断开后不再发出请求、也不在限流队列中排队
+    return DefaultHttpxClient(transport=CancellableTransport(transport))
+
+
+def create_async_http_client(pooled_key: Optional["PooledKey"] = None) -> httpx.AsyncClient:
+    transport = (
+        AsyncCassetteTransport(cassette) if cassette 
+        else httpx.AsyncHTTPTransport(limits=UPSTREAM_CONNECTION_LIMITS)
+    )
+    if adaptive_limiters.enabled:
+        transport = AsyncAdaptiveLimitTransport(adaptive_limiters, transport)
+    if pooled_key is not None:
+        transport = AsyncPooledKeyTransport(pooled_key, transport)
+    return DefaultAsyncHttpxClient(transport=transport)
+
+
+# ==================== 客户端连接池 ====================
+
+class OpenAIClientPool:
+    """进程级 OpenAI 客户端池
+
+    按 (api_key, base_url) 复用客户端，使 keep-alive 连接在请求之间共享，
+    避免每条消息都重新建立连接池和 TLS 握手。长时间未使用的客户端会被关闭回收；
+    超出容量时按 LRU 淘汰，被淘汰的客户端可能仍有请求在使用，retire_grace 秒后再关闭。
+    """
+
+    def __init__(
+        self, 
+        max_size: int = 32, 
+        idle_ttl: float = 600.0, 
+        factory=OpenAI, 
+        client_options: Optional[Dict[str, Any]] = None,
+        http_client_factory: Optional[Callable[[], Any]] = None,
+        retire_grace: Optional[float] = None
+    ):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.retire_grace = idle_ttl if retire_grace is None else retire_grace
+        self.factory = factory
+        self.client_options = client_options or {}
+        # 每个客户端需要独立的 httpx 客户端（关闭 OpenAI 客户端时会一并关闭）
+        self.http_client_factory = http_client_factory
+        self._reset()
+        # gunicorn preload 后 fork 出的 worker 不能复用 master 的连接
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        """丢弃继承来的客户端，不关闭连接（套接字仍属于父进程）"""
+        self._clients: "OrderedDict[Tuple[str, str], Tuple[Any, float]]" = OrderedDict()
+        # LRU 淘汰、等待关闭的客户端：(客户端, 淘汰时间)
+        self._retired: "deque[Tuple[Any, float]]" = deque()
+        # 进行中的异步关闭任务，保留引用以免任务在完成前被回收
+        self._closing: Set[asyncio.Task] = set()
+        self._lock = threading.Lock()
+
+    def get(self, api_key: str, base_url: str = SILICONFLOW_BASE_URL):
+        """获取（或创建）指定 key 对应的客户端"""
+        key = (api_key, base_url)
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            entry = self._clients.pop(key, None)
+            if entry is not None and now - entry[1] > self.idle_ttl:
+                expired.append(entry[0])
+                entry = None
+            client = entry[0] if entry else self._create(api_key, base_url)
+            self._clients[key] = (client, now)
+            expired.extend(self._evict_locked(now))
+        for stale in expired:
+            self._close(stale)
+        return client
+
+    def _create(self, api_key: str, base_url: str):
+        options = dict(self.client_options)
+        if self.http_client_factory:
+            options["http_client"] = self.http_client_factory()
+        return self.factory(api_key=api_key, base_url=base_url, **options)
+
+    def _evict_locked(self, now: float) -> List[Any]:
+        """淘汰空闲超时和超出容量的客户端，返回需要关闭的客户端"""
+        to_close = []
+        for key, (client, last_used) in list(self._clients.items()):
+            if now - last_used > self.idle_ttl:
+                del self._clients[key]
+                to_close.append(client)
+        while len(self._clients) > self.max_size:
+            # LRU 淘汰的客户端可能仍有请求在使用，过了 retire_grace 再关闭
+            _, (client, _) = self._clients.popitem(last=False)
+            self._retired.append((client, now))
+        while self._retired and now - self._retired[0][1] > self.retire_grace:
+            to_close.append(self._retired.popleft()[0])
+        return to_close
+
+    def _close(self, client) -> None:
+        try:
+            result = client.close()
+            if inspect.isawaitable(result):
+                self._close_async(result)
+        except Exception as e:
+            logging.warning(f"⚠️ 关闭空闲客户端失败: {e}")
+
+    def _close_async(self, closing: Awaitable[None]) -> None:
+        """AsyncOpenAI 的 close() 是协程：在当前事件循环中执行，没有运行中的事件循环时就地执行"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(closing)
+            return
+        task = loop.create_task(closing)
+        self._closing.add(task)
+        task.add_done_callback(self._closed)
+
+    def _closed(self, task: asyncio.Task) -> None:
+        self._closing.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(f"⚠️ 关闭空闲客户端失败: {task.exception()}")
+
+    def clear(self) -> None:
+        """关闭并清空所有客户端"""
+        with self._lock:
+            clients = [client for client, _ in self._clients.values()]
+            clients.extend(client for client, _ in self._retired)
+            self._clients.clear()
+            self._retired.clear()
+        for client in clients:
+            self._close(client)
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+
+# SDK 默认超时 10 分钟、重试 2 次，卡住的请求会长期占用线程；每次调用另按请求期限设置超时
+CLIENT_OPTIONS = {
+    "timeout": float(os.getenv("CLIENT_TIMEOUT", 60)),
+    "max_retries": int(os.getenv("CLIENT_MAX_RETRIES", 1)),
+}
+
+client_pool = OpenAIClientPool(
+    max_size=int(os.getenv("CLIENT_POOL_SIZE", 32)),
+    idle_ttl=float(os.getenv("CLIENT_IDLE_TTL", 600)),
+    client_options=CLIENT_OPTIONS,
+    http_client_factory=create_http_client,
+)
+
+# ASGI 入口使用的异步客户端池，客户端绑定在所属进程的事件循环上
+async_client_pool = OpenAIClientPool(
+    max_size=int(os.getenv("CLIENT_POOL_SIZE", 32)),
+    idle_ttl=float(os.getenv("CLIENT_IDLE_TTL", 600)),
+    factory=AsyncOpenAI,
+    client_options=CLIENT_OPTIONS,
+    http_client_factory=create_async_http_client,
+)
+
+
+# ==================== API Key 池 ====================
+
+class PooledKey:
+    """服务器端 Key 池中的一个 API Key
+
+    拥有独立的同步 / 异步客户端，连接池互不共享。经由这些客户端的上游请求从发出
+    到响应读完或关闭都计入 outstanding，流式回复在整个流期间计入；响应中的剩余额度
+    按模型记录。认证失败或余额不足时暂停使用整个 Key；上游的限流按 (Key, 模型) 计算，
+    被限流时只暂停该 Key 上的这个模型，其他模型照常使用。
+    """
+    
+    def __init__(self, pool: "ApiKeyPool", api_key: str):
+        self.pool = pool
+        self.api_key = api_key
+        self.name = key_fingerprint(api_key)
+        self.outstanding = 0
+        self.requests = 0
+        self.quarantines = 0
+        self.quarantined_until = 0.0
+        # 模型 -> 因限流暂停到的时刻
+        self.throttled_until: Dict[str, float] = {}
+        # 模型 -> 最近一次响应中剩余额度的比例
+        self.remaining: Dict[str, float] = {}
+        self._reset()
+    
+    def _reset(self) -> None:
+        """丢弃客户端，fork 后由子进程重新创建"""
+        self._client: Optional[OpenAI] = None
+        self._async_client: Optional[AsyncOpenAI] = None
+        self._lock = threading.Lock()
+    
+    @property
+    def client(self) -> OpenAI:
+        with self._lock:
+            if self._client is None:
+                self._client = OpenAI(
+                    api_key=self.api_key, 
+                    base_url=self.pool.base_url, 
+                    http_client=create_http_client(self), 
+                    **CLIENT_OPTIONS
+                )
+            return self._client
+    
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        with self._lock:
+            if self._async_client is None:
+                self._async_client = AsyncOpenAI(
+                    api_key=self.api_key, 
+                    base_url=self.pool.base_url, 
+                    http_client=create_async_http_client(self), 
+                    **CLIENT_OPTIONS
+                )
+            return self._async_client
+    
+    def quarantined(self, now: float, model: Optional[str] = None) -> bool:
+        """整个 Key 暂停使用中；指定模型时还包括该模型被限流"""
+        return now < self.resumes_at(model)
+    
+    def resumes_at(self, model: Optional[str] = None) -> float:
+        """可以再次用于该模型的时刻"""
+        if model is None:
+            return self.quarantined_until
+        return max(self.quarantined_until, self.throttled_until.get(model, 0.0))
+    
+    def throttled_models(self, now: float) -> List[str]:
+        with self._lock:
+            return [model for model, until in self.throttled_until.items() if now < until]
+    
+    def begin(self) -> None:
+        with self._lock:
+            self.outstanding += 1
+            self.requests += 1
+    
+    def release(self) -> None:
+        with self._lock:
+            self.outstanding -= 1
+    
+    def observe(self, request: httpx.Request, response: httpx.Response) -> None:
+        status = response.status_code
+        if LOCAL_THROTTLE_HEADER in response.headers:
+            # 本地限流队列超时，上游并没有限流
+            return
+        if status in ApiKeyPool.AUTH_ERRORS:
+            self.quarantine(self.pool.quarantine_seconds, f"HTTP {status}")
+        elif status == 429:
+            seconds = retry_after_seconds(response.headers) or self.pool.throttle_seconds
+            model = request_model(request)
+            if model is None:
+                self.quarantine(seconds, "429")
+            else:
+                self.throttle(model, seconds)
+        else:
+            remaining = rate_limit_remaining(response.headers)
+            model = request_model(request)
+            if remaining is not None and model is not None:
+                with self._lock:
+                    self.remaining[model] = remaining
+    
+    def quarantine(self, seconds: float, reason: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            newly = not self.quarantined(now)
+            self.quarantined_until = max(self.quarantined_until, now + seconds)
+            if newly:
+                self.quarantines += 1
+        if newly:
+            logging.warning(f"⚠️ API Key {self.name} 暂停使用 {seconds:.0f} 秒（{reason}）")
+    
+    def throttle(self, model: str, seconds: float) -> None:
+        """被限流：只暂停该 Key 上的这个模型"""
+        now = time.monotonic()
+        with self._lock:
+            # 顺便丢弃已过期的记录，避免字典随模型名增长
+            for expired in [name for name, until in self.throttled_until.items() if until <= now]:
+                del self.throttled_until[expired]
+            newly = model not in self.throttled_until
+            self.throttled_until[model] = max(self.throttled_until.get(model, 0.0), now + seconds)
+            if newly:
+                self.quarantines += 1
+        if newly:
+            logging.warning(f"⚠️ API Key {self.name} 的模型 {model} 被限流，暂停使用 {seconds:.0f} 秒")
+
+
+class PooledKeyTransport(httpx.BaseTransport):
+    """统计 Key 池中某个 Key 进行中的请求，并根据响应隔离该 Key"""
+    
+    def __init__(self, pooled_key: PooledKey, transport: httpx.BaseTransport):
+        self.pooled_key = pooled_key
+        self._transport = transport
+    
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        self.pooled_key.begin()
+        try:
+            response = self._transport.handle_request(request)
+        except BaseException:
+            self.pooled_key.release()
+            raise
+        self.pooled_key.observe(request, response)
+        return _hold_until_closed(response, self.pooled_key)
+    
+    def close(self) -> None:
+        self._transport.close()
+
+
+class AsyncPooledKeyTransport(httpx.AsyncBaseTransport):
+    
+    def __init__(self, pooled_key: PooledKey, transport: httpx.AsyncBaseTransport):
+        self.pooled_key = pooled_key
+        self._transport = transport
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        self.pooled_key.begin()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            self.pooled_key.release()
+            raise
+        self.pooled_key.observe(request, response)
+        return _hold_until_closed(response, self.pooled_key)
+    
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class ApiKeyPool:
+    """服务器端 API Key 池
+
+    用户没有提供自己的 Key 时，每次阶段调用从池中选一个 Key：跳过暂停中的 Key，
+    优先剩余额度不低于水位线的 Key，其中选进行中请求最少的；并列时轮流选择，
+    使同时到达的请求分散到不同 Key。全部暂停时选最早恢复的 Key，而不是直接拒绝。
+    """
+    
+    # 401 Key 无效，403 余额不足或无权限
+    AUTH_ERRORS = (401, 403)
+    
+    def __init__(
+        self, 
+        keys: List[str], 
+        base_url: str = SILICONFLOW_BASE_URL, 
+        quarantine_seconds: float = 300.0, 
+        throttle_seconds: float = 5.0, 
+        low_watermark: float = 0.1
+    ):
+        self.base_url = base_url
+        self.quarantine_seconds = quarantine_seconds
+        self.throttle_seconds = throttle_seconds
+        self.low_watermark = low_watermark
+        self.keys = [PooledKey(self, key) for key in dict.fromkeys(keys)]
+        self._by_key = {pooled.api_key: pooled for pooled in self.keys}
+        self._reset()
+        # gunicorn preload 后 fork 出的 worker 不能复用 master 的连接
+        os.register_at_fork(after_in_child=self._reset)
+    
+    def _reset(self) -> None:
+        self._cursor = 0
+        self._lock = threading.Lock()
+        for pooled in self.keys:
+            pooled._reset()
+    
+    def __len__(self) -> int:
+        return len(self.keys)
+    
+    def get(self, api_key: str) -> Optional[PooledKey]:
+        return self._by_key.get(api_key)
+    
+    def available(self, model: Optional[str] = None) -> int:
+        """可用的 Key 数；指定模型时不计该模型被限流的 Key"""
+        now = time.monotonic()
+        return sum(1 for pooled in self.keys if not pooled.quarantined(now, model))
+    
+    def select(self, model: str) -> PooledKey:
+        now = time.monotonic()
+        with self._lock:
+            start = self._cursor
+            self._cursor = (self._cursor + 1) % len(self.keys)
+        candidates = self.keys[start:] + self.keys[:start]
+        usable = [pooled for pooled in candidates if not pooled.quarantined(now, model)]
+        if not usable:
+            return min(candidates, key=lambda pooled: pooled.resumes_at(model))
+        
+        def load(pooled: PooledKey) -> Tuple[bool, int, float]:
+            remaining = pooled.remaining.get(model, 1.0)
+            return remaining < self.low_watermark, pooled.outstanding, -remaining
+        
+        return min(usable, key=load)
+    
+    @classmethod
+    def is_key_error(cls, error: Exception) -> bool:
+        """由 Key 本身引起、换一个 Key 可能成功的错误"""
+        return isinstance(error, APIStatusError) and (
+            error.status_code in cls.AUTH_ERRORS or error.status_code == 429
+        )
+
+
+def create_key_pool() -> Optional[ApiKeyPool]:
+    """从 SILICONFLOW_API_KEYS（逗号分隔）和 SILICONFLOW_API_KEYS_FILE（每行一个）读取 Key 池"""
+    keys = [key.strip() for key in os.getenv("SILICONFLOW_API_KEYS", "").split(",")]
+    keys_file = os.getenv("SILICONFLOW_API_KEYS_FILE")
+    if keys_file:
+        with open(keys_file, "r", encoding="utf-8") as f:
+            keys.extend(line.strip() for line in f if not line.lstrip().startswith("#"))
+    keys = [key for key in keys if key]
+    if not keys:
+        return None
+    invalid = [key for key in keys if not key.startswith("sk-")]
+    if invalid:
+        logging.warning(f"⚠️ 忽略 {len(invalid)} 个格式不正确的服务器端 API Key")
+        keys = [key for key in keys if key.startswith("sk-")]
+        if not keys:
+            return None
+    pool = ApiKeyPool(
+        keys, 
+        quarantine_seconds=float(os.getenv("KEY_POOL_QUARANTINE", 300)), 
+        throttle_seconds=float(os.getenv("KEY_POOL_THROTTLE_QUARANTINE", 5)), 
+        low_watermark=float(os.getenv("KEY_POOL_LOW_WATERMARK", 0.1)),
+    )
+    logging.info(f"✅ 已加载 {len(pool)} 个服务器端 API Key")
+    return pool
+
+
+key_pool = create_key_pool()
+
+
+# ==================== 参考音频缓存 ====================
+
+DEFAULT_VOICE = "nahida"
+
+DEFAULT_REFERENCE_TEXT = "初次见面，我已经关注你很久了。我叫纳西妲，别看我像个孩子，我比任何一位大人都了解这个世界。所以，我可以用我的知识，换取你路上的见闻吗？"
+
+
+@dataclass(frozen=True)
+class ReferenceVoice:
+    """已编码的参考音色"""
+    name: str
+    path: str
+    text: str
+    data_uri: str
+    fingerprint: str
+    mtime: float
+    size: int
+
+
+class ReferenceAudioCache:
+    """参考音频缓存
+
+    应用启动时把所有参考音色编码为数据 URI 并常驻内存，多线程共享。
+    以路径 + mtime/size 判断文件是否变化，且每个音色至多每隔
+    check_interval 秒检查一次，热路径上基本不访问文件系统。
+    """
+
+    def __init__(self, check_interval: float = 30.0):
+        self.check_interval = check_interval
+        self._sources: Dict[str, Tuple[str, str]] = {}
+        self._voices: Dict[str, ReferenceVoice] = {}
+        self._checked_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, path: str, text: str) -> None:
+        """登记一个参考音色（音频路径 + 音频中的文本）"""
+        with self._lock:
+            self._sources[name] = (path, text)
+            self._voices.pop(name, None)
+            self._checked_at.pop(name, None)
+
+    def load_all(self) -> None:
+        """预加载所有已登记的音色"""
+        for name in list(self._sources):
+            if self.get(name):
+                logging.info(f"✅ 参考音频加载成功: {name}")
+
+    def names(self) -> List[str]:
+        return list(self._sources)
+
+    def get(self, name: str = DEFAULT_VOICE) -> Optional[ReferenceVoice]:
+        """获取参考音色，文件变化时自动重新编码"""
+        source = self._sources.get(name)
+        if source is None:
+            return None
+
+        voice = self._voices.get(name)
+        now = time.monotonic()
+        if voice is not None and now - self._checked_at.get(name, 0.0) < self.check_interval:
+            return voice
+
+        path, text = source
+        try:
+            stat = os.stat(path)
+        except OSError:
+            logging.error(f"❌ 参考音频文件不存在: {path}")
+            self._checked_at[name] = now
+            return voice
+
+        if voice is not None and (voice.mtime, voice.size) == (stat.st_mtime, stat.st_size):
+            self._checked_at[name] = now
+            return voice
+
+        data_uri = encode_audio_to_base64(path)
+        if not data_uri:
+            return voice
+
+        voice = ReferenceVoice(
+            name=name,
+            path=path,
+            text=text,
+            data_uri=data_uri,
+            fingerprint=hashlib.sha256(data_uri.encode("utf-8")).hexdigest()[:16],
+            mtime=stat.st_mtime,
+            size=stat.st_size,
+        )
+        with self._lock:
+            if self._sources.get(name) == source:
+                self._voices[name] = voice
+                self._checked_at[name] = now
+        return voice
+
+
+def _load_voice_sources(cache: ReferenceAudioCache) -> None:
+    """从环境变量登记参考音色"""
+    cache.register(
+        DEFAULT_VOICE,
+        os.getenv("REFERENCE_AUDIO_PATH", "Ref_audio.mp3"),
+        os.getenv("TEXT_IN_REFERENCE_AUDIO", DEFAULT_REFERENCE_TEXT),
+    )
+
+    # REFERENCE_VOICES='{"名称": {"path": "xxx.mp3", "text": "音频中的文本"}}'
+    extra = os.getenv("REFERENCE_VOICES")
+    if not extra:
+        return
+    try:
+        for name, item in json.loads(extra).items():
+            cache.register(name, item["path"], item.get("text", ""))
+    except (ValueError, KeyError, AttributeError) as e:
+        logging.error(f"❌ REFERENCE_VOICES 配置格式错误: {e}")
+
+
+reference_audio_cache = ReferenceAudioCache(
+    check_interval=float(os.getenv("REFERENCE_AUDIO_CHECK_INTERVAL", 30)),
+)
+_load_voice_sources(reference_audio_cache)
+
+
+# ==================== 音色注册 ====================
+
+class VoiceRegistry:
+    """上游音色注册表
+
+    参考音频按 (API Key, 接口地址, 模型, 音色) 只上传一次，换取上游返回的
+    音色 uri，之后的语音合成只需传递 uri，不再每次上传几百 KB 的音频。
+    注册结果持久化到本地文件，进程重启后仍然有效。
+    """
+    
+    UPLOAD_PATH = "/uploads/audio/voice"
+    
+    def __init__(self, path: Optional[str], enabled: bool = True, retry_after: float = 600.0):
+        self.path = Path(path) if path else None
+        self.enabled = enabled
+        self.retry_after = retry_after
+        self._uris: Dict[str, str] = {}
+        self._failed_at: Dict[str, float] = {}
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._load()
+    
+    @staticmethod
+    def make_key(api_key: str, base_url: str, model: str, voice: ReferenceVoice) -> str:
+        # 只保存 API Key 的哈希，注册表文件中不出现明文
+        payload = "\x00".join([
+            hashlib.sha256(api_key.encode("utf-8")).hexdigest(),
+            base_url, model, voice.name, voice.fingerprint, voice.text,
+        ])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def _load(self) -> None:
+        if not self.path or not self.path.exists():
+            return
+        try:
+            self._uris = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            logging.warning(f"⚠️ 读取音色注册表失败: {e}")
+    
+    def _save_locked(self) -> None:
+        if not self.path:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            tmp_path.write_text(json.dumps(self._uris), encoding="utf-8")
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"⚠️ 保存音色注册表失败: {e}")
+    
+    def lookup(self, key: str) -> Optional[str]:
+        return self._uris.get(key) if self.enabled else None
+    
+    def register(self, client: OpenAI, key: str, model: str, voice: ReferenceVoice) -> Optional[str]:
+        """上传参考音频并返回音色 uri；失败后一段时间内不再重试"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        
+        # 同一音色并发注册时只上传一次
+        with key_lock:
+            uri = self._uris.get(key)
+            if uri:
+                return uri
+            failed_at = self._failed_at.get(key)
+            if failed_at is not None and time.monotonic() - failed_at < self.retry_after:
+                return None
+            
+            try:
+                result = client.post(
+                    self.UPLOAD_PATH,
+                    cast_to=object,
+                    body={
+                        "model": model,
+                        "customName": re.sub(r"[^A-Za-z0-9_-]", "_", f"{voice.name}_{voice.fingerprint[:8]}"),
+                        "audio": voice.data_uri,
+                        "text": voice.text,
+                    },
+                )
+                uri = result.get("uri") if isinstance(result, dict) else None
+            except Exception as e:
+                logging.warning(f"⚠️ 注册参考音色失败，将继续随请求上传参考音频: {e}")
+                uri = None
+            
+            if not uri:
+                self._failed_at[key] = time.monotonic()
+                return None
+            
+            with self._lock:
+                self._uris[key] = uri
+                self._failed_at.pop(key, None)
+                self._save_locked()
+            logging.info(f"✅ 参考音色已注册: {voice.name}")
+            return uri
+    
+    def invalidate(self, key: str) -> None:
+        """上游不再认可该 uri 时删除，下次调用会重新注册"""
+        with self._lock:
+            if self._uris.pop(key, None) is not None:
+                self._save_locked()
+
+
+voice_registry = VoiceRegistry(
+    path=os.getenv("VOICE_REGISTRY_PATH", os.path.join(".cache", "voices.json")),
+    enabled=os.getenv("VOICE_REGISTRATION", "true").lower() == "true",
+)
+
+
+# 上游提示音色 uri 不存在或无效时的错误信息关键字
+STALE_VOICE_MARKERS = ("not found", "not exist", "invalid", "不存在", "无效")
+
+
+def _is_stale_voice_error(error: Exception) -> bool:
+    """上游明确提示音色 uri 不存在或无效
+
+    其他 4xx（输入有误、Key 无效或被限流）与 uri 无关，不能因此重新上传参考音频。
+    """
+    if not isinstance(error, APIStatusError) or error.status_code not in (400, 404):
+        return False
+    message = str(error.message).lower()
+    return ("voice" in message or "音色" in message) and any(marker in message for marker in STALE_VOICE_MARKERS)
+
+
+# ==================== 用户配置类 ====================
+
+def _split_models(value: str) -> List[str]:
+    return [model.strip() for model in value.split(",") if model.strip()]
+
+
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", 120))
+# 客户端通过请求头申请的期限上限，默认不能超过服务端期限
+MAX_REQUEST_DEADLINE = float(os.getenv("MAX_REQUEST_DEADLINE", REQUEST_DEADLINE))
+
+
+def _request_deadline(value: Optional[str]) -> float:
+    """解析 X-Request-Deadline：无法解析时使用默认期限，超过上限时截断到上限"""
+    if value is None:
+        return REQUEST_DEADLINE
+    try:
+        deadline = float(value)
+    except ValueError:
+        logging.warning(f"⚠️ 忽略无效的请求期限: {value!r}")
+        return REQUEST_DEADLINE
+    if math.isnan(deadline):
+        return REQUEST_DEADLINE
+    return min(deadline, MAX_REQUEST_DEADLINE)
+
+
+@dataclass
+class UserConfig:
+    """用户配置，从请求头中读取"""
+    api_key: str
+    chat_model: str = "deepseek-ai/DeepSeek-V3.1"
+    prompt_engineer_model: str = "zai-org/GLM-4.5"
+    summary_model: str = "deepseek-ai/DeepSeek-V3.1"
+    image_model: str = "Qwen/Qwen-Image"
+    tts_model: str = "IndexTeam/IndexTTS-2"
+    max_tokens: int = 2048
+    temperature: float = 0.7
+    image_size: str = "928x1664"
+    base_url: str = SILICONFLOW_BASE_URL
+    voice: str = DEFAULT_VOICE
+    stream: bool = True
+    tts_chunked: bool = True
+    tts_chunk_concurrency: int = 2
+    speculative_image: str = "off"
+    # 阶段（chat / prompt / image）-> 主模型之后依次尝试的回退模型
+    fallback_models: Dict[str, List[str]] = field(default_factory=dict)
+    # 阶段 -> 对冲延迟（秒），0 表示不对冲
+    hedge_delays: Dict[str, float] = field(default_factory=dict)
+    # 整个请求的时间预算（秒）
+    deadline: float = 120.0
+    
+    @classmethod
+    def from_headers(cls, headers) -> "UserConfig":
+        """从请求头中读取配置"""
+        api_key = headers.get("X-API-Key", "")
+        
+        # 如果没有提供 API Key，使用服务器端配置：配置了 Key 池时留空，每次调用从池中选择
+        if not api_key and key_pool is None:
+            api_key = os.getenv("SILICONFLOW_API_KEY", "")
+        
+        return cls(
+            api_key=api_key,
+            chat_model=headers.get("X-Chat-Model", "deepseek-ai/DeepSeek-V3.1"),
+            summary_model=os.getenv("SUMMARY_MODEL", "deepseek-ai/DeepSeek-V3.1"),
+            image_model=headers.get("X-Image-Model", "Qwen/Qwen-Image"),
+            tts_model=headers.get("X-TTS-Model", "IndexTeam/IndexTTS-2"),
+            temperature=float(headers.get("X-Temperature", 0.7)),
+            max_tokens=int(headers.get("X-Max-Tokens", 2048)),
+            voice=headers.get("X-Voice", DEFAULT_VOICE),
+            stream=headers.get("X-Stream", os.getenv("STREAM_CHAT", "true")).lower() == "true",
+            tts_chunked=headers.get("X-TTS-Chunked", os.getenv("TTS_CHUNKED", "true")).lower() == "true",
+            tts_chunk_concurrency=int(os.getenv("TTS_CHUNK_CONCURRENCY", 2)),
+            speculative_image=headers.get(
+                "X-Speculative-Image", os.getenv("SPECULATIVE_IMAGE", "off")
+            ).lower(),
+            fallback_models={
+                "chat": _split_models(headers.get(
+                    "X-Chat-Fallback-Models", os.getenv("CHAT_FALLBACK_MODELS", "moonshotai/Kimi-K2-Instruct-0905")
+                )),
+                "prompt": _split_models(os.getenv("PROMPT_FALLBACK_MODELS", "deepseek-ai/DeepSeek-V3.1")),
+                "image": _split_models(os.getenv("IMAGE_FALLBACK_MODELS", "")),
+            },
+            hedge_delays={
+                stage: float(os.getenv(f"{stage.upper()}_HEDGE_DELAY", 0))
+                for stage in ("chat", "prompt", "image")
+            },
+            deadline=_request_deadline(headers.get("X-Request-Deadline")),
+        )
+    
+    def models_for(self, stage: str) -> List[str]:
+        """返回某个阶段的模型回退链，主模型在前"""
+        primary = {
+            "chat": self.chat_model,
+            "prompt": self.prompt_engineer_model,
+            "image": self.image_model,
+        }[stage]
+        chain = [primary]
+        for model in self.fallback_models.get(stage, []):
+            if model not in chain:
+                chain.append(model)
+        return chain
+    
+    def validate(self) -> Optional[str]:
+        """验证配置是否有效"""
+        if not self.api_key and key_pool is None:
+            return "请先配置 SiliconFlow API Key"
+        if self.api_key and not self.api_key.startswith("sk-"):
+            return "API Key 格式不正确，应以 sk- 开头"
+        if self.speculative_image not in ("off", "draft", "refine"):
+            return "预生成图像模式只能是 off、draft 或 refine"
+        if self.deadline <= 0:
+            return "请求期限必须大于 0 秒"
+        return None
+
+
+# ==================== 请求期限 ====================
+
+class DeadlineExceeded(Exception):
+    """请求的总时间预算已用完"""
+    
+    def __init__(self, stage: str):
+        super().__init__(f"请求超时：{stage} 阶段没有剩余时间")
+        self.stage = stage
+
+
+class Deadline:
+    """单次请求的总时间预算，各阶段以剩余时间作为超时"""
+    
+    # 阶段 -> 单次上游调用的超时上限（秒）
+    STAGE_TIMEOUTS = {
+        stage: float(os.getenv(f"STAGE_TIMEOUT_{stage.upper()}", default))
+        for stage, default in (("chat", 60), ("summary", 30), ("prompt", 30), ("image", 90), ("tts", 30))
+    }
+    # 可选阶段 -> 开始前至少需要的剩余时间（秒），不足时跳过
+    MIN_BUDGETS = {
+        stage: float(os.getenv(f"MIN_BUDGET_{stage.upper()}", default))
+        for stage, default in (("prompt", 5), ("image", 20))
+    }
+    
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+    
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+    
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+    
+    def timeout(self, stage: str) -> float:
+        """本阶段上游调用的超时：阶段上限与剩余时间取较小值"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(stage)
+        return min(self.STAGE_TIMEOUTS.get(stage, remaining), remaining)
+    
+    def allows(self, stage: str) -> bool:
+        """剩余时间是否足够开始一个可选阶段"""
+        return self.remaining() >= self.MIN_BUDGETS.get(stage, 0.0)
+
+
+# ==================== 模型容灾 ====================
+
+class EmptyReplyError(ValueError):
+    """模型返回了空内容"""
+
+
+def _is_model_failure(error: Exception) -> bool:
+    """连接失败、超时、5xx 和空回复说明模型本身不可用，计入熔断器
+
+    4xx 由请求本身引起（如某个用户的 Key 无效），不能让它熔断所有人共用的模型；
+    本地限流队列超时以带标记的 429 表示，同样不计入。
+    请求期限耗尽不一定是模型的问题，由 CircuitBreaker.record_overrun 按延迟单独计入；
+    客户端断开导致的取消与模型无关。
+    """
+    if isinstance(error, APIStatusError):
+        return error.status_code >= 500
+    return not isinstance(error, (DeadlineExceeded, UpstreamCancelled))
+
+
+def upstream_status(error: Exception) -> str:
+    """上游错误的分类，用作监控指标的标签"""
+    if is_local_throttle(error):
+        return "local_throttle"
+    if isinstance(error, APIStatusError):
+        return str(error.status_code)
+    if isinstance(error, APITimeoutError):
+        return "timeout"
+    if isinstance(error, APIConnectionError):
+        return "connection"
+    if isinstance(error, DeadlineExceeded):
+        return "deadline"
+    if isinstance(error, UpstreamCancelled):
+        return "cancelled"
+    if isinstance(error, EmptyReplyError):
+        return "empty"
+    return "other"
+
+
+def _should_fall_back(error: Exception) -> bool:
+    """模型故障或被限流时换下一个模型；其他 4xx 换模型也无济于事"""
+    if isinstance(error, APIStatusError) and error.status_code == 429:
+        return True
+    return _is_model_failure(error)
+
+
+class CircuitBreaker:
+    """单个模型的熔断器
+
+    最近 window 次调用中错误率超过 error_rate，或成功调用的 p95 延迟超过
+    latency_threshold 时熔断；cooldown 秒后放行一次试探请求（半开），
+    试探成功则恢复，失败则继续熔断。
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(
+        self, 
+        name: str, 
+        latency_threshold: float, 
+        window: int = 20, 
+        min_calls: int = 5, 
+        error_rate: float = 0.5, 
+        cooldown: float = 30.0
+    ):
+        self.name = name
+        self.latency_threshold = latency_threshold
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        # (是否成功, 延迟)
+        self._outcomes: deque = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+    
+    def allow(self) -> bool:
+        """是否可以向该模型发起调用；半开状态下只放行一次试探"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+    
+    def release(self) -> None:
+        """调用结束但结果没有计入（如 4xx、被取消）时调用；半开状态下归还试探名额，
+        否则试探一直处于进行中，该模型再也不会被放行"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+    
+    def record_overrun(self, latency: float) -> None:
+        """调用被请求期限截断，只知道它至少用了 latency 秒
+
+        超过延迟阈值时作为一次慢调用计入，持续拖满期限的模型因此会按 p95 熔断；
+        未超过阈值说明期限主要耗在其他阶段，结果未知，不计入。
+        """
+        if latency > self.latency_threshold:
+            self.record(True, latency)
+    
+    def p95(self) -> Optional[float]:
+        latencies = sorted(latency for ok, latency in self._outcomes if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    
+    def record(self, ok: bool, latency: float) -> None:
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if ok and latency <= self.latency_threshold:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                    logging.info(f"✅ 模型 {self.name} 恢复")
+                else:
+                    self._trip("试探失败")
+                return
+            
+            self._outcomes.append((ok, latency))
+            if self.state != self.CLOSED or len(self._outcomes) < self.min_calls:
+                return
+            failures = sum(1 for ok, _ in self._outcomes if not ok)
+            p95 = self.p95()
+            if failures / len(self._outcomes) >= self.error_rate:
+                self._trip(f"错误率 {failures}/{len(self._outcomes)}")
+            elif p95 is not None and p95 > self.latency_threshold:
+                self._trip(f"p95 延迟 {p95:.1f}s")
+    
+    def _trip(self, reason: str) -> None:
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        logging.warning(f"⚠️ 模型 {self.name} 熔断（{reason}），{self.cooldown:.0f} 秒后试探恢复")
+
+
+class ModelRouter:
+    """按阶段调用模型回退链
+
+    依次尝试回退链中未熔断的模型，前一个失败时换下一个。设置了对冲延迟时，
+    主模型在该时间内没有结果就同时请求下一个模型，取先返回的结果。
+    流式对话以首段文本到达作为“返回”，落败的流随即关闭。
+    """
+    
+    # 阶段 -> 默认延迟阈值（秒）；对话按首段文本延迟计算
+    LATENCY_THRESHOLDS = {"chat": 10.0, "prompt": 20.0, "image": 60.0}
+    
+    def __init__(self, hedge_workers: int = 16):
+        self._breakers: Dict[Tuple[str, str, str], CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self._hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="hedge")
+    
+    def breaker(self, stage: str, base_url: str, model: str) -> CircuitBreaker:
+        key = (stage, base_url, model)
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = CircuitBreaker(
+                    f"{model}（{stage}）",
+                    latency_threshold=float(os.getenv(
+                        f"CIRCUIT_LATENCY_{stage.upper()}", self.LATENCY_THRESHOLDS.get(stage, 30.0)
+                    )),
+                    window=int(os.getenv("CIRCUIT_WINDOW", 20)),
+                    min_calls=int(os.getenv("CIRCUIT_MIN_CALLS", 5)),
+                    error_rate=float(os.getenv("CIRCUIT_ERROR_RATE", 0.5)),
+                    cooldown=float(os.getenv("CIRCUIT_COOLDOWN", 30)),
+                )
+            return breaker
+    
+    def _chain(self, stage: str, base_url: str, models: List[str]) -> Generator[str, None, None]:
+        """按顺序产出可用的模型；全部熔断时仍尝试主模型"""
+        tried = False
+        for model in models:
+            if self.breaker(stage, base_url, model).allow():
+                tried = True
+                yield model
+        if not tried and models:
+            yield models[0]
+    
+    def _record(self, stage: str, base_url: str, model: str, started: float, error: Optional[Exception]) -> None:
+        latency = time.monotonic() - started
+        if error is None:
+            UPSTREAM_LATENCY.labels(stage, model).observe(latency)
+            self.breaker(stage, base_url, model).record(True, latency)
+            return
+        UPSTREAM_ERRORS.labels(stage, upstream_status(error)).inc()
+        if _is_model_failure(error):
+            self.breaker(stage, base_url, model).record(False, latency)
+        elif isinstance(error, DeadlineExceeded):
+            self.breaker(stage, base_url, model).record_overrun(latency)
+    
+    def _timed(self, stage: str, base_url: str, model: str, request: Callable[[str], Any]) -> Any:
+        started = time.monotonic()
+        try:
+            result = request(model)
+        except Exception as e:
+            self._record(stage, base_url, model, started, e)
+            raise
+        else:
+            self._record(stage, base_url, model, started, None)
+            return result
+        finally:
+            # 已计入结果时 record 已结束试探，这里不会再改变状态
+            self.breaker(stage, base_url, model).release()
+    
+    def call(
+        self, 
+        stage: str, 
+        base_url: str, 
+        models: List[str], 
+        request: Callable[[str], Any], 
+        hedge_delay: float = 0.0, 
+        discard: Optional[Callable[[Any], None]] = None
+    ) -> Any:
+        """用回退链调用 request(model)；discard 用于释放对冲中落败的结果"""
+        chain = self._chain(stage, base_url, models)
+        if hedge_delay <= 0:
+            error: Optional[Exception] = None
+            for model in chain:
+                try:
+                    return self._timed(stage, base_url, model, request)
+                except Exception as e:
+                    error = e
+                    if not _should_fall_back(e):
+                        raise
+                    logging.warning(f"⚠️ 模型 {model} 调用失败，尝试回退: {e}")
+            raise error or RuntimeError(f"{stage} 阶段没有可用的模型")
+        
+        # 对冲：等待 hedge_delay 后并行请求下一个模型，取先成功的结果
+        pending: Dict[Future, str] = {}
+        error = None
+        
+        def launch() -> bool:
+            model = next(chain, None)
+            if model is None:
+                return False
+            pending[self._hedge_executor.submit(self._timed, stage, base_url, model, request)] = model
+            return True
+        
+        def release_losers() -> None:
+            for future, model in pending.items():
+                if discard:
+                    future.add_done_callback(
+                        lambda f: discard(f.result()) if not f.cancelled() and f.exception() is None else None
+                    )
+                if future.cancel():
+                    # 还没开始执行，_timed 不会运行，由这里归还放行时占用的试探名额
+                    self.breaker(stage, base_url, model).release()
+        
+        launch()
+        while pending:
+            timeout = hedge_delay if len(pending) < 2 else None
+            done, _ = futures_wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                if launch():
+                    logging.info(f"⏱️ {stage} 阶段 {hedge_delay:.1f}s 内未返回，对冲请求下一个模型")
+                continue
+            winner = None
+            for future in done:
+                model = pending.pop(future)
+                if winner is None and future.exception() is None:
+                    winner = future
+                elif future.exception() is None:
+                    if discard:
+                        discard(future.result())
+                else:
+                    error = future.exception()
+                    if not _should_fall_back(error):
+                        release_losers()
+                        raise error
+                    logging.warning(f"⚠️ 模型 {model} 调用失败，尝试回退: {error}")
+            if winner is not None:
+                release_losers()
+                return winner.result()
+            if not pending:
+                launch()
+        raise error or RuntimeError(f"{stage} 阶段没有可用的模型")
+    
+    async def _timed_async(
+        self, 
+        stage: str, 
+        base_url: str, 
+        model: str, 
+        request: Callable[[str], Awaitable[Any]]
+    ) -> Any:
+        started = time.monotonic()
+        try:
+            result = await request(model)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._record(stage, base_url, model, started, e)
+            raise
+        else:
+            self._record(stage, base_url, model, started, None)
+            return result
+        finally:
+            self.breaker(stage, base_url, model).release()
+    
+    async def call_async(
+        self, 
+        stage: str, 
+        base_url: str, 
+        models: List[str], 
+        request: Callable[[str], Awaitable[Any]], 
+        hedge_delay: float = 0.0, 
+        discard: Optional[Callable[[Any], None]] = None
+    ) -> Any:
+        """call 的协程版本；对冲落败的请求会被真正取消"""
+        chain = self._chain(stage, base_url, models)
+        pending: Dict[asyncio.Task, str] = {}
+        error: Optional[Exception] = None
+        
+        def launch() -> bool:
+            model = next(chain, None)
+            if model is None:
+                return False
+            task = asyncio.ensure_future(self._timed_async(stage, base_url, model, request))
+            # 开始执行前就被取消的任务不会进入 _timed_async 的 finally
+            task.add_done_callback(
+                lambda t, breaker=self.breaker(stage, base_url, model): breaker.release() if t.cancelled() else None
+            )
+            pending[task] = model
+            return True
+        
+        launch()
+        try:
+            while pending:
+                timeout = hedge_delay if hedge_delay > 0 and len(pending) < 2 else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if launch():
+                        logging.info(f"⏱️ {stage} 阶段 {hedge_delay:.1f}s 内未返回，对冲请求下一个模型")
+                    continue
+                winner = None
+                for task in done:
+                    model = pending.pop(task)
+                    if winner is None and task.exception() is None:
+                        winner = task
+                    elif task.exception() is None:
+                        if discard:
+                            discard(task.result())
+                    else:
+                        error = task.exception()
+                        if not _should_fall_back(error):
+                            raise error
+                        logging.warning(f"⚠️ 模型 {model} 调用失败，尝试回退: {error}")
+                if winner is not None:
+                    return winner.result()
+                if not pending:
+                    launch()
+        finally:
+            for task in pending:
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    if discard:
+                        discard(task.result())
+                else:
+                    task.cancel()
+        raise error or RuntimeError(f"{stage} 阶段没有可用的模型")
+
+
+model_router = ModelRouter(hedge_workers=int(os.getenv("HEDGE_WORKERS", 16)))
+
+
+# ==================== 请求合并 ====================
+
+def flight_key(*parts: str) -> str:
+    """由请求参数生成合并键"""
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    """一次被合并的同步调用：结果、共享调用所属的范围和仍在等待的调用方数量"""
+    
+    def __init__(self):
+        self.future = Future()
+        self.scope = UpstreamScope()
+        self.waiters = 0
+        self._lock = threading.Lock()
+    
+    def leave(self) -> int:
+        """一个调用方已取消，最后一个离开时取消共享调用；返回被中断的响应数"""
+        with self._lock:
+            self.waiters -= 1
+            last = self.waiters == 0
+        return self.scope.cancel() if last else 0
+
+
+class SingleFlight:
+    """合并相同的进行中请求
+
+    多个标签页或用户同时发起完全相同的上游请求（同一句语音、同一段提示词）时，
+    只有第一个调用真正访问上游，其余调用等待同一个结果。
+    calls / coalesced 统计调用总数和被合并的次数。
+    """
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+        self._inflight: Dict[str, _Flight] = {}
+        # 异步调用：合并键 -> [共享任务, 等待者数量]
+        self._tasks: Dict[str, List[Any]] = {}
+        self._lock = threading.Lock()
+    
+    def _count(self, coalesced: bool) -> None:
+        with self._lock:
+            self.calls += 1
+            if coalesced:
+                self.coalesced += 1
+        if coalesced:
+            logging.info(f"🔗 合并相同的 {self.name} 请求（累计 {self.coalesced}/{self.calls}）")
+    
+    def do(self, key: str, fn: Callable[[], Any], scope: Optional[UpstreamScope] = None) -> Any:
+        """执行 fn；相同 key 的调用正在进行时等待其结果
+
+        共享的上游调用在独立的 UpstreamScope 中进行，scope 是调用方所属的范围：
+        所有调用方都已取消时才取消共享调用，不会因为发起者断开而让其他等待者失败。
+        """
+        with self._lock:
+            flight = self._inflight.get(key)
+            # 已被取消的共享调用即将失败，新的调用方不加入，重新发起
+            leader = flight is None or flight.scope.cancelled
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            flight.waiters += 1
+        self._count(not leader)
+        if scope is not None:
+            scope.on_cancel(flight.leave)
+        if not leader:
+            return flight.future.result()
+        
+        try:
+            with bind_upstream(flight.scope):
+                result = fn()
+        except BaseException as e:
+            flight.future.set_exception(e)
+            raise
+        else:
+            flight.future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is flight:
+                    del self._inflight[key]
+    
+    async def do_async(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """do 的协程版本；所有等待者都取消时才取消共享的上游调用"""
+        entry = self._tasks.get(key)
+        self._count(entry is not None)
+        if entry is None:
+            task = asyncio.ensure_future(fn())
+            entry = self._tasks[key] = [task, 0]
+            task.add_done_callback(lambda _: self._forget(key, entry))
+        task = entry[0]
+        
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done():
+                entry[1] -= 1
+                if entry[1] == 0:
+                    # 与取消在同一步中移除，之后的调用方不会加入即将取消的任务
+                    self._forget(key, entry)
+                    task.cancel()
+            raise
+    
+    def _forget(self, key: str, entry: List[Any]) -> None:
+        """移除合并键；该键已被新的共享任务占用时保留"""
+        if self._tasks.get(key) is entry:
+            del self._tasks[key]
+
+
+flights = {name: SingleFlight(name) for name in ("speech", "image_prompt", "image")}
+
+
+# ==================== AI 服务类 ====================
+
+class AIService:
+    """AI 服务管理类"""
+    
+    def __init__(self, config: UserConfig):
+        self.config = config
+        # 使用服务器端 Key 池时没有固定的客户端，每次调用通过 _credentials 选择
+        self.client = client_pool.get(config.api_key, config.base_url) if config.api_key else None
+        self.reference_voice = reference_audio_cache.get(config.voice)
+        # 被折叠的早期对话的摘要，由 ContextWindow 设置
+        self.history_summary: Optional[str] = None
+        # 请求期限，由对话流水线设置；未设置时只使用各阶段的超时上限
+        self.deadline: Optional[Deadline] = None
+        # 本次对话的上游请求，由对话流水线设置，客户端断开时统一取消
+        self.upstream: Optional[UpstreamScope] = None
+    
+    def _build_chat_messages(
+        self, 
+        user_message: str, 
+        history: List[Dict[str, str]]
+    ) -> List[Dict[str, str]]:
+        """组装对话消息列表"""
+        system_prompt = NAHIDA_SYSTEM_PROMPT
+        if self.history_summary:
+            system_prompt += f"\n\n此前对话的摘要：\n{self.history_summary}"
+        return [
+            {"role": "system", "content": system_prompt}
+        ] + [
+            msg for msg in normalize_history(history)
+        ] + [
+            {"role": "user", "content": user_message}
+        ]
+    
+    def generate_chat_response(
+        self, 
+        user_message: str, 
+        history: List[Dict[str, str]]
+    ) -> str:
+        """生成对话回复"""
+        messages = self._build_chat_messages(user_message, history)
+        
+        logging.info(f"🤖 调用对话模型: {self.config.chat_model}")
+        
+        return self._route("chat", lambda model: self._request_chat(model, messages))
+    
+    @property
+    def _pooled(self) -> bool:
+        return not self.config.api_key and key_pool is not None
+    
+    def _credentials(self, model: str) -> Tuple[str, Any]:
+        """本次调用使用的 (API Key, 客户端)：用户自己的 Key，或从服务器端 Key 池中按负载选择"""
+        if not self._pooled:
+            return self.config.api_key, self.client
+        pooled = key_pool.select(model)
+        return pooled.api_key, pooled.client
+    
+    def _client(self, model: str):
+        return self._credentials(model)[1]
+    
+    def _retry_with_another_key(self, error: Exception, attempt: int, model: str) -> bool:
+        """池中的 Key 失效或该模型被限流时（已被暂停使用），换一个 Key 重试同一模型"""
+        if not self._pooled or not ApiKeyPool.is_key_error(error):
+            return False
+        if attempt + 1 >= len(key_pool) or not key_pool.available(model):
+            return False
+        logging.warning(f"⚠️ API Key 不可用，换用其他 Key 重试: {error}")
+        return True
+    
+    def _with_key_retry(self, model: str, request: Callable[[str], Any]) -> Any:
+        """调用 request(model)，池中的 Key 失效或被限流时换一个 Key 重试"""
+        attempt = 0
+        while True:
+            try:
+                return request(model)
+            except Exception as e:
+                if not self._retry_with_another_key(e, attempt, model):
+                    raise
+                attempt += 1
+    
+    def _timeout(self, stage: str) -> float:
+        """本次上游调用的超时"""
+        if self.deadline is None:
+            return Deadline.STAGE_TIMEOUTS[stage]
+        return self.deadline.timeout(stage)
+    
+    def _deadline_error(self, stage: str, error: Exception) -> Exception:
+        """期限耗尽导致的超时不是模型的问题，转换为 DeadlineExceeded，不计入熔断、不再回退"""
+        if isinstance(error, APITimeoutError) and self.deadline is not None and self.deadline.expired:
+            return DeadlineExceeded(stage)
+        return error
+    
+    def _route(self, stage: str, request: Callable[[str], Any], discard: Optional[Callable[[Any], None]] = None) -> Any:
+        """按该阶段的模型回退链调用"""
+        # 合并的调用在共享范围中进行；对冲请求在其他线程中执行，需要重新绑定
+        scope = upstream_scope.get() or self.upstream
+        
+        def call(model: str) -> Any:
+            try:
+                with bind_upstream(scope):
+                    return self._with_key_retry(model, request)
+            except Exception as e:
+                if scope is not None and scope.cancelled:
+                    raise UpstreamCancelled() from e
+                error = self._deadline_error(stage, e)
+                if error is e:
+                    raise
+                raise error from e
+        
+        return model_router.call(
+            stage, 
+            self.config.base_url, 
+            self.config.models_for(stage), 
+            call, 
+            hedge_delay=self.config.hedge_delays.get(stage, 0.0), 
+            discard=discard
+        )
+    
+    def _request_chat(self, model: str, messages: List[Dict[str, str]]) -> str:
+        response = self._client(model).chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=self.config.max_tokens,
+            temperature=self.config.temperature,
+            timeout=self._timeout("chat"),
+        )
+        
+        content = response.choices[0].message.content.strip()
+        if not content:
+            raise EmptyReplyError("对话模型返回了空回复")
+        
+        return content
+    
+    def stream_chat_response(
+        self, 
+        user_message: str, 
+        history: List[Dict[str, str]]
+    ) -> Generator[str, None, None]:
+        """流式生成对话回复，逐段产出增量文本"""
+        messages = self._build_chat_messages(user_message, history)
+        
+        logging.info(f"🤖 调用对话模型（流式）: {self.config.chat_model}")
+        
+        # 首段文本到达前失败可以换模型；之后已经推送给用户，只能报错
+        stream, deltas, first = self._route(
+            "chat", 
+            lambda model: self._open_chat_stream(model, messages), 
+            discard=lambda opened: opened[0].close()
+        )
+        try:
+            yield first
+            yield from deltas
+        finally:
+            stream.close()
+    
+    def _open_chat_stream(self, model: str, messages: List[Dict[str, str]]):
+        """打开流式回复并等到首段文本，返回 (流, 后续增量, 首段文本)"""
+        stream = self._client(model).chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=self.config.max_tokens,
+            temperature=self.config.temperature,
+            stream=True,
+            timeout=self._timeout("chat"),
+        )
+        try:
+            deltas = self._stream_deltas(stream)
+            first = next(deltas, None)
+        except BaseException:
+            stream.close()
+            raise
+        if first is None:
+            stream.close()
+            raise EmptyReplyError("对话模型返回了空回复")
+        return stream, deltas, first
+    
+    @staticmethod
+    def _stream_deltas(stream) -> Generator[str, None, None]:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    
+    def _image_prompt_key(self, prompt_input: str) -> str:
+        return flight_key(
+            self.config.api_key, self.config.base_url, self.config.prompt_engineer_model, prompt_input
+        )
+    
+    def _engineer_image_prompt(self, prompt_input: str) -> Optional[str]:
+        """生成图像提示词，合并相同的进行中请求"""
+        return flights["image_prompt"].do(
+            self._image_prompt_key(prompt_input), lambda: self._request_image_prompt(prompt_input), self.upstream
+        )
+    
+    def _request_image_prompt(self, prompt_input: str) -> Optional[str]:
+        """调用提示词工程模型生成图像提示词"""
+        messages = [
+            {"role": "system", "content": PROMPT_ENGINEER_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt_input}
+        ]
+        
+        def request(model: str) -> str:
+            # 流式读取：响应头很快返回，客户端断开时可以中断连接，上游随即停止生成
+            stream = self._client(model).chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=200,
+                temperature=0.5,
+                stream=True,
+                timeout=self._timeout("prompt"),
+            )
+            parts = []
+            try:
+                for delta in self._stream_deltas(stream):
+                    parts.append(delta)
+                    if self.deadline is not None and self.deadline.expired:
+                        raise DeadlineExceeded("prompt")
+            finally:
+                stream.close()
+            prompt = "".join(parts).strip()
+            if not prompt:
+                raise EmptyReplyError("提示词模型返回了空内容")
+            return prompt
+        
+        try:
+            prompt = self._route("prompt", request)
+            logging.info(f"🎨 生成的图像提示词: {prompt[:100]}...")
+            return prompt
+        except Exception as e:
+            logging.error(f"❌ 生成图像提示词失败: {e}")
+            return None
+    
+    def generate_image_prompt(self, user_message: str, nahida_reply: str) -> Optional[str]:
+        """生成图像提示词"""
+        return self._engineer_image_prompt(f'User: "{user_message}"\nNahida: "{nahida_reply}"')
+    
+    def draft_image_prompt(
+        self, 
+        user_message: str, 
+        history: List[Dict[str, str]], 
+        max_turns: int = 4
+    ) -> Optional[str]:
+        """在回复生成之前，根据用户消息和最近的对话预先起草图像提示词"""
+        lines = []
+        for msg in normalize_history(history)[-max_turns:]:
+            speaker = "Nahida" if msg.get("role") == "assistant" else "User"
+            lines.append(f'{speaker}: "{msg["content"]}"')
+        lines.append(f'User: "{user_message}"')
+        lines.append("(Nahida is about to answer; imagine the scene of her reply.)")
+        return self._engineer_image_prompt("\n".join(lines))
+    
+    def refine_image_prompt(self, draft: str, user_message: str, nahida_reply: str) -> Optional[str]:
+        """根据最终回复修订预先起草的图像提示词"""
+        return self._engineer_image_prompt(
+            f'User: "{user_message}"\nNahida: "{nahida_reply}"\n\n'
+            f"Draft prompt (revise it so it matches Nahida's reply, keep what still fits):\n{draft}"
+        )
+    
+    def _summary_messages(
+        self, 
+        previous_summary: Optional[str], 
+        messages: List[Dict[str, str]]
+    ) -> List[Dict[str, str]]:
+        lines = [
+            f"{'纳西妲' if m['role'] == 'assistant' else '旅行者'}：{m['content']}" for m in messages
+        ]
+        prompt = f"已有摘要：\n{previous_summary}\n\n" if previous_summary else ""
+        prompt += "新增对话：\n" + "\n".join(lines)
+        return [
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+    
+    def summarize_history(
+        self, 
+        previous_summary: Optional[str], 
+        messages: List[Dict[str, str]]
+    ) -> Optional[str]:
+        """把新折叠的对话合并进已有摘要"""
+        def request(model: str):
+            return self._client(model).chat.completions.create(
+                model=model,
+                messages=self._summary_messages(previous_summary, messages),
+                max_tokens=400,
+                temperature=0.3,
+                timeout=self._timeout("summary"),
+            )
+        
+        try:
+            response = self._with_key_retry(self.config.summary_model, request)
+            summary = response.choices[0].message.content.strip()
+            logging.info(f"📝 更新对话摘要（折叠 {len(messages)} 条消息）")
+            return summary or None
+        except Exception as e:
+            logging.error(f"❌ 生成对话摘要失败: {e}")
+            return None
+    
+    def _image_key(self, prompt: str) -> str:
+        return flight_key(
+            self.config.api_key, self.config.base_url, self.config.image_model, self.config.image_size, prompt
+        )
+    
+    def generate_image(self, prompt: str) -> Optional[str]:
+        """生成图像，合并相同的进行中请求"""
+        return flights["image"].do(self._image_key(prompt), lambda: self._request_image(prompt), self.upstream)
+    
+    def _request_image(self, prompt: str) -> Optional[str]:
+        """调用图像模型"""
+        def request(model: str) -> str:
+            response = self._client(model).images.generate(
+                model=model,
+                prompt=prompt,
+                n=1,
+                extra_body={"image_size": self.config.image_size},
+                timeout=self._timeout("image"),
+            )
+            if not response.data or not response.data[0].url:
+                raise EmptyReplyError("图像模型没有返回图像")
+            return response.data[0].url
+        
+        try:
+            return self._route("image", request)
+        except Exception as e:
+            logging.error(f"❌ 生成图像失败: {e}")
+            return None
+    
+    def _request_speech(self, text: str, voice: ReferenceVoice):
+        """请求语音合成，池中的 Key 失效或被限流时换一个 Key 重试"""
+        return self._with_key_retry(self.config.tts_model, lambda model: self._speak(model, text, voice))
+    
+    def _speak(self, model: str, text: str, voice: ReferenceVoice):
+        """用一个 Key 合成语音：优先使用已注册的音色 uri，失败时退回随请求上传参考音频"""
+        # 音色 uri 属于注册它的账号，按实际使用的 Key 登记
+        api_key, client = self._credentials(model)
+        key = VoiceRegistry.make_key(api_key, self.config.base_url, model, voice)
+        uri = voice_registry.lookup(key) or voice_registry.register(client, key, model, voice)
+        if uri:
+            try:
+                return client.audio.speech.create(
+                    model=model, input=text, voice=uri, response_format="mp3", timeout=self._timeout("tts")
+                )
+            except Exception as e:
+                if not _is_stale_voice_error(e):
+                    raise
+                logging.warning(f"⚠️ 音色 uri 已失效，重新注册: {e}")
+                voice_registry.invalidate(key)
+                uri = voice_registry.register(client, key, model, voice)
+                if uri:
+                    return client.audio.speech.create(
+                        model=model, input=text, voice=uri, response_format="mp3", timeout=self._timeout("tts")
+                    )
+        
+        return client.audio.speech.create(
+            model=model,
+            input=text,
+            voice="",
+            response_format="mp3",
+            extra_body={
+                "references": [{
+                    "audio": voice.data_uri,
+                    "text": voice.text
+                }]
+            },
+            timeout=self._timeout("tts"),
+        )
+    
+    def _synthesize(self, text: str, voice: ReferenceVoice, cache_key: str) -> bytes:
+        started = time.monotonic()
+        try:
+            response = self._request_speech(text, voice)
+        except Exception as e:
+            UPSTREAM_ERRORS.labels("tts", upstream_status(e)).inc()
+            raise
+        UPSTREAM_LATENCY.labels("tts", self.config.tts_model).observe(time.monotonic() - started)
+        AUDIO_PAYLOAD_BYTES.observe(len(response.content))
+        tts_cache.put(cache_key, response.content)
+        return response.content
+    
+    def generate_speech(self, text: str) -> Optional[bytes]:
+        """生成语音"""
+        try:
+            voice = self.reference_voice
+            if not voice:
+                logging.warning("⚠️ 参考音频未加载，跳过语音生成")
+                return None
+            
+            cache_key = tts_cache.make_key(self.config.tts_model, voice, text)
+            cached = tts_cache.get(cache_key)
+            if cached is not None:
+                return cached
+            
+            return flights["speech"].do(
+                flight_key(self.config.api_key, self.config.base_url, cache_key),
+                lambda: self._synthesize(text, voice, cache_key),
+                self.upstream
+            )
+        except Exception as e:
+            logging.error(f"❌ 生成语音失败: {e}")
+            return None
+
+
+# ==================== 异步 AI 服务类 ====================
+
+class AsyncAIService(AIService):
+    """基于 AsyncOpenAI 的 AI 服务，供 ASGI 入口使用
+
+    消息组装逻辑继承自 AIService；所有访问网络的方法都改为协程，
+    generate_image_prompt 等包装方法因此同样返回可 await 的对象。
+    """
+    
+    def __init__(self, config: UserConfig):
+        self.config = config
+        self.client = async_client_pool.get(config.api_key, config.base_url) if config.api_key else None
+        self.reference_voice = reference_audio_cache.get(config.voice)
+        self.history_summary: Optional[str] = None
+        self.deadline: Optional[Deadline] = None
+        # 协程由任务组直接取消，不需要 UpstreamScope
+        self.upstream: Optional[UpstreamScope] = None
+    
+    def _credentials(self, model: str) -> Tuple[str, Any]:
+        if not self._pooled:
+            return self.config.api_key, self.client
+        pooled = key_pool.select(model)
+        return pooled.api_key, pooled.async_client
+    
+    async def _with_key_retry(self, model: str, request: Callable[[str], Awaitable[Any]]) -> Any:
+        """调用 request(model)，池中的 Key 失效或被限流时换一个 Key 重试"""
+        attempt = 0
+        while True:
+            try:
+                return await request(model)
+            except Exception as e:
+                if not self._retry_with_another_key(e, attempt, model):
+                    raise
+                attempt += 1
+    
+    async def generate_chat_response(
+        self, 
+        user_message: str, 
+        history: List[Dict[str, str]]
+    ) -> str:
+        """生成对话回复"""
+        messages = self._build_chat_messages(user_message, history)
+        
+        logging.info(f"🤖 调用对话模型: {self.config.chat_model}")
+        
+        return await self._route("chat", lambda model: self._request_chat(model, messages))
+    
+    async def _route(
+        self, 
+        stage: str, 
+        request: Callable[[str], Awaitable[Any]], 
+        discard: Optional[Callable[[Any], None]] = None
+    ) -> Any:
+        """按该阶段的模型回退链调用"""
+        async def call(model: str) -> Any:
+            try:
+                return await self._with_key_retry(model, request)
+            except Exception as e:
+                error = self._deadline_error(stage, e)
+                if error is e:
+                    raise
+                raise error from e
+        
+        return await model_router.call_async(
+            stage, 
+            self.config.base_url, 
+            self.config.models_for(stage), 
+            call, 
+            hedge_delay=self.config.hedge_delays.get(stage, 0.0), 
+            discard=discard
+        )
+    
+    async def _request_chat(self, model: str, messages: List[Dict[str, str]]) -> str:
+        response = await self._client(model).chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=self.config.max_tokens,
+            temperature=self.config.temperature,
+            timeout=self._timeout("chat"),
+        )
+        
+        content = response.choices[0].message.content.strip()
+        if not content:
+            raise EmptyReplyError("对话模型返回了空回复")
+        
+        return content
+    
+    async def stream_chat_response(
+        self, 
+        user_message: str, 
+        history: List[Dict[str, str]]
+    ):
+        """流式生成对话回复，逐段产出增量文本"""
+        messages = self._build_chat_messages(user_message, history)
+        
+        logging.info(f"🤖 调用对话模型（流式）: {self.config.chat_model}")
+        
+        stream, deltas, first = await self._route(
+            "chat", 
+            lambda model: self._open_chat_stream(model, messages), 
+            discard=lambda opened: asyncio.ensure_future(opened[0].close())
+        )
+        try:
+            yield first
+            async for delta in deltas:
+                yield delta
+        finally:
+            await stream.close()
+    
+    async def _open_chat_stream(self, model: str, messages: List[Dict[str, str]]):
+        """打开流式回复并等到首段文本，返回 (流, 后续增量, 首段文本)"""
+        stream = await self._client(model).chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=self.config.max_tokens,
+            temperature=self.config.temperature,
+            stream=True,
+            timeout=self._timeout("chat"),
+        )
+        try:
+            deltas = self._stream_deltas(stream)
+            try:
+                first = await deltas.__anext__()
+            except StopAsyncIteration:
+                first = None
+        except BaseException:
+            await stream.close()
+            raise
+        if first is None:
+            await stream.close()
+            raise EmptyReplyError("对话模型返回了空回复")
+        return stream, deltas, first
+    
+    @staticmethod
+    async def _stream_deltas(stream):
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    
+    async def _engineer_image_prompt(self, prompt_input: str) -> Optional[str]:
+        """生成图像提示词，合并相同的进行中请求"""
+        return await flights["image_prompt"].do_async(
+            self._image_prompt_key(prompt_input), lambda: self._request_image_prompt(prompt_input)
+        )
+    
+    async def _request_image_prompt(self, prompt_input: str) -> Optional[str]:
+        """调用提示词工程模型生成图像提示词"""
+        messages = [
+            {"role": "system", "content": PROMPT_ENGINEER_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt_input}
+        ]
+        
+        async def request(model: str) -> str:
+            response = await self._client(model).chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=200,
+                temperature=0.5,
+                timeout=self._timeout("prompt"),
+            )
+            prompt = response.choices[0].message.content.strip()
+            if not prompt:
+                raise EmptyReplyError("提示词模型返回了空内容")
+            return prompt
+        
+        try:
+            prompt = await self._route("prompt", request)
+            logging.info(f"🎨 生成的图像提示词: {prompt[:100]}...")
+            return prompt
+        except Exception as e:
+            logging.error(f"❌ 生成图像提示词失败: {e}")
+            return None
+    
+    async def summarize_history(
+        self, 
+        previous_summary: Optional[str], 
+        messages: List[Dict[str, str]]
+    ) -> Optional[str]:
+        """把新折叠的对话合并进已有摘要"""
+        def request(model: str):
+            return self._client(model).chat.completions.create(
+                model=model,
+                messages=self._summary_messages(previous_summary, messages),
+                max_tokens=400,
+                temperature=0.3,
+                timeout=self._timeout("summary"),
+            )
+        
+        try:
+            response = await self._with_key_retry(self.config.summary_model, request)
+            summary = response.choices[0].message.content.strip()
+            logging.info(f"📝 更新对话摘要（折叠 {len(messages)} 条消息）")
+            return summary or None
+        except Exception as e:
+            logging.error(f"❌ 生成对话摘要失败: {e}")
+            return None
+    
+    async def generate_image(self, prompt: str) -> Optional[str]:
+        """生成图像，合并相同的进行中请求"""
+        return await flights["image"].do_async(self._image_key(prompt), lambda: self._request_image(prompt))
+    
+    async def _request_image(self, prompt: str) -> Optional[str]:
+        """调用图像模型"""
+        async def request(model: str) -> str:
+            response = await self._client(model).images.generate(
+                model=model,
+                prompt=prompt,
+                n=1,
+                extra_body={"image_size": self.config.image_size},
+                timeout=self._timeout("image"),
+            )
+            if not response.data or not response.data[0].url:
+                raise EmptyReplyError("图像模型没有返回图像")
+            return response.data[0].url
+        
+        try:
+            return await self._route("image", request)
+        except Exception as e:
+            logging.error(f"❌ 生成图像失败: {e}")
+            return None
+    
+    async def _register_voice(self, api_key: str, key: str, voice: ReferenceVoice) -> Optional[str]:
+        # 注册只在首次使用时发生，借用同步客户端在线程池中完成
+        pooled = key_pool.get(api_key) if self._pooled else None
+        client = pooled.client if pooled else client_pool.get(api_key, self.config.base_url)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(voice_registry.register, client, key, self.config.tts_model, voice)
+        )
+    
+    async def _request_speech(self, text: str, voice: ReferenceVoice):
+        """请求语音合成，池中的 Key 失效或被限流时换一个 Key 重试"""
+        return await self._with_key_retry(self.config.tts_model, lambda model: self._speak(model, text, voice))
+    
+    async def _speak(self, model: str, text: str, voice: ReferenceVoice):
+        """用一个 Key 合成语音：优先使用已注册的音色 uri，失败时退回随请求上传参考音频"""
+        api_key, client = self._credentials(model)
+        key = VoiceRegistry.make_key(api_key, self.config.base_url, model, voice)
+        uri = voice_registry.lookup(key) or await self._register_voice(api_key, key, voice)
+        if uri:
+            try:
+                return await client.audio.speech.create(
+                    model=model, input=text, voice=uri, response_format="mp3", timeout=self._timeout("tts")
+                )
+            except Exception as e:
+                if not _is_stale_voice_error(e):
+                    raise
+                logging.warning(f"⚠️ 音色 uri 已失效，重新注册: {e}")
+                voice_registry.invalidate(key)
+                uri = await self._register_voice(api_key, key, voice)
+                if uri:
+                    return await client.audio.speech.create(
+                        model=model, input=text, voice=uri, response_format="mp3", timeout=self._timeout("tts")
+                    )
+        
+        return await client.audio.speech.create(
+            model=model,
+            input=text,
+            voice="",
+            response_format="mp3",
+            extra_body={
+                "references": [{
+                    "audio": voice.data_uri,
+                    "text": voice.text
+                }]
+            },
+            timeout=self._timeout("tts"),
+        )
+    
+    async def _synthesize(self, text: str, voice: ReferenceVoice, cache_key: str) -> bytes:
+        started = time.monotonic()
+        try:
+            response = await self._request_speech(text, voice)
+        except Exception as e:
+            UPSTREAM_ERRORS.labels("tts", upstream_status(e)).inc()
+            raise
+        UPSTREAM_LATENCY.labels("tts", self.config.tts_model).observe(time.monotonic() - started)
+        AUDIO_PAYLOAD_BYTES.observe(len(response.content))
+        # 磁盘读写和目录清理不能在事件循环中执行，否则会卡住所有进行中的对话
+        await anyio.to_thread.run_sync(tts_cache.put, cache_key, response.content)
+        return response.content
+    
+    async def generate_speech(self, text: str) -> Optional[bytes]:
+        """生成语音"""
+        try:
+            voice = self.reference_voice
+            if not voice:
+                logging.warning("⚠️ 参考音频未加载，跳过语音生成")
+                return None
+            
+            cache_key = tts_cache.make_key(self.config.tts_model, voice, text)
+            cached = await anyio.to_thread.run_sync(tts_cache.get, cache_key)
+            if cached is not None:
+                return cached
+            
+            return await flights["speech"].do_async(
+                flight_key(self.config.api_key, self.config.base_url, cache_key),
+                lambda: self._synthesize(text, voice, cache_key)
+            )
+        except Exception as e:
+            logging.error(f"❌ 生成语音失败: {e}")
+            return None
+
+
+# ==================== 音频存储 ====================
+
+class AudioStore:
+    """生成音频的磁盘存储
+
+    音频以独立文件保存，SSE 消息只携带 id，浏览器通过 /audio/<id>
+    直接下载（支持 Range 请求），避免 base64 膨胀和多份内存拷贝。
+    存储目录可被多个 worker 进程共享，按总大小和过期时间清理。
+    """
+    
+    ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+    
+    def __init__(self, directory: str, max_bytes: int, ttl: float, suffix: str = ".mp3"):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.suffix = suffix
+        self._last_cleanup = 0.0
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+    
+    def put(self, data: bytes) -> str:
+        """保存音频，返回 id"""
+        audio_id = uuid.uuid4().hex
+        path = self.path_for(audio_id)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._maybe_cleanup()
+        return audio_id
+    
+    def path_for(self, audio_id: str) -> Path:
+        return self.directory / f"{audio_id}{self.suffix}"
+    
+    def get_path(self, audio_id: str) -> Optional[Path]:
+        """返回音频文件路径，不存在或 id 非法时返回 None"""
+        if not self.ID_PATTERN.match(audio_id):
+            return None
+        path = self.path_for(audio_id)
+        return path if path.is_file() else None
+    
+    def _maybe_cleanup(self, interval: float = 30.0) -> None:
+        now = time.monotonic()
+        if now - self._last_cleanup < interval or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._last_cleanup = now
+            self.cleanup()
+        finally:
+            self._lock.release()
+    
+    def cleanup(self) -> None:
+        """删除过期文件，并在超出容量时从最旧的开始删除"""
+        prune_directory(self.directory, f"*{self.suffix}", self.max_bytes, self.ttl)
+        prune_orphan_tmp(self.directory)
+
+
+audio_store = AudioStore(
+    directory=os.getenv("AUDIO_STORE_DIR", os.path.join(tempfile.gettempdir(), "nahida_audio")),
+    max_bytes=int(os.getenv("AUDIO_STORE_MAX_BYTES", 256 * 1024 * 1024)),
+    ttl=float(os.getenv("AUDIO_STORE_TTL", 3600)),
+)
+
+
+# ==================== 语音缓存 ====================
+
+class TTSCache:
+    """按内容寻址的语音缓存
+
+    键为 (TTS 模型, 参考音色指纹, 参考文本, 归一化后的回复文本) 的哈希，
+    内存层按 LRU 淘汰，磁盘层按总大小和空闲时间淘汰（命中时刷新修改时间）。
+    重复的台词直接从缓存返回，不再请求上游。
+    """
+    
+    def __init__(
+        self, 
+        directory: Optional[str], 
+        memory_bytes: int, 
+        disk_bytes: int, 
+        ttl: float
+    ):
+        self.directory = Path(directory) if directory else None
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_size = 0
+        self._last_cleanup = 0.0
+        self._lock = threading.Lock()
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+    
+    @staticmethod
+    def make_key(tts_model: str, voice: ReferenceVoice, text: str) -> str:
+        normalized = " ".join(text.split())
+        payload = "\x00".join([tts_model, voice.fingerprint, voice.text, normalized])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.mp3"
+    
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return data
+        
+        data = self._read_disk(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._put_memory(key, data)
+        return data
+    
+    def put(self, key: str, data: bytes) -> None:
+        self._put_memory(key, data)
+        if self.directory:
+            path = self._path(key)
+            tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logging.warning(f"⚠️ 写入语音缓存失败: {e}")
+            self._maybe_cleanup()
+    
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                return None
+            data = path.read_bytes()
+            # 刷新修改时间，磁盘层据此按最近使用淘汰
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+    
+    def _put_memory(self, key: str, data: bytes) -> None:
+        if len(data) > self.memory_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_size -= len(old)
+            self._memory[key] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+    
+    def _maybe_cleanup(self, interval: float = 60.0) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_cleanup < interval:
+                return
+            self._last_cleanup = now
+        prune_directory(self.directory, "*.mp3", self.disk_bytes, self.ttl)
+        prune_orphan_tmp(self.directory)
+
+
+tts_cache = TTSCache(
+    directory=os.getenv("TTS_CACHE_DIR", os.path.join(".cache", "tts")) or None,
+    memory_bytes=int(os.getenv("TTS_CACHE_MEMORY_BYTES", 32 * 1024 * 1024)),
+    disk_bytes=int(os.getenv("TTS_CACHE_DISK_BYTES", 512 * 1024 * 1024)),
+    ttl=float(os.getenv("TTS_CACHE_TTL", 7 * 24 * 3600)),
+)
+
+
+# ==================== 图像镜像 ====================
+
+@dataclass(frozen=True)
+class MediaItem:
+    """已镜像到本地的图像"""
+    digest: str
+    url: str
+    thumbnail_url: Optional[str]
+
+
+def sniff_image_type(data: bytes) -> Optional[str]:
+    """根据文件头识别图像格式，返回扩展名；非图像返回 None"""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return ".jpg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return ".gif"
+    return None
+
+
+class MediaStore:
+    """生成图像的本地镜像
+
+    上游返回的图像链接是临时的，这里在后台把图像下载到本地，按内容哈希
+    命名，通过 /media/<hash> 提供永久地址（内容不可变，可长期缓存）。
+    安装了 Pillow 时同时生成 WebP 缩略图，用于快速加载历史会话。
+    """
+    
+    DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+    MIMETYPES = {".png": "image/png", ".jpg": "image/jpeg", ".webp": "image/webp", ".gif": "image/gif"}
+    
+    def __init__(
+        self, 
+        directory: str, 
+        max_bytes: int, 
+        max_image_bytes: int, 
+        thumbnail_size: int, 
+        fetch_timeout: float, 
+        workers: int,
+        transport: Optional[httpx.BaseTransport] = None
+    ):
+        self.directory = Path(directory)
+        self.thumbnail_directory = self.directory / "thumbs"
+        self.max_bytes = max_bytes
+        self.max_image_bytes = max_image_bytes
+        self.thumbnail_size = thumbnail_size if Image is not None else 0
+        self.fetch_timeout = fetch_timeout
+        self._workers = workers
+        self._transport = transport
+        self._last_cleanup = 0.0
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+        self.thumbnail_directory.mkdir(parents=True, exist_ok=True)
+    
+    def _reset(self) -> None:
+        """创建下载线程池和连接；fork 后在子进程中重新创建"""
+        self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="media")
+        self._http = httpx.Client(transport=self._transport, follow_redirects=True)
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+    
+    def mirror(self, url: str) -> Future:
+        """在后台下载图像，返回结果为 Optional[MediaItem] 的 Future；同一链接只下载一次"""
+        with self._lock:
+            future = self._inflight.get(url)
+            if future is None:
+                future = self._executor.submit(self._fetch, url)
+                self._inflight[url] = future
+                future.add_done_callback(lambda _: self._forget(url))
+        return future
+    
+    def _forget(self, url: str) -> None:
+        with self._lock:
+            self._inflight.pop(url, None)
+    
+    def _fetch(self, url: str) -> Optional[MediaItem]:
+        try:
+            with self._http.stream("GET", url, timeout=self.fetch_timeout) as response:
+                response.raise_for_status()
+                buffer = bytearray()
+                for chunk in response.iter_bytes():
+                    buffer.extend(chunk)
+                    if len(buffer) > self.max_image_bytes:
+                        raise ValueError(f"图像超过 {self.max_image_bytes} 字节")
+            IMAGE_PAYLOAD_BYTES.observe(len(buffer))
+            item = self.put(bytes(buffer))
+            if item is None:
+                logging.warning("⚠️ 镜像图像失败: 下载内容不是图像")
+            return item
+        except Exception as e:
+            logging.warning(f"⚠️ 镜像图像失败: {e}")
+            return None
+    
+    def put(self, data: bytes) -> Optional[MediaItem]:
+        """按内容哈希保存图像；只接受可识别的图像格式，避免以本站域名提供任意内容"""
+        suffix = sniff_image_type(data)
+        if suffix is None:
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.directory / f"{digest}{suffix}"
+        if not path.exists():
+            tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+            self._maybe_cleanup()
+        
+        thumbnail_url = None
+        if self.thumbnail_size and self._make_thumbnail(digest, data):
+            thumbnail_url = f"/media/{digest}/thumb"
+        return MediaItem(digest=digest, url=f"/media/{digest}", thumbnail_url=thumbnail_url)
+    
+    def _make_thumbnail(self, digest: str, data: bytes) -> bool:
+        path = self.thumbnail_path(digest)
+        if path.exists():
+            return True
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+                if image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGBA")
+                tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+                image.save(tmp_path, "WEBP", quality=80)
+            os.replace(tmp_path, path)
+            return True
+        except Exception as e:
+            logging.warning(f"⚠️ 生成缩略图失败: {e}")
+            return False
+    
+    def thumbnail_path(self, digest: str) -> Path:
+        return self.thumbnail_directory / f"{digest}.webp"
+    
+    def get_path(self, digest: str) -> Optional[Tuple[Path, str]]:
+        """返回图像文件路径和 MIME 类型，不存在或哈希非法时返回 None"""
+        if not self.DIGEST_PATTERN.match(digest):
+            return None
+        for suffix, mimetype in self.MIMETYPES.items():
+            path = self.directory / f"{digest}{suffix}"
+            if path.is_file():
+                return path, mimetype
+        return None
+    
+    def get_thumbnail_path(self, digest: str) -> Optional[Path]:
+        if not self.DIGEST_PATTERN.match(digest):
+            return None
+        path = self.thumbnail_path(digest)
+        return path if path.is_file() else None
+    
+    def _maybe_cleanup(self, interval: float = 30.0) -> None:
+        # 默认不限容量，图像永久保留
+        if not self.max_bytes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_cleanup < interval:
+                return
+            self._last_cleanup = now
+        self.cleanup()
+    
+    def cleanup(self) -> None:
+        """超出容量时从最旧的文件开始删除；缩略图计入容量，原图删除后缩略图随之删除
+
+        只统计已完成的图像和缩略图，正在写入的 *.tmp 文件不会被删除。
+        """
+        patterns = tuple(f"*{suffix}" for suffix in self.MIMETYPES) + ("thumbs/*.webp",)
+        prune_directory(self.directory, patterns, self.max_bytes, math.inf)
+        for path in self.thumbnail_directory.glob("*.webp"):
+            if self.get_path(path.stem) is None:
+                path.unlink(missing_ok=True)
+        prune_orphan_tmp(self.directory)
+        prune_orphan_tmp(self.thumbnail_directory)
+
+
+media_store = MediaStore(
+    directory=os.getenv("MEDIA_DIR", "media"),
+    max_bytes=int(os.getenv("MEDIA_MAX_BYTES", 0)),
+    max_image_bytes=int(os.getenv("MEDIA_MAX_IMAGE_BYTES", 20 * 1024 * 1024)),
+    thumbnail_size=int(os.getenv("MEDIA_THUMBNAIL_SIZE", 512)),
+    fetch_timeout=float(os.getenv("MEDIA_FETCH_TIMEOUT", 30)),
+    workers=int(os.getenv("MEDIA_WORKERS", 4)),
+    transport=CassetteTransport(cassette) if cassette else None,
+)
+
+
+# ==================== 会话存储 ====================
+
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+
+class ConversationStore(ABC):
+    """服务端会话存储接口，按会话 id 追加和读取消息"""
+    
+    @abstractmethod
+    def load(self, session_id: str) -> Optional[List[Dict[str, str]]]:
+        """读取会话历史，会话不存在时返回 None"""
+    
+    @abstractmethod
+    def append(self, session_id: str, messages: List[Dict[str, str]]) -> None:
+        """向会话末尾追加消息"""
+    
+    @abstractmethod
+    def delete(self, session_id: str) -> None:
+        """删除会话"""
+
+
+class InMemoryConversationStore(ConversationStore):
+    """进程内会话存储，仅适合单进程部署和开发调试
+
+    最多保留 max_sessions 个会话，超出时淘汰最久未使用的；超过 ttl 秒
+    未使用的会话同样删除（0 表示不限）。
+    """
+    
+    def __init__(self, max_sessions: int = 10000, ttl: float = 0):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        # 会话 id -> (最近使用时间, 消息)，按最近使用排序
+        self._sessions: "OrderedDict[str, Tuple[float, List[Dict[str, str]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def load(self, session_id: str) -> Optional[List[Dict[str, str]]]:
+        with self._lock:
+            self._evict_locked()
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            self._sessions[session_id] = (time.monotonic(), entry[1])
+            self._sessions.move_to_end(session_id)
+            return list(entry[1])
+    
+    def append(self, session_id: str, messages: List[Dict[str, str]]) -> None:
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            stored = entry[1] if entry is not None else []
+            stored.extend(messages)
+            self._sessions[session_id] = (time.monotonic(), stored)
+            self._evict_locked()
+    
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+    
+    def _evict_locked(self) -> None:
+        expire_before = time.monotonic() - self.ttl if self.ttl else -math.inf
+        while self._sessions:
+            last_used, _ = next(iter(self._sessions.values()))
+            if len(self._sessions) <= self.max_sessions and last_used >= expire_before:
+                break
+            self._sessions.popitem(last=False)
+
+
+class SQLiteConversationStore(ConversationStore):
+    """基于 SQLite 的会话存储，多个 worker 进程可共享同一个数据库文件
+
+    最后一条消息早于 ttl 秒前的会话定期删除（0 表示永久保留）。
+    """
+    
+    def __init__(self, path: str, ttl: float = 0, cleanup_interval: float = 600.0):
+        self.path = path
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self._last_cleanup = 0.0
+        self._cleanup_lock = threading.Lock()
+        self._local = threading.local()
+        # sqlite3 连接不能跨进程使用，fork 后各 worker 重新连接
+        os.register_at_fork(after_in_child=self._reset)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " session_id TEXT NOT NULL,"
+                " role TEXT NOT NULL,"
+                " content TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, id)"
+            )
+    
+    def _reset(self) -> None:
+        self._local = threading.local()
+    
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3 连接不能跨线程使用，每个线程各自持有一个
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+    
+    def load(self, session_id: str) -> Optional[List[Dict[str, str]]]:
+        rows = self._connect().execute(
+            "SELECT role, content FROM messages WHERE session_id = ? ORDER BY id",
+            (session_id,),
+        ).fetchall()
+        if not rows:
+            return None
+        return [{"role": role, "content": content} for role, content in rows]
+    
+    def append(self, session_id: str, messages: List[Dict[str, str]]) -> None:
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO messages (session_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                [(session_id, m["role"], m["content"], now) for m in messages],
+            )
+        self._maybe_cleanup()
+    
+    def delete(self, session_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+    
+    def _maybe_cleanup(self) -> None:
+        if not self.ttl:
+            return
+        now = time.monotonic()
+        if now - self._last_cleanup < self.cleanup_interval or not self._cleanup_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_cleanup = now
+            self.cleanup()
+        finally:
+            self._cleanup_lock.release()
+    
+    def cleanup(self) -> int:
+        """删除过期会话，返回删除的会话数"""
+        expire_before = time.time() - self.ttl
+        with self._connect() as conn:
+            expired = [
+                (session_id,) for (session_id,) in conn.execute(
+                    "SELECT session_id FROM messages GROUP BY session_id HAVING MAX(created_at) < ?",
+                    (expire_before,),
+                )
+            ]
+            conn.executemany("DELETE FROM messages WHERE session_id = ?", expired)
+        if expired:
+            logging.info(f"🧹 已删除 {len(expired)} 个过期会话")
+        return len(expired)
+
+
+# 可用的会话存储实现，可在此登记自定义实现
+CONVERSATION_STORES: Dict[str, Callable[[], ConversationStore]] = {
+    "sqlite": lambda: SQLiteConversationStore(
+        os.getenv("CONVERSATION_DB_PATH", "conversations.db"),
+        ttl=float(os.getenv("CONVERSATION_TTL", 30 * 24 * 3600)),
+    ),
+    "memory": lambda: InMemoryConversationStore(
+        max_sessions=int(os.getenv("CONVERSATION_MAX_SESSIONS", 10000)),
+        ttl=float(os.getenv("CONVERSATION_TTL", 30 * 24 * 3600)),
+    ),
+}
+
+
+def create_conversation_store() -> Optional[ConversationStore]:
+    """按 CONVERSATION_STORE 环境变量创建会话存储，none 表示关闭"""
+    name = os.getenv("CONVERSATION_STORE", "sqlite").lower()
+    if name in ("", "none", "off"):
+        return None
+    factory = CONVERSATION_STORES.get(name)
+    if factory is None:
+        logging.error(f"❌ 未知的会话存储类型: {name}")
+        return None
+    return factory()
+
+
+class SessionMissing(Exception):
+    """客户端认为服务端已保存会话（synced），但服务端找不到该会话"""
+    
+    def __init__(self, session_id: Optional[str]):
+        super().__init__("服务端会话已失效，请重新上传历史记录")
+        self.session_id = session_id
+
+
+def session_missing_event(error: SessionMissing) -> Dict[str, Any]:
+    """会话丢失时返回给前端的错误事件，前端清除同步标记后带上完整历史重试"""
+    return {
+        "type": "error",
+        "code": "session_missing",
+        "content": str(error),
+        "session_id": error.session_id,
+    }
+
+
+def resolve_history(
+    store: Optional[ConversationStore], 
+    data: Dict[str, Any]
+) -> Tuple[List[Dict[str, str]], Optional[str]]:
+    """确定本轮使用的历史记录
+
+    启用会话存储且请求带有 session_id 时，历史记录从服务端读取，客户端只需
+    上传新消息；服务端还没有该会话时，用客户端上传的历史初始化。
+    客户端标记了 synced（只上传了新消息）而服务端没有该会话时（进程重启、
+    多 worker 的内存存储、数据库被删除），抛出 SessionMissing，不能静默丢掉上下文。
+    返回 (历史记录, 会话 id)，未使用会话存储时会话 id 为 None。
+    """
+    history = normalize_history(data.get("history") or [])
+    session_id = data.get("session_id")
+    synced = data.get("synced") is True
+    if store is None or not isinstance(session_id, str) or not SESSION_ID_PATTERN.match(session_id):
+        if synced:
+            raise SessionMissing(session_id if isinstance(session_id, str) else None)
+        return history, None
+    
+    stored = store.load(session_id)
+    if stored is None:
+        if synced:
+            raise SessionMissing(session_id)
+        if history:
+            store.append(session_id, history)
+        return history, session_id
+    return stored, session_id
+
+
+# ==================== 上下文窗口 ====================
+
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """本地估算 token 数：中文字符按 1 个计，其余字符约 4 个计 1 个"""
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_messages_tokens(messages: List[Dict[str, str]]) -> int:
+    # 每条消息另计 4 个 token 的角色和分隔开销
+    return sum(estimate_tokens(m["content"]) + 4 for m in messages)
+
+
+def _messages_digest(messages: List[Dict[str, str]]) -> str:
+    return hashlib.sha256(json.dumps(messages, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+@dataclass
+class HistorySummary:
+    """已折叠进摘要的历史前缀"""
+    folded_count: int
+    digest: str
+    text: str
+
+
+class ContextWindow:
+    """按 token 预算裁剪历史记录
+
+    历史未超出预算时原样发送；超出后保留最近 keep_turns 轮，其余折叠进
+    滚动摘要。摘要按会话缓存，之后只有保留部分再次超出预算（窗口滑动）
+    时，才把新移出窗口的消息增量合并进摘要。
+    """
+    
+    def __init__(self, token_budget: int, keep_turns: int, max_entries: int = 1024):
+        self.token_budget = token_budget
+        self.keep_turns = keep_turns
+        self.max_entries = max_entries
+        self._summaries: "OrderedDict[str, HistorySummary]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _get(self, key: str) -> Optional[HistorySummary]:
+        with self._lock:
+            entry = self._summaries.get(key)
+            if entry is not None:
+                self._summaries.move_to_end(key)
+            return entry
+    
+    def _put(self, key: str, entry: HistorySummary) -> None:
+        with self._lock:
+            self._summaries[key] = entry
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_entries:
+                self._summaries.popitem(last=False)
+    
+    def fit(
+        self, 
+        history: List[Dict[str, str]], 
+        summarize: Callable[[Optional[str], List[Dict[str, str]]], Optional[str]], 
+        session_key: Optional[str] = None
+    ) -> Tuple[List[Dict[str, str]], Optional[str]]:
+        """返回 (需要原样发送的历史, 早期对话摘要)"""
+        if not history or self.token_budget <= 0:
+            return history, None
+        
+        key = session_key or _messages_digest(history[:1])
+        cached = self._get(key)
+        # 缓存的摘要必须与当前历史的前缀一致（例如会话被编辑过就失效）
+        if cached and (
+            cached.folded_count > len(history)
+            or _messages_digest(history[:cached.folded_count]) != cached.digest
+        ):
+            cached = None
+        start = cached.folded_count if cached else 0
+        previous = cached.text if cached else None
+        
+        if estimate_messages_tokens(history[start:]) <= self.token_budget:
+            return history[start:], previous
+        
+        # 窗口滑动：保留最近 keep_turns 轮，仍超出预算时继续向后折叠
+        cut = max(start, len(history) - self.keep_turns * 2)
+        while cut < len(history) - 1 and (
+            estimate_messages_tokens(history[cut:]) > self.token_budget
+            or history[cut]["role"] != "user"
+        ):
+            cut += 1
+        
+        summary = summarize(previous, history[start:cut])
+        if summary is None:
+            # 摘要失败时直接丢弃移出窗口的消息，保证请求不超出上下文
+            logging.warning("⚠️ 对话摘要不可用，早期对话将被截断")
+            return history[cut:], previous
+        
+        self._put(key, HistorySummary(cut, _messages_digest(history[:cut]), summary))
+        return history[cut:], summary
+
+
+context_window = ContextWindow(
+    token_budget=int(os.getenv("HISTORY_TOKEN_BUDGET", 4000)),
+    keep_turns=int(os.getenv("HISTORY_KEEP_TURNS", 4)),
+)
+
+
+# ==================== 阶段调度 ====================
+
+class StageBusy(Exception):
+    """阶段排队已满"""
+    
+    def __init__(self, stage: str, retry_after: int):
+        super().__init__(f"{stage} 阶段繁忙，请 {retry_after} 秒后重试")
+        self.stage = stage
+        self.retry_after = retry_after
+
+
+class Stage:
+    """单个处理阶段的并发限制
+
+    同时执行的任务不超过 limit，排队的任务不超过 queue_size，超出时立即
+    抛出 StageBusy，而不是让延迟无限增长。带线程池的阶段通过 submit 提交
+    后台任务；不带线程池的阶段（如流式对话）在调用线程中通过 slot 占用名额。
+    异步入口通过 async_slot 在协程中占用名额，与同步入口共用排队计数。
+    """
+    
+    def __init__(self, name: str, limit: int, queue_size: int, pooled: bool):
+        self.name = name
+        self.limit = max(1, limit)
+        self.queue_size = max(0, queue_size)
+        self._pending = 0
+        # 任务平均耗时，用于估算 Retry-After
+        self._avg_seconds = 1.0
+        self._lock = threading.Lock()
+        self._running = threading.Semaphore(self.limit)
+        # 异步入口的并发限制，在事件循环中首次使用时创建（fork 后的子进程各自创建）
+        self._async_running: Optional[anyio.Semaphore] = None
+        self._executor = (
+            ThreadPoolExecutor(max_workers=self.limit, thread_name_prefix=f"stage-{name}")
+            if pooled else None
+        )
+    
+    @property
+    def pending(self) -> int:
+        """执行中和排队中的任务数"""
+        return self._pending
+    
+    def is_full(self) -> bool:
+        return self._pending >= self.limit + self.queue_size
+    
+    def retry_after(self) -> int:
+        """估算排队清空所需的秒数"""
+        waves = max(1, self._pending - self.limit + 1) / self.limit
+        return max(1, math.ceil(self._avg_seconds * waves))
+    
+    def _admit(self) -> None:
+        with self._lock:
+            if self._pending >= self.limit + self.queue_size:
+                raise StageBusy(self.name, self.retry_after())
+            self._pending += 1
+    
+    def _leave(self) -> None:
+        with self._lock:
+            self._pending -= 1
+    
+    def _record(self, elapsed: float) -> None:
+        with self._lock:
+            self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * elapsed
+    
+    @contextmanager
+    def slot(self):
+        """在当前线程中占用一个执行名额，排队已满时抛出 StageBusy"""
+        self._admit()
+        try:
+            self._running.acquire()
+            started = time.monotonic()
+            try:
+                yield
+            finally:
+                self._running.release()
+                self._record(time.monotonic() - started)
+        finally:
+            self._leave()
+    
+    @asynccontextmanager
+    async def async_slot(self):
+        """在当前协程中占用一个执行名额，排队已满时抛出 StageBusy"""
+        self._admit()
+        try:
+            if self._async_running is None:
+                self._async_running = anyio.Semaphore(self.limit)
+            async with self._async_running:
+                started = time.monotonic()
+                try:
+                    yield
+                finally:
+                    self._record(time.monotonic() - started)
+        finally:
+            self._leave()
+    
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """提交后台任务，排队已满时抛出 StageBusy"""
+        if self._executor is None:
+            raise RuntimeError(f"{self.name} 阶段没有线程池")
+        self._admit()
+        try:
+            future = self._executor.submit(self._call, fn, *args, **kwargs)
+        except Exception:
+            self._leave()
+            raise
+        # 任务完成或被取消时都要归还名额
+        future.add_done_callback(lambda _: self._leave())
+        return future
+    
+    def _call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        started = time.monotonic()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._record(time.monotonic() - started)
+
+
+class StageScheduler:
+    """进程内共享的阶段调度器
+
+    对话、提示词工程、图像、语音四个阶段分别限流，所有请求共用，
+    避免突发流量下每个请求各自开线程，同时向上游发起大量调用。
+    """
+    
+    # 阶段名 -> (默认并发数, 默认排队长度, 是否使用线程池)
+    DEFAULTS = {
+        "chat": (32, 64, False),
+        "prompt": (8, 32, False),
+        "image": (4, 16, True),
+        "tts": (int(os.getenv("TTS_WORKERS", 16)), 128, True),
+    }
+    
+    def __init__(self):
+        self.stages: Dict[str, Stage] = {}
+        for name, (limit, queue_size, pooled) in self.DEFAULTS.items():
+            prefix = f"STAGE_{name.upper()}"
+            self.stages[name] = Stage(
+                name,
+                limit=int(os.getenv(f"{prefix}_CONCURRENCY", limit)),
+                queue_size=int(os.getenv(f"{prefix}_QUEUE", queue_size)),
+                pooled=pooled,
+            )
+    
+    def stage(self, name: str) -> Stage:
+        return self.stages[name]
+    
+    def slot(self, name: str):
+        return self.stages[name].slot()
+    
+    def async_slot(self, name: str):
+        return self.stages[name].async_slot()
+    
+    def submit(self, name: str, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        return self.stages[name].submit(fn, *args, **kwargs)
+
+
+scheduler = StageScheduler()
+
+
+def busy_event(retry_after: int) -> Dict[str, Any]:
+    """排队已满时返回给前端的错误事件"""
+    return {
+        "type": "error",
+        "code": "busy",
+        "content": f"服务繁忙，请 {retry_after} 秒后重试",
+        "retry_after": retry_after
+    }
+
+
+# ==================== 分句语音合成 ====================
+
+class SentenceSplitter:
+    """按中英文句子边界切分流式文本"""
+    
+    # 句末标点，以及紧随其后的右引号/右括号
+    BOUNDARY = re.compile(r'(?:[。！？!?；;…～~\n]+|\.(?=\s|$))[”’」』）)"\']*')
+    
+    def __init__(self, min_chars: int = 6):
+        self.min_chars = min_chars
+        self._buffer = ""
+    
+    def feed(self, text: str) -> List[str]:
+        """追加文本，返回已经完整的句子"""
+        self._buffer += text
+        sentences = []
+        start = 0
+        for match in self.BOUNDARY.finditer(self._buffer):
+            # 句号后面还没收到字符时无法确定是否为小数点等情况，等待更多文本
+            if match.end() == len(self._buffer) and self._buffer[match.start()] == ".":
+                break
+            candidate = self._buffer[start:match.end()].strip()
+            if len(candidate) >= self.min_chars:
+                sentences.append(candidate)
+                start = match.end()
+        self._buffer = self._buffer[start:]
+        return sentences
+    
+    def flush(self) -> Optional[str]:
+        """返回剩余的文本"""
+        rest = self._buffer.strip()
+        self._buffer = ""
+        return rest or None
+
+
+class ChunkedSpeechSynthesizer:
+    """分句增量语音合成
+
+    每个句子单独提交合成，单个请求同时进行的合成数不超过 concurrency，
+    结果按提交顺序取出，保证音频片段顺序播放。
+    """
+    
+    def __init__(self, synthesize: Callable[[str], Optional[str]], concurrency: int = 2):
+        self.synthesize = synthesize
+        self.concurrency = max(1, concurrency)
+        self._pending: List[Tuple[int, str]] = []
+        self._futures: Dict[int, Future] = {}
+        self._texts: Dict[int, str] = {}
+        self._running = 0
+        self._next_index = 0
+        self._next_emit = 0
+        self._lock = threading.Lock()
+        self._submitted = threading.Condition(self._lock)
+    
+    def add(self, text: str) -> None:
+        """提交一个句子"""
+        with self._lock:
+            self._texts[self._next_index] = text
+            self._pending.append((self._next_index, text))
+            self._next_index += 1
+        self._pump()
+    
+    def _pump(self) -> None:
+        submitted = []
+        with self._lock:
+            while self._pending and self._running < self.concurrency:
+                index, text = self._pending.pop(0)
+                self._running += 1
+                try:
+                    future = scheduler.submit("tts", self.synthesize, text)
+                except StageBusy as e:
+                    # 语音阶段过载时跳过该句，文本照常显示
+                    logging.warning(f"⚠️ {e}")
+                    future = Future()
+                    future.set_result(None)
+                self._futures[index] = future
+                submitted.append(future)
+            self._submitted.notify_all()
+        # 回调可能在当前线程立即执行，必须在锁外注册
+        for future in submitted:
+            future.add_done_callback(self._on_done)
+    
+    def _on_done(self, _future: Future) -> None:
+        with self._lock:
+            self._running -= 1
+        self._pump()
+    
+    @property
+    def count(self) -> int:
+        return self._next_index
+    
+    def _emit(self, index: int) -> Dict[str, Any]:
+        future = self._futures.pop(index)
+        self._next_emit += 1
+        return {
+            "type": "audio_chunk",
+            "index": index,
+            "text": self._texts.pop(index),
+            "audio_url": future.result(),
+        }
+    
+    def ready(self) -> List[Dict[str, Any]]:
+        """取出所有已按顺序完成的音频片段"""
+        chunks = []
+        while True:
+            future = self._futures.get(self._next_emit)
+            if future is None or not future.done():
+                return chunks
+            chunks.append(self._emit(self._next_emit))
+    
+    @property
+    def finished(self) -> bool:
+        return self._next_emit >= self._next_index
+    
+    def next_ready(self, timeout: float) -> Optional[Dict[str, Any]]:
+        """按顺序等待下一个音频片段，超时返回 None"""
+        index = self._next_emit
+        with self._submitted:
+            # 还在排队的句子要等前面的合成完成后才会提交
+            if not self._submitted.wait_for(lambda: index in self._futures, timeout):
+                return None
+        try:
+            self._futures[index].result(timeout)
+        except FutureTimeoutError:
+            return None
+        return self._emit(index)
+    
+    def cancel(self) -> int:
+        """取消尚未开始的合成，返回节省的调用次数"""
+        with self._lock:
+            saved = len(self._pending)
+            self._pending.clear()
+            futures = list(self._futures.values())
+        return saved + sum(1 for future in futures if future.cancel())
+
+
+# ==================== 取消统计 ====================
+
+class CancellationStats:
+    """统计客户端断开后被取消的上游调用数"""
+    
+    def __init__(self, window: float = 60.0):
+        self.window = window
+        self.total = 0
+        self._events: "deque[Tuple[float, int]]" = deque()
+        self._lock = threading.Lock()
+    
+    def record(self, count: int = 1) -> None:
+        if count <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self.total += count
+            self._events.append((now, count))
+            self._trim(now)
+    
+    def _trim(self, now: float) -> None:
+        while self._events and now - self._events[0][0] > self.window:
+            self._events.popleft()
+    
+    def per_minute(self) -> int:
+        """最近一个统计窗口内节省的调用数"""
+        with self._lock:
+            self._trim(time.monotonic())
+            return sum(count for _, count in self._events)
+
+
+cancellation_stats = CancellationStats()
+
+# SSE 注释行，浏览器会忽略；用于定期写出数据以便及时发现客户端断开
+SSE_HEARTBEAT = ": keep-alive\n\n"
+
+
+# ==================== 对话流水线 ====================
+
+class ChatPipeline:
+    """单次对话的处理流程，产出 SSE 消息
+
+    客户端断开时 WSGI 服务器会关闭生成器，此时取消流式回复、
+    尚未开始的语音合成以及图像生成，避免为无人接收的结果消耗额度。
+    """
+    
+    def __init__(
+        self, 
+        ai_service: "AIService", 
+        user_message: str, 
+        history: List[Dict[str, str]], 
+        heartbeat_interval: float = 1.0,
+        session_key: Optional[str] = None,
+        timing: Optional[RequestTiming] = None
+    ):
+        self.ai_service = ai_service
+        self.config = ai_service.config
+        self.user_message = user_message
+        self.history = history
+        self.heartbeat_interval = heartbeat_interval
+        self.session_key = session_key
+        self.results: Dict[str, Any] = {}
+        # 回复完成（或失败）时置位；失败时 reply 为 None，预生成的图像随之取消
+        self.reply: Optional[str] = None
+        self.reply_ready = threading.Event()
+        # 预生成模式下起草的提示词；needs_reply 表示还要等回复完成后修订或重新生成
+        self.draft_prompt: Optional[str] = None
+        self.needs_reply = False
+        self.cancelled = threading.Event()
+        self.speech: Optional[ChunkedSpeechSynthesizer] = None
+        self._chat_stream: Optional[Generator[str, None, None]] = None
+        # 回复生成后调用（如写入会话存储），返回值合并进 done 事件
+        self.on_reply: Optional[Callable[[str], Dict[str, Any]]] = None
+        # 整个请求共用一个期限，各阶段以剩余时间作为超时
+        self.deadline = ai_service.deadline = Deadline(self.config.deadline)
+        # 本次对话的所有上游请求，客户端断开时统一中断
+        self.upstream = ai_service.upstream = UpstreamScope()
+        # 被跳过的阶段 -> 原因（deadline / busy），随 done 事件返回
+        self.skipped: Dict[str, str] = {}
+        # 各阶段起止时间，结束时作为 timing 事件发送并写入日志
+        self.timing = timing or RequestTiming()
+        self.timer = ResponseTimer(self.timing)
+    
+    def _emit(self, event: Dict[str, Any]) -> str:
+        self.timer.observe(event)
+        return create_sse_message(event)
+    
+    def skip(self, stage: str, reason: str) -> None:
+        if stage not in self.skipped:
+            self.skipped[stage] = reason
+            logging.warning(f"⏭️ 跳过 {stage} 阶段（{reason}）")
+    
+    def _has_budget(self, stage: str) -> bool:
+        """可选阶段开始前检查剩余时间，不足时记录跳过"""
+        if self.deadline.allows(stage):
+            return True
+        self.skip(stage, "deadline")
+        return False
+    
+    def synthesize(self, text: str) -> Optional[str]:
+        """合成语音并存入音频存储，返回音频地址"""
+        if self._skip_if_cancelled():
+            return None
+        if self.deadline.expired:
+            self.skip("tts", "deadline")
+            return None
+        with self.timing.span("tts"):
+            audio = self.ai_service.generate_speech(text)
+        if not audio:
+            return None
+        return f"/audio/{audio_store.put(audio)}"
+    
+    def _skip_if_cancelled(self) -> bool:
+        """客户端已断开时跳过即将发起的上游调用"""
+        if self.cancelled.is_set():
+            cancellation_stats.record()
+            return True
+        return False
+    
+    def cancel(self) -> None:
+        """客户端断开：停止流式回复，取消尚未开始的任务，中断进行中的上游调用"""
+        if self.cancelled.is_set():
+            return
+        self.cancelled.set()
+        
+        saved = 0
+        if self._chat_stream is not None and self.reply is None:
+            # 关闭流式响应会断开上游连接，模型随即停止生成
+            self._chat_stream.close()
+            saved += 1
+        if self.speech:
+            saved += self.speech.cancel()
+        # 各阶段线程中进行中的提示词、图像和语音请求（被其他对话合并共享的除外）
+        saved += self.upstream.cancel()
+        cancellation_stats.record(saved)
+        self.reply_ready.set()
+        
+        logging.info(
+            f"🛑 客户端已断开，取消 {saved} 个上游调用"
+            f"（最近一分钟共节省 {cancellation_stats.per_minute()} 个）"
+        )
+    
+    def _wait(self, is_done: Callable[[], bool], wait: Callable[[float], Any]) -> Generator[str, None, None]:
+        """等待后台任务，期间定期发送心跳以便及时发现客户端断开"""
+        while not is_done():
+            wait(self.heartbeat_interval)
+            if not is_done():
+                yield SSE_HEARTBEAT
+    
+    def _wait_future(self, future: Future) -> Generator[str, None, None]:
+        yield from self._wait(future.done, lambda timeout: futures_wait([future], timeout))
+    
+    def _start_image(self, task: Callable[[], None]) -> Future:
+        """在图像阶段线程池中运行图像任务；过载时跳过图像"""
+        def run() -> None:
+            try:
+                task()
+            except StageBusy as e:
+                logging.warning(f"⚠️ {e}")
+                self.skip("image", "busy")
+        
+        future = Future()
+        future.set_result(None)
+        if not self._has_budget("image"):
+            return future
+        try:
+            return scheduler.submit("image", run)
+        except StageBusy as e:
+            logging.warning(f"⚠️ {e}")
+            self.skip("image", "busy")
+            return future
+    
+    def _image_task(self) -> None:
+        """生成图像提示词和图像"""
+        if self._skip_if_cancelled():
+            return
+        if not self._has_budget("prompt"):
+            self.skip("image", "deadline")
+            return
+        with scheduler.slot("prompt"), self.timing.span("prompt"):
+            prompt = self.ai_service.generate_image_prompt(self.user_message, self.reply)
+        if prompt and not self._skip_if_cancelled() and self._has_budget("image"):
+            with self.timing.span("image"):
+                self.results["image_url"] = self.ai_service.generate_image(prompt)
+    
+    def _speculative_image_task(self) -> None:
+        """根据用户消息预先起草提示词；draft 模式下随即生成图像，对话失败时取消
+
+        refine 模式或草稿失败时需要最终回复，但不在这里等待：等待会让图像阶段的
+        线程在整个对话流期间闲置。草稿留在 draft_prompt 中，回复完成后由
+        _after_draft 重新提交图像任务。
+        """
+        with scheduler.slot("prompt"), self.timing.span("prompt"):
+            self.draft_prompt = self.ai_service.draft_image_prompt(self.user_message, self.history)
+        if self.config.speculative_image == "refine" or not self.draft_prompt:
+            self.needs_reply = True
+            return
+        if self.reply_ready.is_set() and self.reply is None:
+            return
+        if self._skip_if_cancelled() or not self._has_budget("image"):
+            return
+        with self.timing.span("image"):
+            self.results["image_url"] = self.ai_service.generate_image(self.draft_prompt)
+    
+    def _refine_image_task(self) -> None:
+        """回复完成后修订草稿（或草稿失败时按回复重新生成提示词），然后生成图像"""
+        if self._skip_if_cancelled():
+            return
+        prompt = self.draft_prompt
+        # 时间不足时直接使用草稿，不再修订
+        if self._has_budget("prompt"):
+            with scheduler.slot("prompt"), self.timing.span("prompt"):
+                if prompt:
+                    prompt = self.ai_service.refine_image_prompt(prompt, self.user_message, self.reply) or prompt
+                else:
+                    prompt = self.ai_service.generate_image_prompt(self.user_message, self.reply)
+        if not prompt or self._skip_if_cancelled() or not self._has_budget("image"):
+            return
+        with self.timing.span("image"):
+            self.results["image_url"] = self.ai_service.generate_image(prompt)
+    
+    def _after_draft(self, draft: Future) -> Future:
+        """回复已完成：草稿任务结束后，如有需要再提交修订和图像任务；返回整个图像分支的 Future"""
+        done = Future()
+        
+        def follow_up(_: Future) -> None:
+            try:
+                if self.needs_reply:
+                    self._start_image(self._refine_image_task).add_done_callback(lambda _: done.set_result(None))
+                    return
+            except Exception as e:
+                logging.error(f"❌ 提交图像任务失败: {e}")
+            done.set_result(None)
+        
+        draft.add_done_callback(follow_up)
+        return done
+    
+    def events(self) -> Generator[str, None, None]:
+        INFLIGHT_REQUESTS.inc()
+        outcome = "cancelled"
+        try:
+            yield from self._run()
+            outcome = "ok"
+        except GeneratorExit:
+            self.cancel()
+            raise
+        except StageBusy as e:
+            outcome = "busy"
+            logging.warning(f"⚠️ {e}")
+            yield self._emit(busy_event(e.retry_after))
+        except Exception as e:
+            outcome = "error"
+            logging.error(f"❌ 处理请求时出错: {e}")
+            yield self._emit({
+                "type": "error",
+                "content": str(e)
+            })
+        finally:
+            INFLIGHT_REQUESTS.dec()
+            summary = self.timing.log(outcome)
+        # 最后一个事件：各阶段耗时，供前端调试面板展示
+        yield self._emit({"type": "timing", **summary})
+    
+    def _run(self) -> Generator[str, None, None]:
+        ai_service = self.ai_service
+        config = self.config
+        
+        # 对话阶段全局限流，排队已满时立即返回 busy
+        queued_at = time.monotonic()
+        with scheduler.slot("chat"):
+            self.timing.record("queue", queued_at, time.monotonic())
+            
+            # 历史超出 token 预算时折叠早期对话
+            with self.timing.span("context"):
+                self.history, ai_service.history_summary = context_window.fit(
+                    self.history, ai_service.summarize_history, self.session_key
+                )
+            
+            # 分句合成时，语音随文本生成同步进行
+            speech = None
+            splitter = None
+            if config.tts_chunked and ai_service.reference_voice:
+                speech = self.speech = ChunkedSpeechSynthesizer(self.synthesize, config.tts_chunk_concurrency)
+                splitter = SentenceSplitter()
+            
+            # 预生成模式下，图像分支与对话回复同时开始
+            image_future = None
+            if config.speculative_image != "off":
+                image_future = self._start_image(self._speculative_image_task)
+            
+            # 1. 生成对话回复（流式模式下边生成边推送增量文本）
+            chat_started = time.monotonic()
+            try:
+                if config.stream:
+                    parts: List[str] = []
+                    self._chat_stream = ai_service.stream_chat_response(self.user_message, self.history)
+                    for delta in self._chat_stream:
+                        if not parts:
+                            self.timing.mark("first_token")
+                        parts.append(delta)
+                        yield self._emit({"type": "delta", "text": delta})
+                        if speech:
+                            for sentence in splitter.feed(delta):
+                                speech.add(sentence)
+                            for chunk in speech.ready():
+                                yield self._emit(chunk)
+                        # 读取超时只限制单次读取，持续缓慢输出的流要按总期限截断
+                        if self.deadline.expired:
+                            self._chat_stream.close()
+                            self.skip("chat", "deadline")
+                            break
+                    nahida_reply = "".join(parts).strip()
+                    if not nahida_reply:
+                        raise ValueError("对话模型返回了空回复")
+                else:
+                    nahida_reply = ai_service.generate_chat_response(self.user_message, self.history)
+                    if speech:
+                        for sentence in splitter.feed(nahida_reply):
+                            speech.add(sentence)
+                self.reply = nahida_reply
+            finally:
+                # 正常结束时 reply 已赋值；异常时保持 None，通知预生成任务取消
+                self.timing.record("chat", chat_started, time.monotonic())
+                self.reply_ready.set()
+        
+        if speech:
+            rest = splitter.flush()
+            if rest:
+                speech.add(rest)
+        
+        # 2. 并行生成语音和图像
+        results = self.results
+        
+        if image_future is None:
+            image_future = self._start_image(self._image_task)
+        else:
+            image_future = self._after_draft(image_future)
+        
+        if speech:
+            yield self._emit({
+                "type": "content_start",
+                "text": nahida_reply,
+                "audio_url": None,
+                "chunked": True
+            })
+            while not speech.finished:
+                chunk = speech.next_ready(self.heartbeat_interval)
+                yield self._emit(chunk) if chunk else SSE_HEARTBEAT
+            yield self._emit({"type": "audio_end", "count": speech.count})
+        else:
+            # 等待语音完成并发送
+            audio_url = None
+            try:
+                speech_future = scheduler.submit("tts", self.synthesize, nahida_reply)
+                yield from self._wait_future(speech_future)
+                audio_url = speech_future.result()
+            except StageBusy as e:
+                logging.warning(f"⚠️ {e}")
+                self.skip("tts", "busy")
+            yield self._emit({
+                "type": "content_start",
+                "text": nahida_reply,
+                "audio_url": audio_url
+            })
+        
+        # 等待图像完成并发送
+        yield from self._wait_future(image_future)
+        mirrored = None
+        if results.get("image_url"):
+            mirror_started = time.monotonic()
+            mirrored = media_store.mirror(results["image_url"])
+            yield self._emit({
+                "type": "image",
+                "payload": results["image_url"]
+            })
+        
+        # 完成
+        done = {
+            "type": "done",
+            "full_response": nahida_reply
+        }
+        if self.skipped:
+            done["skipped"] = self.skipped
+        if self.on_reply:
+            done.update(self.on_reply(nahida_reply))
+        yield self._emit(done)
+        
+        # 上游链接会过期，本地镜像完成后再告知前端永久地址；
+        # 放在 done 之后，下载再慢也不会推迟回复完成和会话保存
+        if mirrored is not None:
+            yield from self._wait_future(mirrored)
+            self.timing.record("mirror", mirror_started, time.monotonic())
+            item = mirrored.result()
+            if item:
+                yield self._emit({
+                    "type": "image_local",
+                    "payload": item.url,
+                    "thumbnail": item.thumbnail_url
+                })
+
+
+# ==================== 运行状态指标 ====================
+
+# 以下指标在抓取 /metrics 时从已有的统计对象读取，记录路径上没有额外开销
+CIRCUIT_STATE_VALUES = {
+    CircuitBreaker.CLOSED: 0, 
+    CircuitBreaker.OPEN: 1, 
+    CircuitBreaker.HALF_OPEN: 2,
+}
+
+metrics.callback(
+    "nahida_stage_pending", "各阶段执行中和排队中的任务数", ("stage",),
+    lambda: [((name,), stage.pending) for name, stage in scheduler.stages.items()],
+)
+metrics.callback(
+    "nahida_stage_limit", "各阶段的并发上限", ("stage",),
+    lambda: [((name,), stage.limit) for name, stage in scheduler.stages.items()],
+)
+metrics.callback(
+    "nahida_circuit_state", "模型熔断器状态：0 关闭，1 熔断，2 半开", ("stage", "model"),
+    lambda: [
+        ((stage, model), CIRCUIT_STATE_VALUES[breaker.state])
+        for (stage, _, model), breaker in list(model_router._breakers.items())
+    ],
+)
+metrics.callback(
+    "nahida_singleflight_calls_total", "可合并请求的调用次数", ("group",),
+    lambda: [((name,), flight.calls) for name, flight in flights.items()],
+    metric_type="counter",
+)
+metrics.callback(
+    "nahida_singleflight_coalesced_total", "被合并、未访问上游的调用次数", ("group",),
+    lambda: [((name,), flight.coalesced) for name, flight in flights.items()],
+    metric_type="counter",
+)
+metrics.callback(
+    "nahida_tts_cache_requests_total", "语音缓存查询次数", ("result",),
+    lambda: [(("hit",), tts_cache.hits), (("miss",), tts_cache.misses)],
+    metric_type="counter",
+)
+metrics.callback(
+    "nahida_cancelled_upstream_calls_total", "客户端断开后被取消的上游调用数", (),
+    lambda: [((), cancellation_stats.total)],
+    metric_type="counter",
+)
+metrics.callback(
+    "nahida_adaptive_limit", "各 (API Key, 模型) 当前的自适应并发上限", ("key", "model"),
+    lambda: [(key, limiter.limit) for key, limiter in adaptive_limiters.items()],
+)
+metrics.callback(
+    "nahida_adaptive_inflight", "各 (API Key, 模型) 正在进行的上游调用数", ("key", "model"),
+    lambda: [(key, limiter.inflight) for key, limiter in adaptive_limiters.items()],
+)
+metrics.callback(
+    "nahida_adaptive_waiting", "各 (API Key, 模型) 排队等待名额的调用数", ("key", "model"),
+    lambda: [(key, limiter.waiting) for key, limiter in adaptive_limiters.items()],
+)
+metrics.callback(
+    "nahida_adaptive_throttled_total", "各 (API Key, 模型) 收到的 429 次数", ("key", "model"),
+    lambda: [(key, limiter.throttled) for key, limiter in adaptive_limiters.items()],
+    metric_type="counter",
+)
+metrics.callback(
+    "nahida_key_pool_outstanding", "服务器端 Key 池中各 Key 进行中的请求数", ("key",),
+    lambda: [((pooled.name,), pooled.outstanding) for pooled in (key_pool.keys if key_pool else [])],
+)
+metrics.callback(
+    "nahida_key_pool_quarantined", "服务器端 Key 池中各 Key 是否暂停使用", ("key",),
+    lambda: [
+        ((pooled.name,), int(pooled.quarantined(time.monotonic()))) for pooled in (key_pool.keys if key_pool else [])
+    ],
+)
+metrics.callback(
+    "nahida_key_pool_throttled", "服务器端 Key 池中被限流而暂停使用的 (Key, 模型)", ("key", "model"),
+    lambda: [
+        ((pooled.name, model), 1) 
+        for pooled in (key_pool.keys if key_pool else []) 
+        for model in pooled.throttled_models(time.monotonic())
+    ],
+)
+metrics.callback(
+    "nahida_key_pool_requests_total", "服务器端 Key 池中各 Key 发出的请求数", ("key",),
+    lambda: [((pooled.name,), pooled.requests) for pooled in (key_pool.keys if key_pool else [])],
+    metric_type="counter",
+)
+metrics.callback(
+    "nahida_key_pool_quarantines_total", "服务器端 Key 池中各 Key（或其中某个模型）被暂停使用的次数", ("key",),
+    lambda: [((pooled.name,), pooled.quarantines) for pooled in (key_pool.keys if key_pool else [])],
+    metric_type="counter",
+)
+metrics.callback(
+    "nahida_client_pool_size", "复用中的 API 客户端数量", ("kind",),
+    lambda: [(("sync",), len(client_pool)), (("async",), len(async_client_pool))],
+)
+
+
+# ==================== Flask 应用 ====================
+
+def _immutable_media_response(path: Path, mimetype: str, etag: str) -> Response:
+    """按内容寻址的文件永不变化：以哈希作 ETag，并允许浏览器永久缓存"""
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=etag, max_age=365 * 24 * 3600)
+    response.cache_control.immutable = True
+    return response
+
+
+def create_app() -> Flask:
+    """创建 Flask 应用"""
+    app = Flask(__name__)
+    
+    # 配置日志
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    
+    # 启动时预先编码参考音频，请求路径上不再读取文件
+    reference_audio_cache.load_all()
+    
+    conversation_store = create_conversation_store()
+    
+    @app.route("/")
+    def index():
+        return render_template("index.html")
+    
+    @app.route("/audio/<audio_id>")
+    def audio(audio_id: str):
+        path = audio_store.get_path(audio_id)
+        if path is None:
+            abort(404)
+        # 音频内容不会变化，允许浏览器长期缓存；conditional 同时启用 Range 支持
+        return send_file(path, mimetype="audio/mpeg", conditional=True, max_age=audio_store.ttl)
+    
+    @app.route("/media/<digest>")
+    def media(digest: str):
+        found = media_store.get_path(digest)
+        if found is None:
+            abort(404)
+        path, mimetype = found
+        return _immutable_media_response(path, mimetype, digest)
+    
+    @app.route("/media/<digest>/thumb")
+    def media_thumbnail(digest: str):
+        path = media_store.get_thumbnail_path(digest)
+        if path is None:
+            abort(404)
+        return _immutable_media_response(path, "image/webp", f"{digest}-thumb")
+    
+    @app.route("/metrics")
+    def metrics_endpoint():
+        return Response(metrics.render(), content_type=MetricsRegistry.CONTENT_TYPE)
+    
+    @app.route("/chat", methods=["POST"])
+    def chat():
+        timing = RequestTiming(request_id_from(request.headers))
+        REQUEST_PAYLOAD_BYTES.observe(request.content_length or 0)
+        
+        # 从请求头中读取用户配置
+        config = UserConfig.from_headers(request.headers)
+        
+        # 验证配置
+        error = config.validate()
+        if error:
+            return Response(
+                create_sse_message({"type": "error", "content": error}),
+                mimetype="text/event-stream"
+            )
+        
+        # 创建 AI 服务实例
+        try:
+            ai_service = AIService(config)
+        except Exception as e:
+            return Response(
+                create_sse_message({"type": "error", "content": f"初始化服务失败: {str(e)}"}),
+                mimetype="text/event-stream"
+            )
+        
+        data = request.json
+        user_message = data.get("message", "").strip()
+        
+        if not user_message:
+            return Response(
+                create_sse_message({"type": "error", "content": "消息不能为空"}),
+                mimetype="text/event-stream"
+            )
+        
+        # 对话阶段排队已满时直接拒绝，浏览器可按 Retry-After 重试
+        chat_stage = scheduler.stage("chat")
+        if chat_stage.is_full():
+            retry_after = chat_stage.retry_after()
+            return Response(
+                create_sse_message(busy_event(retry_after)),
+                status=429,
+                mimetype="text/event-stream",
+                headers={"Retry-After": str(retry_after)}
+            )
+        
+        # 请求通过校验后再读写会话存储，无效或被拒绝的请求不会创建会话
+        try:
+            history, session_id = resolve_history(conversation_store, data)
+        except SessionMissing as e:
+            logging.warning(f"⚠️ 会话 {e.session_id} 已失效，要求客户端重新上传历史")
+            return Response(
+                create_sse_message(session_missing_event(e)),
+                status=409,
+                mimetype="text/event-stream"
+            )
+        
+        pipeline = ChatPipeline(
+            ai_service, 
+            user_message, 
+            history, 
+            heartbeat_interval=float(os.getenv("SSE_HEARTBEAT_INTERVAL", 1.0)),
+            session_key=session_id,
+            timing=timing,
+        )
+        
+        if session_id:
+            def save_turn(reply: str) -> Dict[str, Any]:
+                conversation_store.append(session_id, [
+                    {"role": "user", "content": user_message},
+                    {"role": "assistant", "content": reply},
+                ])
+                return {"session_id": session_id, "stored": True}
+            pipeline.on_reply = save_turn
+        
+        # 响应头在流开始前发出，只能带上解析请求、读取会话等准备阶段的耗时；
+        # 完整的分阶段耗时见最后的 timing 事件
+        timing.record("setup", timing.started, time.monotonic())
+        return Response(
+            pipeline.events(), 
+            mimetype="text/event-stream",
+            headers={
+                "X-Request-Id": timing.request_id,
+                "Server-Timing": timing.server_timing(),
+                # 反向代理（如 nginx）不缓冲事件流，每个事件立即送达浏览器
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",
+            }
+        )
     
     return app
 
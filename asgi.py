@@ -0,0 +1,539 @@
+"""
+异步 ASGI 入口
+/chat 使用 AsyncOpenAI 和 anyio 结构化并发处理，单个进程即可同时保持大量对话；
+各阶段与 Flask 入口共用 StageScheduler 的并发和排队限制，客户端断开时取消整个任务组。其余路由（页面、静态文件、音频）转交 Flask 应用处理。
+
+运行方式：uvicorn asgi:app --host 0.0.0.0 --port 1027
+"""
+
+import io
+import sys
+import json
+import time
+import logging
+from typing import Optional, List, Dict, Any, Callable, Awaitable, Tuple
+
+import anyio
+from werkzeug.datastructures import Headers
+
+from app import (
+    create_app,
+    create_sse_message,
+    UserConfig,
+    AsyncAIService,
+    SentenceSplitter,
+    audio_store,
+    create_conversation_store,
+    resolve_history,
+    SessionMissing,
+    session_missing_event,
+    context_window,
+    media_store,
+    Deadline,
+    DeadlineExceeded,
+    StageBusy,
+    scheduler,
+    busy_event,
+    ResponseTimer,
+    RequestTiming,
+    request_id_from,
+    INFLIGHT_REQUESTS,
+    REQUEST_PAYLOAD_BYTES,
+)
+
+flask_app = create_app()
+conversation_store = create_conversation_store()
+
+Emit = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+# ==================== 异步对话流水线 ====================
+
+class AsyncChatPipeline:
+    """单次对话的异步处理流程，与 ChatPipeline 产出相同的 SSE 事件"""
+
+    def __init__(
+        self,
+        ai_service: AsyncAIService,
+        user_message: str,
+        history: List[Dict[str, str]],
+        session_key: Optional[str] = None,
+        timing: Optional[RequestTiming] = None,
+    ):
+        self.ai_service = ai_service
+        self.config = ai_service.config
+        self.user_message = user_message
+        self.history = history
+        self.session_key = session_key
+        self.reply: Optional[str] = None
+        self.image_url: Optional[str] = None
+        # 回复生成后调用（如写入会话存储），返回值合并进 done 事件
+        self.on_reply: Optional[Callable[[str], Awaitable[Dict[str, Any]]]] = None
+        self.deadline = ai_service.deadline = Deadline(self.config.deadline)
+        # 被跳过的阶段 -> 原因（deadline / busy），随 done 事件返回
+        self.skipped: Dict[str, str] = {}
+        self.timing = timing or RequestTiming()
+
+    def skip(self, stage: str, reason: str) -> None:
+        if stage not in self.skipped:
+            self.skipped[stage] = reason
+            logging.warning(f"⏭️ 跳过 {stage} 阶段（{reason}）")
+
+    def _has_budget(self, stage: str) -> bool:
+        """可选阶段开始前检查剩余时间，不足时记录跳过"""
+        if self.deadline.allows(stage):
+            return True
+        self.skip(stage, "deadline")
+        return False
+
+    async def synthesize(self, text: str) -> Optional[str]:
+        """合成语音并存入音频存储，返回音频地址；语音阶段过载时跳过"""
+        if self.deadline.expired:
+            self.skip("tts", "deadline")
+            return None
+        try:
+            async with scheduler.async_slot("tts"):
+                with self.timing.span("tts"):
+                    audio = await self.ai_service.generate_speech(text)
+        except StageBusy as e:
+            logging.warning(f"⚠️ {e}")
+            self.skip("tts", "busy")
+            return None
+        if not audio:
+            return None
+        audio_id = await anyio.to_thread.run_sync(audio_store.put, audio)
+        return f"/audio/{audio_id}"
+
+    async def run(self, emit: Emit) -> None:
+        outcome = "cancelled"
+        try:
+            await self._run(emit)
+            outcome = "ok"
+        except Exception as e:
+            # 任务组会把子任务的异常包装成异常组，取出第一个作为错误信息
+            while isinstance(getattr(e, "exceptions", None), (list, tuple)) and e.exceptions:
+                e = e.exceptions[0]
+            if isinstance(e, StageBusy):
+                outcome = "busy"
+                logging.warning(f"⚠️ {e}")
+                await emit(busy_event(e.retry_after))
+            else:
+                outcome = "error"
+                logging.error(f"❌ 处理请求时出错: {e}")
+                await emit({"type": "error", "content": str(e)})
+        finally:
+            summary = self.timing.log(outcome)
+        await emit({"type": "timing", **summary})
+
+    async def _image_task(self, reply_ready: anyio.Event, image_done: anyio.Event) -> None:
+        """生成图像；预生成模式下与对话回复同时开始，提示词或图像阶段过载时跳过图像"""
+        try:
+            await self._generate_image(reply_ready)
+        except StageBusy as e:
+            logging.warning(f"⚠️ {e}")
+            self.skip("image", "busy")
+        finally:
+            image_done.set()
+
+    async def _generate_image(self, reply_ready: anyio.Event) -> None:
+        ai_service = self.ai_service
+        prompt = None
+        if self.config.speculative_image != "off":
+            async with scheduler.async_slot("prompt"):
+                with self.timing.span("prompt"):
+                    prompt = await ai_service.draft_image_prompt(self.user_message, self.history)
+
+        if self.config.speculative_image != "draft" or not prompt:
+            await reply_ready.wait()
+            if self.reply is None:
+                return
+            # 时间不足时直接使用草稿（没有草稿则放弃图像）
+            if self._has_budget("prompt"):
+                async with scheduler.async_slot("prompt"):
+                    with self.timing.span("prompt"):
+                        if prompt:
+                            prompt = await ai_service.refine_image_prompt(prompt, self.user_message, self.reply) or prompt
+                        else:
+                            prompt = await ai_service.generate_image_prompt(self.user_message, self.reply)
+            elif not prompt:
+                self.skip("image", "deadline")
+
+        if prompt and not (reply_ready.is_set() and self.reply is None) and self._has_budget("image"):
+            async with scheduler.async_slot("image"):
+                with self.timing.span("image"):
+                    self.image_url = await ai_service.generate_image(prompt)
+
+    async def _fit_history(self) -> None:
+        """历史超出 token 预算时折叠早期对话；摘要请求回到事件循环中执行"""
+        def summarize(previous: Optional[str], messages: List[Dict[str, str]]) -> Optional[str]:
+            return anyio.from_thread.run(self.ai_service.summarize_history, previous, messages)
+
+        self.history, self.ai_service.history_summary = await anyio.to_thread.run_sync(
+            context_window.fit, self.history, summarize, self.session_key
+        )
+
+    async def _run(self, emit: Emit) -> None:
+        ai_service = self.ai_service
+        config = self.config
+
+        splitter = None
+        if config.tts_chunked and ai_service.reference_voice:
+            splitter = SentenceSplitter()
+        limiter = anyio.CapacityLimiter(max(1, config.tts_chunk_concurrency))
+        chunks: List[Dict[str, Any]] = []
+        emitted = 0
+
+        reply_ready = anyio.Event()
+        image_done = anyio.Event()
+
+        async with anyio.create_task_group() as tg:
+            async def synthesize_chunk(chunk: Dict[str, Any]) -> None:
+                async with limiter:
+                    chunk["audio_url"] = await self.synthesize(chunk["text"])
+                chunk["ready"].set()
+
+            def add_sentence(text: str) -> None:
+                chunk = {"index": len(chunks), "text": text, "audio_url": None, "ready": anyio.Event()}
+                chunks.append(chunk)
+                tg.start_soon(synthesize_chunk, chunk)
+
+            async def emit_chunk(chunk: Dict[str, Any]) -> None:
+                await emit({
+                    "type": "audio_chunk",
+                    "index": chunk["index"],
+                    "text": chunk["text"],
+                    "audio_url": chunk["audio_url"],
+                })
+
+            # 对话阶段全局限流，排队已满时抛出 StageBusy，由 run 返回 busy
+            queued_at = time.monotonic()
+            async with scheduler.async_slot("chat"):
+                self.timing.record("queue", queued_at, time.monotonic())
+
+                # 历史超出 token 预算时折叠早期对话
+                with self.timing.span("context"):
+                    await self._fit_history()
+
+                tg.start_soon(self._image_task, reply_ready, image_done)
+
+                # 1. 生成对话回复
+                chat_started = time.monotonic()
+                try:
+                    if config.stream:
+                        parts: List[str] = []
+                        deltas = ai_service.stream_chat_response(self.user_message, self.history)
+                        # 读取超时只限制单次读取，持续缓慢输出的流要按总期限截断
+                        try:
+                            with anyio.move_on_after(self.deadline.remaining()) as scope:
+                                async for delta in deltas:
+                                    if not parts:
+                                        self.timing.mark("first_token")
+                                    parts.append(delta)
+                                    await emit({"type": "delta", "text": delta})
+                                    if splitter:
+                                        for sentence in splitter.feed(delta):
+                                            add_sentence(sentence)
+                                        while emitted < len(chunks) and chunks[emitted]["ready"].is_set():
+                                            await emit_chunk(chunks[emitted])
+                                            emitted += 1
+                        finally:
+                            await deltas.aclose()
+                        if scope.cancelled_caught:
+                            if not parts:
+                                raise DeadlineExceeded("chat")
+                            self.skip("chat", "deadline")
+                        nahida_reply = "".join(parts).strip()
+                        if not nahida_reply:
+                            raise ValueError("对话模型返回了空回复")
+                    else:
+                        nahida_reply = await ai_service.generate_chat_response(self.user_message, self.history)
+                        if splitter:
+                            for sentence in splitter.feed(nahida_reply):
+                                add_sentence(sentence)
+                    self.reply = nahida_reply
+                finally:
+                    self.timing.record("chat", chat_started, time.monotonic())
+                    reply_ready.set()
+
+            # 2. 语音
+            if splitter:
+                rest = splitter.flush()
+                if rest:
+                    add_sentence(rest)
+                await emit({
+                    "type": "content_start",
+                    "text": nahida_reply,
+                    "audio_url": None,
+                    "chunked": True
+                })
+                for chunk in chunks[emitted:]:
+                    await chunk["ready"].wait()
+                    await emit_chunk(chunk)
+                await emit({"type": "audio_end", "count": len(chunks)})
+            else:
+                await emit({
+                    "type": "content_start",
+                    "text": nahida_reply,
+                    "audio_url": await self.synthesize(nahida_reply)
+                })
+
+            # 3. 图像
+            await image_done.wait()
+            mirrored = None
+            if self.image_url:
+                mirror_started = time.monotonic()
+                mirrored = media_store.mirror(self.image_url)
+                await emit({"type": "image", "payload": self.image_url})
+
+            done = {"type": "done", "full_response": nahida_reply}
+            if self.skipped:
+                done["skipped"] = self.skipped
+            if self.on_reply:
+                done.update(await self.on_reply(nahida_reply))
+            await emit(done)
+
+            # 本地镜像放在 done 之后，下载再慢也不会推迟回复完成和会话保存
+            if mirrored is not None:
+                item = await anyio.to_thread.run_sync(mirrored.result, abandon_on_cancel=True)
+                self.timing.record("mirror", mirror_started, time.monotonic())
+                if item:
+                    await emit({"type": "image_local", "payload": item.url, "thumbnail": item.thumbnail_url})
+
+
+# ==================== ASGI 应用 ====================
+
+async def _read_body(receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return body
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def _send_sse_event(
+    send, event: Dict[str, Any], status: int = 200, headers: Optional[List[Tuple[bytes, bytes]]] = None
+) -> None:
+    """发送只包含一个事件的完整 SSE 响应"""
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"text/event-stream; charset=utf-8"), *(headers or [])],
+    })
+    await send({
+        "type": "http.response.body",
+        "body": create_sse_message(event).encode("utf-8"),
+    })
+
+
+async def _send_sse_error(send, content: str) -> None:
+    await _send_sse_event(send, {"type": "error", "content": content})
+
+
+async def chat(scope, receive, send) -> None:
+    """异步 /chat，客户端断开时取消所有上游调用"""
+    headers = Headers([(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]])
+    timing = RequestTiming(request_id_from(headers))
+    timer = ResponseTimer(timing)
+    body = await _read_body(receive)
+    REQUEST_PAYLOAD_BYTES.observe(len(body))
+
+    config = UserConfig.from_headers(headers)
+    error = config.validate()
+    if error:
+        await _send_sse_error(send, error)
+        return
+
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        await _send_sse_error(send, "请求格式不正确")
+        return
+    user_message = data.get("message", "").strip()
+    if not user_message:
+        await _send_sse_error(send, "消息不能为空")
+        return
+
+    try:
+        ai_service = AsyncAIService(config)
+    except Exception as e:
+        await _send_sse_error(send, f"初始化服务失败: {str(e)}")
+        return
+
+    # 对话阶段排队已满时直接拒绝，浏览器可按 Retry-After 重试
+    chat_stage = scheduler.stage("chat")
+    if chat_stage.is_full():
+        retry_after = chat_stage.retry_after()
+        await _send_sse_event(
+            send, busy_event(retry_after), status=429,
+            headers=[(b"retry-after", str(retry_after).encode("latin-1"))],
+        )
+        return
+
+    # 请求通过校验后再读写会话存储，无效或被拒绝的请求不会创建会话
+    try:
+        history, session_id = await anyio.to_thread.run_sync(resolve_history, conversation_store, data)
+    except SessionMissing as e:
+        logging.warning(f"⚠️ 会话 {e.session_id} 已失效，要求客户端重新上传历史")
+        await _send_sse_event(send, session_missing_event(e), status=409)
+        return
+
+    # 响应头只能带上准备阶段的耗时，完整的分阶段耗时见最后的 timing 事件
+    timing.record("setup", timing.started, time.monotonic())
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+            (b"x-request-id", timing.request_id.encode("latin-1")),
+            (b"server-timing", timing.server_timing().encode("latin-1")),
+        ],
+    })
+
+    async def emit(event: Dict[str, Any]) -> None:
+        timer.observe(event)
+        await send({
+            "type": "http.response.body",
+            "body": create_sse_message(event).encode("utf-8"),
+            "more_body": True,
+        })
+
+    pipeline = AsyncChatPipeline(ai_service, user_message, history, session_key=session_id, timing=timing)
+    if session_id:
+        async def save_turn(reply: str) -> Dict[str, Any]:
+            await anyio.to_thread.run_sync(conversation_store.append, session_id, [
+                {"role": "user", "content": user_message},
+                {"role": "assistant", "content": reply},
+            ])
+            return {"session_id": session_id, "stored": True}
+        pipeline.on_reply = save_turn
+
+    disconnected = False
+
+    INFLIGHT_REQUESTS.inc()
+    try:
+        async with anyio.create_task_group() as tg:
+            async def watch_disconnect() -> None:
+                nonlocal disconnected
+                while (await receive())["type"] != "http.disconnect":
+                    pass
+                disconnected = True
+                logging.info("🛑 客户端已断开，取消本次对话")
+                tg.cancel_scope.cancel()
+
+            tg.start_soon(watch_disconnect)
+            await pipeline.run(emit)
+            tg.cancel_scope.cancel()
+    finally:
+        INFLIGHT_REQUESTS.dec()
+
+    if not disconnected:
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def _build_environ(scope, body: bytes) -> Dict[str, Any]:
+    """根据 ASGI scope 构造 WSGI environ"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name == "CONTENT_LENGTH":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+# 每次到线程中读取的响应体大小，文件按 Werkzeug 的 8 KB 分块合并后发送
+WSGI_SEND_BYTES = 64 * 1024
+
+
+async def wsgi_fallback(scope, receive, send) -> None:
+    """在线程中调用 Flask 应用处理非流式路由，响应体边读边发，不整体缓存在内存中"""
+    body = await _read_body(receive)
+    environ = _build_environ(scope, body)
+    response: Dict[str, Any] = {}
+    written: List[bytes] = []
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [
+            (k.encode("latin-1"), v.encode("latin-1")) for k, v in headers
+        ]
+        return written.append
+
+    result = await anyio.to_thread.run_sync(flask_app, environ, start_response)
+    iterator = iter(result)
+
+    def pull() -> Tuple[bytes, bool]:
+        """读取下一段响应体，返回 (数据, 是否已读完)"""
+        parts = []
+        size = 0
+        for chunk in iterator:
+            parts.append(chunk)
+            size += len(chunk)
+            if size >= WSGI_SEND_BYTES:
+                return b"".join(parts), False
+        return b"".join(parts), True
+
+    try:
+        # WSGI 允许应用在返回第一段响应体时才调用 start_response
+        content, finished = await anyio.to_thread.run_sync(pull)
+        await send({
+            "type": "http.response.start",
+            "status": response["status"],
+            "headers": response["headers"],
+        })
+        if written:
+            await send({"type": "http.response.body", "body": b"".join(written), "more_body": True})
+        while not finished:
+            await send({"type": "http.response.body", "body": content, "more_body": True})
+            content, finished = await anyio.to_thread.run_sync(pull)
+        await send({"type": "http.response.body", "body": content, "more_body": False})
+    finally:
+        if hasattr(result, "close"):
+            await anyio.to_thread.run_sync(result.close)
+
+
+async def app(scope, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    if scope["path"] == "/chat" and scope["method"] == "POST":
+        await chat(scope, receive, send)
+    else:
+        await wsgi_fallback(scope, receive, send)
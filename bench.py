@@ -0,0 +1,413 @@
+"""
+/chat 端到端压测工具
+按脚本回放多轮对话，解析 SSE 事件流，统计吞吐量以及首个事件、content_start、
+image、done 的 p50/p95/p99 耗时，结果保存为 JSON，便于在不同提交和服务端配置之间对比。
+
+运行方式：
+    python bench.py run --concurrency 8 --conversations 40
+    python bench.py run --rate 2 --duration 60 --label gunicorn-gthread
+    python bench.py compare bench-results/a.json bench-results/b.json
+
+配合 simulator.py 可在本地离线压测，不消耗额度。
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import logging
+import subprocess
+from dataclasses import dataclass, asdict
+from typing import Optional, List, Dict, Any
+
+import httpx
+
+
+# ==================== 对话脚本 ====================
+
+DEFAULT_SCRIPTS: List[List[str]] = [
+    ["你好呀，纳西妲", "今天须弥的天气怎么样？", "能给我讲讲净善宫的故事吗？"],
+    ["我最近总是睡不好", "有什么办法能做个好梦吗？"],
+    ["我们去雨林里散步吧", "你看到那只蓝色的蝴蝶了吗？", "它飞到哪里去了？", "下次还一起来吧"],
+    ["你最喜欢的书是什么？", "为什么喜欢它呢？"],
+]
+
+# 记录耗时的事件，key 为结果中的字段名
+MILESTONES = {
+    "first_event": None,
+    "content_start": "content_start",
+    "image": "image",
+    "done": "done",
+}
+
+
+def load_scripts(path: Optional[str]) -> List[List[str]]:
+    """脚本文件为 JSON 数组，每项是一段对话中依次发送的用户消息"""
+    if not path:
+        return DEFAULT_SCRIPTS
+    with open(path, "r", encoding="utf-8") as f:
+        scripts = json.load(f)
+    if not isinstance(scripts, list) or not all(isinstance(s, list) and s for s in scripts):
+        raise ValueError("脚本文件应为非空消息列表组成的数组")
+    return scripts
+
+
+# ==================== 单轮请求 ====================
+
+@dataclass
+class TurnResult:
+    """单轮对话的结果，耗时均为相对发出请求的秒数"""
+    conversation: int
+    turn: int
+    status: str = "ok"
+    http_status: int = 0
+    first_event: Optional[float] = None
+    content_start: Optional[float] = None
+    image: Optional[float] = None
+    done: Optional[float] = None
+    audio_chunks: int = 0
+    bytes: int = 0
+    request_id: Optional[str] = None
+    error: Optional[str] = None
+
+
+async def run_turn(
+    client: httpx.AsyncClient,
+    url: str,
+    headers: Dict[str, str],
+    payload: Dict[str, Any],
+    result: TurnResult,
+) -> Dict[str, Any]:
+    """发送一轮消息并解析 SSE 流，返回 done 事件"""
+    started = time.monotonic()
+    done_event: Dict[str, Any] = {}
+    try:
+        async with client.stream("POST", url, json=payload, headers=headers) as response:
+            result.http_status = response.status_code
+            data_lines: List[str] = []
+            async for line in response.aiter_lines():
+                result.bytes += len(line) + 1
+                if line.startswith("data: "):
+                    data_lines.append(line[6:])
+                    continue
+                if line or not data_lines:
+                    # 心跳注释或多余空行
+                    continue
+
+                event = json.loads("\n".join(data_lines))
+                data_lines = []
+                elapsed = time.monotonic() - started
+                event_type = event.get("type")
+                if result.first_event is None:
+                    result.first_event = elapsed
+                for name, expected in MILESTONES.items():
+                    if expected == event_type and getattr(result, name) is None:
+                        setattr(result, name, elapsed)
+
+                if event_type == "audio_chunk":
+                    result.audio_chunks += 1
+                elif event_type == "done":
+                    done_event = event
+                elif event_type == "timing":
+                    result.request_id = event.get("request_id")
+                elif event_type == "error":
+                    # 排队已满时为 code=busy 的错误事件
+                    result.status = event.get("code") or "error"
+                    result.error = event.get("content")
+    except (httpx.HTTPError, ValueError) as e:
+        result.status = "error"
+        result.error = f"{type(e).__name__}: {e}"
+
+    if result.status == "ok" and result.done is None:
+        result.status = "error"
+        result.error = result.error or f"流在 done 之前结束（HTTP {result.http_status}）"
+    return done_event
+
+
+async def run_conversation(
+    client: httpx.AsyncClient,
+    args: argparse.Namespace,
+    headers: Dict[str, str],
+    index: int,
+    script: List[str],
+    results: List[TurnResult],
+) -> None:
+    """依次发送一段对话的各轮消息，与前端一样优先使用服务端会话"""
+    session_id = uuid.uuid4().hex
+    history: List[Dict[str, str]] = []
+    synced = False
+
+    for turn, message in enumerate(script):
+        result = TurnResult(conversation=index, turn=turn)
+        payload = {
+            "message": message,
+            "session_id": session_id,
+            "history": [] if synced else history,
+        }
+        done = await run_turn(client, f"{args.url}/chat", headers, payload, result)
+        results.append(result)
+        if result.status != "ok":
+            # 后续轮次依赖本轮回复，失败后放弃这段对话
+            return
+        synced = synced or bool(done.get("stored"))
+        history += [
+            {"role": "user", "content": message},
+            {"role": "assistant", "content": done.get("full_response", "")},
+        ]
+        if args.think_time:
+            await asyncio.sleep(args.think_time)
+
+
+# ==================== 负载模式 ====================
+
+async def closed_loop(client, args, headers, scripts, results) -> None:
+    """固定并发：每个虚拟用户完成一段对话后立即开始下一段"""
+    deadline = time.monotonic() + args.duration if args.duration else None
+    counter = iter(range(sys.maxsize))
+
+    async def user() -> None:
+        while True:
+            index = next(counter)
+            if args.conversations and index >= args.conversations:
+                return
+            if deadline and time.monotonic() >= deadline:
+                return
+            await run_conversation(client, args, headers, index, scripts[index % len(scripts)], results)
+
+    await asyncio.gather(*(user() for _ in range(args.concurrency)))
+
+
+async def open_loop(client, args, headers, scripts, results) -> None:
+    """固定到达率：按泊松过程开始新对话，不受服务端响应速度影响"""
+    rng = random.Random(args.seed)
+    deadline = time.monotonic() + args.duration if args.duration else None
+    inflight = asyncio.Semaphore(args.max_inflight)
+    tasks = []
+
+    async def start(index: int) -> None:
+        async with inflight:
+            await run_conversation(client, args, headers, index, scripts[index % len(scripts)], results)
+
+    index = 0
+    while not (args.conversations and index >= args.conversations):
+        if deadline and time.monotonic() >= deadline:
+            break
+        tasks.append(asyncio.create_task(start(index)))
+        index += 1
+        await asyncio.sleep(rng.expovariate(args.rate))
+    await asyncio.gather(*tasks)
+
+
+# ==================== 统计 ====================
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """线性插值百分位数"""
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(results: List[TurnResult], wall_time: float) -> Dict[str, Any]:
+    ok = [r for r in results if r.status == "ok"]
+    statuses: Dict[str, int] = {}
+    for r in results:
+        statuses[r.status] = statuses.get(r.status, 0) + 1
+
+    latency = {}
+    for name in MILESTONES:
+        values = [getattr(r, name) for r in ok if getattr(r, name) is not None]
+        latency[name] = {
+            "count": len(values),
+            "mean": sum(values) / len(values) if values else None,
+            "p50": percentile(values, 0.50),
+            "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99),
+            "max": max(values) if values else None,
+        }
+
+    return {
+        "turns": len(results),
+        "conversations": len({r.conversation for r in results}),
+        "statuses": statuses,
+        "error_rate": 1 - len(ok) / len(results) if results else 0.0,
+        "wall_time": wall_time,
+        "throughput": {
+            "turns_per_second": len(ok) / wall_time if wall_time else 0.0,
+            "conversations_per_second": len({r.conversation for r in ok}) / wall_time if wall_time else 0.0,
+        },
+        "latency": latency,
+    }
+
+
+def _format_seconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.0f}ms"
+
+
+def print_summary(summary: Dict[str, Any]) -> None:
+    throughput = summary["throughput"]
+    print(
+        f"\n轮次 {summary['turns']}，对话 {summary['conversations']}，"
+        f"状态 {summary['statuses']}，用时 {summary['wall_time']:.1f}s"
+    )
+    print(
+        f"吞吐量 {throughput['turns_per_second']:.2f} 轮/s，"
+        f"{throughput['conversations_per_second']:.2f} 段对话/s\n"
+    )
+    print(f"{'event':<14}{'count':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for name, stats in summary["latency"].items():
+        print(
+            f"{name:<14}{stats['count']:>6}"
+            + "".join(f"{_format_seconds(stats[key]):>10}" for key in ("p50", "p95", "p99", "max"))
+        )
+
+
+def git_revision() -> Optional[str]:
+    """当前提交，工作区有改动时加 -dirty 后缀"""
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain"], capture_output=True, text=True).stdout.strip()
+        return f"{revision}-dirty" if dirty else revision
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ==================== 命令 ====================
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    scripts = load_scripts(args.script)
+    headers = {"X-API-Key": args.api_key}
+    for item in args.header:
+        name, _, value = item.partition("=")
+        headers[name] = value
+
+    results: List[TurnResult] = []
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    timeout = httpx.Timeout(args.timeout, connect=10)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        started = time.monotonic()
+        if args.rate:
+            await open_loop(client, args, headers, scripts, results)
+        else:
+            await closed_loop(client, args, headers, scripts, results)
+        wall_time = time.monotonic() - started
+
+    return {
+        "label": args.label,
+        "revision": git_revision(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {
+            "url": args.url,
+            "mode": "open" if args.rate else "closed",
+            "concurrency": None if args.rate else args.concurrency,
+            "rate": args.rate,
+            "max_inflight": args.max_inflight if args.rate else None,
+            "conversations": args.conversations,
+            "duration": args.duration,
+            "think_time": args.think_time,
+            "script": args.script,
+            "headers": sorted(name for name in headers if name != "X-API-Key"),
+        },
+        "summary": summarize(results, wall_time),
+        "turns": [asdict(r) for r in results],
+    }
+
+
+def compare(baseline_path: str, candidate_path: str) -> None:
+    """对比两次压测结果的吞吐量和各事件百分位数"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(candidate_path, "r", encoding="utf-8") as f:
+        candidate = json.load(f)
+
+    def describe(run: Dict[str, Any]) -> str:
+        return f"{run.get('label') or '-'} @ {run.get('revision') or '?'}"
+
+    print(f"基线: {describe(baseline)}\n对比: {describe(candidate)}\n")
+    before = baseline["summary"]["throughput"]["turns_per_second"]
+    after = candidate["summary"]["throughput"]["turns_per_second"]
+    change = f"{(after - before) / before:+.1%}" if before else "-"
+    print(f"吞吐量 {before:.2f} → {after:.2f} 轮/s（{change}）")
+    print(
+        f"错误率 {baseline['summary']['error_rate']:.1%} → "
+        f"{candidate['summary']['error_rate']:.1%}\n"
+    )
+
+    print(f"{'event':<14}{'':>6}{'baseline':>10}{'candidate':>10}{'change':>10}")
+    for name in MILESTONES:
+        for key in ("p50", "p95", "p99"):
+            old = baseline["summary"]["latency"][name][key]
+            new = candidate["summary"]["latency"][name][key]
+            delta = f"{(new - old) / old:+.1%}" if old and new is not None else "-"
+            print(f"{name:<14}{key:>6}{_format_seconds(old):>10}{_format_seconds(new):>10}{delta:>10}")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="/chat 端到端压测")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="运行压测")
+    run_parser.add_argument("--url", default=os.getenv("BENCH_URL", "http://127.0.0.1:1027"), help="服务地址")
+    run_parser.add_argument("--api-key", default=os.getenv("SILICONFLOW_API_KEY", "sk-bench"), help="X-API-Key 请求头")
+    run_parser.add_argument("-H", "--header", action="append", default=[], help="额外请求头，格式 名称=值")
+    run_parser.add_argument("--script", help="对话脚本 JSON 文件")
+    run_parser.add_argument("--concurrency", type=int, default=4, help="固定并发模式的虚拟用户数")
+    run_parser.add_argument("--rate", type=float, default=0, help="固定到达率模式，每秒开始的对话数")
+    run_parser.add_argument("--max-inflight", type=int, default=256, help="到达率模式下同时进行的对话上限")
+    run_parser.add_argument("--conversations", type=int, default=0, help="总对话数（0 表示只按时长）")
+    run_parser.add_argument("--duration", type=float, default=0, help="持续秒数（0 表示只按对话数）")
+    run_parser.add_argument("--think-time", type=float, default=0, help="同一对话两轮之间的等待秒数")
+    run_parser.add_argument("--timeout", type=float, default=180, help="单轮请求的读取超时（秒）")
+    run_parser.add_argument("--seed", type=int, default=0, help="到达间隔的随机种子")
+    run_parser.add_argument("--label", default="", help="本次压测的标签，如服务端配置")
+    run_parser.add_argument("--output", help="结果文件，默认 bench-results/<时间>-<标签>.json")
+
+    compare_parser = commands.add_parser("compare", help="对比两次压测结果")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+
+    args = parser.parse_args(argv)
+    if args.command == "run" and not (args.conversations or args.duration):
+        args.conversations = args.concurrency * 5
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    args = parse_args(argv)
+    if args.command == "compare":
+        compare(args.baseline, args.candidate)
+        return
+
+    mode = f"到达率 {args.rate}/s" if args.rate else f"并发 {args.concurrency}"
+    logging.info(f"🚀 开始压测 {args.url}（{mode}）")
+    report = asyncio.run(run(args))
+    print_summary(report["summary"])
+
+    output = args.output
+    if not output:
+        name = time.strftime("%Y%m%d-%H%M%S") + (f"-{args.label}" if args.label else "")
+        output = os.path.join("bench-results", f"{name}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logging.info(f"📝 结果已保存: {output}")
+
+
+# ==================== 主入口 ====================
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+gunicorn 配置，针对长时间保持的 SSE 流
+
+每次对话的事件流会持续整个回复、语音和图像生成过程（数秒到数十秒），
+默认的 sync worker 在此期间只能服务一个连接，因此默认使用 gthread：
+每个 worker 用线程池处理请求，空闲的 keep-alive 连接由事件循环管理，不占用线程。
+也可以设置 GUNICORN_WORKER_CLASS=gevent（需另行安装 gevent）。
+
+运行方式：gunicorn wsgi:app（gunicorn 会自动读取当前目录下的本文件）
+"""
+
+import os
+import multiprocessing
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+
+if worker_class == "gevent":
+    # 必须在预加载应用之前打补丁，否则应用创建的锁和连接仍是阻塞版本
+    from gevent import monkey
+    monkey.patch_all()
+
+wsgi_app = "wsgi:app"
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', 1027)}"
+
+# 在 master 中加载应用一次：系统提示词、预编码的参考音频等只读数据
+# 通过写时复制在各 worker 间共享；连接和线程池在 fork 后由各对象自行重建
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+# 每个 worker 同时处理的请求数，应大于对话阶段并发数（STAGE_CHAT_CONCURRENCY），
+# 以便排队已满时仍能立即返回 429
+threads = int(os.getenv("GUNICORN_THREADS", 64))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", 1000))
+
+# gthread / gevent 的心跳由事件循环发送，长时间的事件流不会触发超时；
+# 超时只用于回收真正卡死的 worker
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+# 长于常见负载均衡器的空闲超时（60 秒），避免连接被两端同时关闭
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 75))
+
+# 重启或停止时停止接受新连接，等待进行中的事件流结束；
+# 默认等待一个完整的请求期限，超过后才强制结束
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", float(os.getenv("REQUEST_DEADLINE", 120)) + 10))
+
+# 定期替换 worker 以回收内存碎片，加随机抖动避免同时重启（0 表示不替换）
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 0)) or max_requests // 10
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-")
+
+
+def post_fork(server, worker):
+    server.log.info(f"🌱 worker {worker.pid} 已启动（{worker_class}）")
+
+
+def worker_exit(server, worker):
+    server.log.info(f"🛑 worker {worker.pid} 已退出")
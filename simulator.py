@@ -0,0 +1,448 @@
+"""
+SiliconFlow 本地模拟服务
+实现应用用到的接口子集（对话补全含流式、图像生成、语音合成、音色上传），
+可配置延迟分布、生成速度和错误注入，用于离线开发、调试和压测，不消耗额度。
+
+同一种子下结果可复现：回复内容由请求内容决定，延迟和错误由请求内容及其出现次数决定，
+与并发请求的先后顺序无关。
+
+运行方式：
+    python simulator.py
+    SILICONFLOW_BASE_URL=http://127.0.0.1:8090/v1 python app.py
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import zlib
+import struct
+import random
+import hashlib
+import logging
+import threading
+from collections import defaultdict
+from typing import Optional, List, Dict, Any, Tuple, Generator
+
+from flask import Flask, request, Response, jsonify, abort, g
+
+
+# ==================== 默认内容 ====================
+
+DEFAULT_PAYLOADS: Dict[str, List[str]] = {
+    "chat": [
+        "你好呀，旅行者。今天的须弥很安静，风从雨林那边吹过来，带着湿润的草木气息。你想和我聊些什么呢？",
+        "嗯……这个问题很有意思。知识就像树根一样，会向着看不见的地方不断延伸。我们一起慢慢想想吧？",
+        "我刚才在净善宫的窗边看书，书里说，梦是人们心里的另一片森林。你最近有做过什么有趣的梦吗？",
+        "别担心，就算走得慢一点也没关系。种子发芽需要时间，而我会一直在这里陪着你。",
+    ],
+    "prompt": [
+        "masterpiece, best quality, Nahida from Genshin Impact, sitting by a window in the Sanctuary of Surasthana, "
+        "soft morning light, lush rainforest in the background, gentle smile, cinematic composition",
+        "masterpiece, best quality, Nahida, floating among glowing dendro particles in a moonlit forest, "
+        "curious expression, depth of field, detailed illustration",
+    ],
+    "summary": [
+        "旅行者与纳西妲聊了须弥的近况和各自的见闻，旅行者提到最近在雨林中迷路的经历，纳西妲给了一些建议。",
+    ],
+}
+
+# 用于判断请求属于哪类调用的系统提示词关键字
+KIND_MARKERS = (
+    ("prompt", ("Art Director", "image prompt")),
+    ("summary", ("摘要",)),
+)
+
+
+# ==================== 延迟与错误 ====================
+
+class LatencyModel:
+    """延迟分布，格式：
+    0.5 或 fixed:0.5          固定延迟
+    uniform:0.2:1.0           均匀分布
+    lognormal:0.6:0.4         对数正态分布（中位数, sigma）
+    """
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        kind, _, rest = spec.partition(":")
+        if not rest:
+            kind, rest = "fixed", kind
+        try:
+            params = [float(x) for x in rest.split(":")]
+        except ValueError:
+            raise ValueError(f"无法解析延迟配置: {spec}")
+
+        if kind == "fixed" and len(params) == 1:
+            self._sample = lambda rng: params[0]
+        elif kind == "uniform" and len(params) == 2:
+            self._sample = lambda rng: rng.uniform(params[0], params[1])
+        elif kind == "lognormal" and len(params) == 2:
+            median, sigma = params
+            self._sample = lambda rng: rng.lognormvariate(math.log(max(median, 1e-6)), sigma)
+        else:
+            raise ValueError(f"无法解析延迟配置: {spec}")
+
+    def sample(self, rng: random.Random) -> float:
+        return max(0.0, self._sample(rng))
+
+
+def parse_errors(spec: str) -> List[Tuple[str, float]]:
+    """解析错误注入配置，如 429:0.05,500:0.02,timeout:0.01"""
+    errors = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        kind, _, rate = item.partition(":")
+        if kind != "timeout" and not kind.isdigit():
+            raise ValueError(f"无法解析错误注入配置: {item}")
+        errors.append((kind, float(rate)))
+    return errors
+
+
+class SimulatorConfig:
+    """模拟服务配置，从 SIM_* 环境变量读取"""
+
+    ENDPOINTS = ("chat", "image", "tts")
+    DEFAULT_LATENCY = {
+        "chat": "lognormal:0.6:0.4",
+        "image": "lognormal:4:0.3",
+        "tts": "lognormal:0.8:0.3",
+    }
+
+    def __init__(self):
+        self.seed = os.getenv("SIM_SEED", "nahida")
+        # 所有等待时间乘以该系数，压测时可调小以加快速度
+        self.time_scale = float(os.getenv("SIM_TIME_SCALE", 1.0))
+        # 每秒生成的 token 数，按一个字符一个 token 估算
+        self.token_rate = float(os.getenv("SIM_TOKEN_RATE", 30))
+        self.chunk_chars = max(1, int(os.getenv("SIM_CHUNK_CHARS", 2)))
+        # 注入超时时挂起的时间，应大于客户端超时
+        self.timeout_seconds = float(os.getenv("SIM_TIMEOUT_SECONDS", 600))
+        # 始终返回 503 的模型，用于验证回退和熔断
+        self.fail_models = {m.strip() for m in os.getenv("SIM_FAIL_MODELS", "").split(",") if m.strip()}
+        # 始终返回 401 的 API Key，用于验证服务器端 Key 池的隔离
+        self.invalid_keys = {k.strip() for k in os.getenv("SIM_INVALID_KEYS", "").split(",") if k.strip()}
+        # 每个 (API Key, 模型) 的并发上限，超出返回 429；0 表示不限制
+        self.max_concurrency = int(os.getenv("SIM_MAX_CONCURRENCY", 0))
+
+        global_errors = os.getenv("SIM_ERRORS", "")
+        self.latency: Dict[str, LatencyModel] = {}
+        self.errors: Dict[str, List[Tuple[str, float]]] = {}
+        for endpoint in self.ENDPOINTS:
+            name = endpoint.upper()
+            self.latency[endpoint] = LatencyModel(
+                os.getenv(f"SIM_{name}_LATENCY", self.DEFAULT_LATENCY[endpoint])
+            )
+            self.errors[endpoint] = parse_errors(os.getenv(f"SIM_{name}_ERRORS", global_errors))
+
+        self.payloads = dict(DEFAULT_PAYLOADS)
+        payloads_path = os.getenv("SIM_PAYLOADS_PATH")
+        if payloads_path:
+            with open(payloads_path, "r", encoding="utf-8") as f:
+                self.payloads.update(json.load(f))
+
+
+# ==================== 模拟服务 ====================
+
+class Simulator:
+    """按配置生成回复、延迟和错误"""
+
+    def __init__(self, config: SimulatorConfig):
+        self.config = config
+        self.voices: Dict[str, str] = {}
+        # 请求内容摘要 -> 出现次数，使重复请求得到不同但可复现的随机数
+        self._seen: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = defaultdict(int)
+        self._active: Dict[Tuple[str, str], int] = defaultdict(int)
+
+    def digest(self, body: bytes) -> str:
+        return hashlib.sha256(body).hexdigest()[:16]
+
+    def rng(self, body: bytes) -> random.Random:
+        """延迟和错误用的随机数，由种子、请求内容和出现次数决定"""
+        digest = self.digest(body)
+        with self._lock:
+            occurrence = self._seen[digest]
+            self._seen[digest] += 1
+        return random.Random(f"{self.config.seed}:{digest}:{occurrence}")
+
+    def choose(self, kind: str, body: bytes) -> str:
+        """相同请求总是得到相同的内容"""
+        choices = self.config.payloads.get(kind) or DEFAULT_PAYLOADS["chat"]
+        return random.Random(f"{self.config.seed}:{self.digest(body)}").choice(choices)
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats)
+
+    def sleep(self, seconds: float) -> None:
+        if seconds > 0:
+            time.sleep(seconds * self.config.time_scale)
+
+    def admit(self, key: Tuple[str, str]) -> Optional[int]:
+        """占用并发名额，返回剩余名额；已满时返回 None"""
+        limit = self.config.max_concurrency
+        with self._lock:
+            if self._active[key] >= limit:
+                self.stats["throttled"] += 1
+                return None
+            self._active[key] += 1
+            return limit - self._active[key]
+
+    def release(self, key: Tuple[str, str]) -> None:
+        with self._lock:
+            self._active[key] -= 1
+
+    def inject(self, endpoint: str, rng: random.Random, model: str) -> Optional[Response]:
+        """按配置返回错误响应；注入超时时挂起直到客户端放弃"""
+        self.count(f"{endpoint}_requests")
+        if model in self.config.fail_models:
+            self.count(f"{endpoint}_errors")
+            return error_response(503, f"Model {model} is temporarily unavailable")
+
+        roll = rng.random()
+        for kind, rate in self.config.errors[endpoint]:
+            if roll < rate:
+                self.count(f"{endpoint}_errors")
+                if kind == "timeout":
+                    logging.info(f"⏱️ 注入超时: {endpoint} {model}")
+                    # 不受 SIM_TIME_SCALE 影响，需要真正超过客户端超时
+                    time.sleep(self.config.timeout_seconds)
+                    return error_response(504, "Gateway Timeout")
+                status = int(kind)
+                logging.info(f"⚠️ 注入错误 {status}: {endpoint} {model}")
+                if status == 429:
+                    return error_response(429, "Request was rejected due to rate limiting", retry_after=1)
+                return error_response(status, "Internal server error")
+            roll -= rate
+        return None
+
+
+def error_response(status: int, message: str, retry_after: Optional[int] = None) -> Response:
+    response = jsonify({"code": status * 100 + 1, "message": message, "data": None})
+    response.status_code = status
+    if retry_after is not None:
+        response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+def request_kind(messages: List[Dict[str, Any]]) -> str:
+    """根据系统提示词判断是对话、图像提示词还是摘要请求"""
+    system = " ".join(m.get("content") or "" for m in messages if m.get("role") == "system")
+    for kind, markers in KIND_MARKERS:
+        if any(marker in system for marker in markers):
+            return kind
+    return "chat"
+
+
+def make_png(seed: str, size: int = 256) -> bytes:
+    """生成单色 PNG，颜色由种子决定"""
+    rng = random.Random(seed)
+    color = bytes(rng.randrange(64, 224) for _ in range(3))
+    row = b"\x00" + color * size
+    raw = zlib.compress(row * size)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", raw) + chunk(b"IEND", b"")
+
+
+# MPEG-1 Layer III，128kbps，44.1kHz，单声道；帧内容全零即为静音
+MP3_FRAME = b"\xff\xfb\x90\xc4" + b"\x00" * 413
+MP3_FRAME_SECONDS = 1152 / 44100
+
+
+def make_mp3(text: str) -> bytes:
+    """生成静音 MP3，时长按每字 0.2 秒估算"""
+    frames = max(1, int(len(text) * 0.2 / MP3_FRAME_SECONDS))
+    return MP3_FRAME * frames
+
+
+# ==================== Flask 应用 ====================
+
+def create_app(config: Optional[SimulatorConfig] = None) -> Flask:
+    app = Flask(__name__)
+    simulator = Simulator(config or SimulatorConfig())
+    app.config["SIMULATOR"] = simulator
+
+    @app.before_request
+    def check_auth():
+        authorization = request.headers.get("Authorization", "")
+        if request.path.startswith("/v1/") and (
+            not authorization.startswith("Bearer ")
+            or authorization[len("Bearer "):] in simulator.config.invalid_keys
+        ):
+            return error_response(401, "Invalid token")
+
+    @app.before_request
+    def check_concurrency():
+        """模拟按 (API Key, 模型) 计算的并发限额，响应头与 SiliconFlow 的 x-ratelimit-* 一致"""
+        if not simulator.config.max_concurrency or request.method != "POST" or request.path == "/v1/uploads/audio/voice":
+            return None
+        data = request.get_json(silent=True) or {}
+        key = (request.headers.get("Authorization", ""), data.get("model", ""))
+        remaining = simulator.admit(key)
+        if remaining is None:
+            logging.info(f"⚠️ 超出并发限额: {key[1]}")
+            response = error_response(429, "Request was rejected due to rate limiting", retry_after=1)
+            remaining = 0
+        else:
+            g.admitted = key
+            response = None
+        g.rate_limit = remaining
+        return response
+
+    @app.after_request
+    def add_rate_limit_headers(response: Response) -> Response:
+        if "rate_limit" in g:
+            response.headers["x-ratelimit-limit-requests"] = str(simulator.config.max_concurrency)
+            response.headers["x-ratelimit-remaining-requests"] = str(g.rate_limit)
+        if "admitted" in g:
+            # 流式回复在发送完毕后才归还名额
+            response.call_on_close(lambda key=g.admitted: simulator.release(key))
+        return response
+
+    @app.route("/v1/chat/completions", methods=["POST"])
+    def chat_completions():
+        body = request.get_data()
+        data = request.get_json(silent=True) or {}
+        model = data.get("model", "")
+        rng = simulator.rng(body)
+        error = simulator.inject("chat", rng, model)
+        if error is not None:
+            return error
+
+        kind = request_kind(data.get("messages", []))
+        text = simulator.choose(kind, body)
+        first_token = simulator.config.latency["chat"].sample(rng)
+        created = int(time.time())
+        completion_id = f"chatcmpl-{simulator.digest(body)}"
+        usage = {
+            "prompt_tokens": sum(len(m.get("content") or "") for m in data.get("messages", [])),
+            "completion_tokens": len(text),
+            "total_tokens": 0,
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if not data.get("stream"):
+            simulator.sleep(first_token + len(text) / simulator.config.token_rate)
+            return jsonify({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+        def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> str:
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+        def stream() -> Generator[str, None, None]:
+            simulator.sleep(first_token)
+            yield chunk({"role": "assistant", "content": ""})
+            step = simulator.config.chunk_chars
+            for i in range(0, len(text), step):
+                piece = text[i:i + step]
+                yield chunk({"content": piece})
+                simulator.sleep(len(piece) / simulator.config.token_rate)
+            yield chunk({}, "stop")
+            yield "data: [DONE]\n\n"
+
+        return Response(stream(), mimetype="text/event-stream")
+
+    @app.route("/v1/images/generations", methods=["POST"])
+    def images_generations():
+        body = request.get_data()
+        data = request.get_json(silent=True) or {}
+        model = data.get("model", "")
+        rng = simulator.rng(body)
+        error = simulator.inject("image", rng, model)
+        if error is not None:
+            return error
+
+        simulator.sleep(simulator.config.latency["image"].sample(rng))
+        url = f"{request.host_url}files/{simulator.digest(body)}.png"
+        return jsonify({
+            "images": [{"url": url}],
+            "data": [{"url": url}],
+            "timings": {"inference": 0},
+            "seed": rng.randrange(2 ** 31),
+            "created": int(time.time()),
+        })
+
+    @app.route("/files/<digest>.png")
+    def image_file(digest: str):
+        if not all(c in "0123456789abcdef" for c in digest):
+            abort(404)
+        return Response(make_png(digest), mimetype="image/png")
+
+    @app.route("/v1/audio/speech", methods=["POST"])
+    def audio_speech():
+        body = request.get_data()
+        data = request.get_json(silent=True) or {}
+        model = data.get("model", "")
+        voice = data.get("voice")
+        if voice and voice.startswith("speech:") and voice not in simulator.voices:
+            return error_response(400, f"voice {voice} not found")
+
+        rng = simulator.rng(body)
+        error = simulator.inject("tts", rng, model)
+        if error is not None:
+            return error
+
+        simulator.sleep(simulator.config.latency["tts"].sample(rng))
+        return Response(make_mp3(data.get("input", "")), mimetype="audio/mpeg")
+
+    @app.route("/v1/uploads/audio/voice", methods=["POST"])
+    def upload_voice():
+        data = request.get_json(silent=True) or {}
+        name = data.get("customName") or "voice"
+        uri = f"speech:{name}:sim:{hashlib.sha256(request.get_data()).hexdigest()[:12]}"
+        simulator.voices[uri] = name
+        return jsonify({"uri": uri})
+
+    @app.route("/stats")
+    def stats():
+        return jsonify(simulator.snapshot())
+
+    return app
+
+
+# ==================== 主入口 ====================
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    try:
+        app = create_app()
+    except ValueError as e:
+        logging.error(f"❌ {e}")
+        sys.exit(1)
+
+    port = int(os.getenv("SIM_PORT", 8090))
+    logging.info(f"🤖 SiliconFlow 模拟服务已启动: http://127.0.0.1:{port}/v1")
+    app.run(host=os.getenv("SIM_HOST", "127.0.0.1"), port=port, threaded=True)
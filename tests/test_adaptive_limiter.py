@@ -0,0 +1,173 @@
+"""AdaptiveLimiter 的 AIMD 调整、429 重新排队与本地背压"""
+
+import json
+import threading
+import time
+
+import httpx
+import pytest
+from openai import OpenAI, RateLimitError
+
+from app import (
+    AdaptiveLimiter, AdaptiveLimiterRegistry, AdaptiveLimitTransport, ApiKeyPool, PooledKeyTransport,
+    _is_model_failure, is_local_throttle, upstream_status
+)
+
+
+def make_limiter(**options) -> AdaptiveLimiter:
+    settings = dict(
+        initial=4, min_limit=1, max_limit=8, decrease_factor=0.5, cooldown=60, low_watermark=0.1
+    )
+    settings.update(options)
+    return AdaptiveLimiter("test", **settings)
+
+
+def response(status: int, **headers) -> httpx.Response:
+    return httpx.Response(status, headers=headers)
+
+
+def test_success_at_capacity_increases_limit():
+    limiter = make_limiter()
+    for _ in range(4):
+        assert limiter.acquire(0)
+    
+    limiter.observe(response(200))
+    
+    assert limiter.limit == pytest.approx(4.25)
+
+
+def test_success_below_capacity_keeps_limit():
+    limiter = make_limiter()
+    assert limiter.acquire(0)
+    
+    limiter.observe(response(200))
+    
+    assert limiter.limit == 4
+
+
+def test_throttle_decreases_once_per_cooldown():
+    limiter = make_limiter()
+    
+    limiter.observe(response(429))
+    limiter.observe(response(429))
+    
+    assert limiter.limit == 2
+    assert limiter.throttled == 2
+
+
+def test_low_remaining_quota_decreases_limit():
+    limiter = make_limiter(cooldown=0)
+    
+    limiter.observe(response(200, **{"x-ratelimit-limit-requests": "100", "x-ratelimit-remaining-requests": "5"}))
+    
+    assert limiter.limit == 2
+
+
+def test_limit_never_drops_below_minimum():
+    limiter = make_limiter(cooldown=0, initial=1.5)
+    
+    limiter.observe(response(429))
+    limiter.observe(response(429))
+    
+    assert limiter.limit == 1
+
+
+def test_retry_after_pauses_new_acquires():
+    limiter = make_limiter()
+    limiter.observe(response(429, **{"retry-after": "30"}))
+    
+    assert limiter.paused_for() > 25
+    assert not limiter.acquire(0.01)
+
+
+def test_waiter_gets_slot_when_released():
+    limiter = make_limiter(initial=1)
+    assert limiter.acquire(0)
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(limiter.acquire(5)))
+    waiter.start()
+    time.sleep(0.05)
+    assert limiter.waiting == 1
+    
+    limiter.release()
+    waiter.join(5)
+    
+    assert acquired == [True]
+
+
+def chat_request(model: str = "m", api_key: str = "sk-test") -> httpx.Request:
+    return httpx.Request(
+        "POST", "https://api.siliconflow.cn/v1/chat/completions",
+        headers={"authorization": f"Bearer {api_key}"},
+        content=json.dumps({"model": model}).encode(),
+        extensions={"timeout": {"pool": 2.0}}
+    )
+
+
+def test_throttled_request_is_requeued_and_resent():
+    registry = AdaptiveLimiterRegistry(initial=2, cooldown=60)
+    statuses = iter([429, 200])
+    sent = []
+    
+    def handler(request):
+        sent.append(request)
+        return httpx.Response(next(statuses), headers={"retry-after-ms": "50"}, json={})
+    
+    transport = AdaptiveLimitTransport(registry, httpx.MockTransport(handler))
+    started = time.monotonic()
+    result = transport.handle_request(chat_request())
+    result.read()
+    result.close()
+    
+    limiter = registry.get("sk-test", "m")
+    assert result.status_code == 200
+    assert len(sent) == 2
+    assert time.monotonic() - started >= 0.05
+    assert limiter.throttled == 1
+    assert limiter.inflight == 0
+
+
+def test_throttled_request_is_returned_when_pause_outlasts_timeout():
+    registry = AdaptiveLimiterRegistry(initial=2)
+    sent = []
+    
+    def handler(request):
+        sent.append(request)
+        return httpx.Response(429, headers={"retry-after": "30"}, json={})
+    
+    transport = AdaptiveLimitTransport(registry, httpx.MockTransport(handler))
+    result = transport.handle_request(chat_request())
+    
+    assert result.status_code == 429
+    assert len(sent) == 1
+    assert registry.get("sk-test", "m").inflight == 0
+
+
+def test_queue_timeout_is_local_backpressure():
+    """排队超时不发往上游、SDK 不重试、不计入熔断器、Key 池也不暂停该 Key"""
+    registry = AdaptiveLimiterRegistry(initial=1)
+    limiter = registry.get("sk-test", "m")
+    assert limiter.acquire(0)
+    sent = []
+    pool = ApiKeyPool(["sk-test"])
+    pooled = pool.keys[0]
+    transport = PooledKeyTransport(
+        pooled, AdaptiveLimitTransport(registry, httpx.MockTransport(lambda request: sent.append(request)))
+    )
+    client = OpenAI(
+        api_key="sk-test",
+        base_url="https://api.siliconflow.cn/v1",
+        http_client=httpx.Client(transport=transport),
+        max_retries=2,
+    )
+    
+    with pytest.raises(RateLimitError) as caught:
+        client.chat.completions.create(model="m", messages=[], timeout=0.05)
+    
+    assert sent == []
+    assert is_local_throttle(caught.value)
+    assert not _is_model_failure(caught.value)
+    assert upstream_status(caught.value) == "local_throttle"
+    assert pool.available("m") == 1
+    assert pooled.outstanding == 0
+    assert limiter.throttled == 0
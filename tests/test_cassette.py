@@ -0,0 +1,41 @@
+"""录制回放"""
+
+import gzip
+import json
+
+import httpx
+
+from app import Cassette, CassetteTransport
+
+
+def gzip_handler(request: httpx.Request) -> httpx.Response:
+    body = gzip.compress(json.dumps({"hello": "world"}).encode("utf-8"))
+    return httpx.Response(
+        200, 
+        headers={"content-type": "application/json", "content-encoding": "gzip", "content-length": str(len(body))}, 
+        content=body,
+    )
+
+
+def test_replays_content_encoded_responses(tmp_path):
+    path = tmp_path / "default.jsonl.gz"
+    recorder = CassetteTransport(Cassette(str(path), "record"))
+    recorder._transport = httpx.MockTransport(gzip_handler)
+    with httpx.Client(transport=recorder) as client:
+        assert client.post("https://upstream.test/v1/x", json={"a": 1}).json() == {"hello": "world"}
+    
+    player = CassetteTransport(Cassette(str(path), "replay", time_scale=0))
+    with httpx.Client(transport=player) as client:
+        assert client.post("https://upstream.test/v1/x", json={"a": 1}).json() == {"hello": "world"}
+
+
+def test_each_process_records_its_own_file(tmp_path):
+    path = tmp_path / "default.jsonl.gz"
+    recorder = CassetteTransport(Cassette(str(path), "record"))
+    recorder._transport = httpx.MockTransport(gzip_handler)
+    with httpx.Client(transport=recorder) as client:
+        client.post("https://upstream.test/v1/x", json={"a": 1}).read()
+    
+    assert not path.exists()
+    assert [p.name.split(".")[1].isdigit() for p in tmp_path.iterdir()] == [True]
+    assert len(Cassette(str(path), "replay").files()) == 1
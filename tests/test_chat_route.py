@@ -0,0 +1,59 @@
+"""/chat 的请求校验与会话同步"""
+
+import pytest
+
+import app as app_module
+from app import InMemoryConversationStore, SessionMissing, create_app, resolve_history
+
+SESSION_ID = "s" * 32
+HISTORY = [{"role": "user", "content": "你好"}, {"role": "assistant", "content": "你好呀"}]
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = InMemoryConversationStore()
+    monkeypatch.setattr(app_module, "create_conversation_store", lambda: store)
+    return store
+
+
+def post_chat(client, message):
+    return client.post(
+        "/chat", 
+        json={"message": message, "history": HISTORY, "session_id": SESSION_ID}, 
+        headers={"X-API-Key": "sk-test"},
+    )
+
+
+def test_empty_message_does_not_create_session(store):
+    response = post_chat(create_app().test_client(), "  ")
+    
+    assert "消息不能为空" in response.get_data(as_text=True)
+    assert store.load(SESSION_ID) is None
+
+
+def test_busy_rejection_does_not_create_session(store, monkeypatch):
+    monkeypatch.setattr(app_module.scheduler.stage("chat"), "is_full", lambda: True)
+    
+    response = post_chat(create_app().test_client(), "你好")
+    
+    assert response.status_code == 429
+    assert store.load(SESSION_ID) is None
+
+
+def test_synced_request_for_unknown_session_is_rejected(store):
+    response = create_app().test_client().post(
+        "/chat", 
+        json={"message": "你好", "history": [], "session_id": SESSION_ID, "synced": True}, 
+        headers={"X-API-Key": "sk-test"},
+    )
+    
+    assert response.status_code == 409
+    assert '"code": "session_missing"' in response.get_data(as_text=True)
+    assert store.load(SESSION_ID) is None
+
+
+def test_resolve_history_reports_missing_session_when_store_is_disabled():
+    with pytest.raises(SessionMissing):
+        resolve_history(None, {"session_id": SESSION_ID, "synced": True, "history": []})
+    
+    assert resolve_history(None, {"session_id": SESSION_ID, "history": HISTORY}) == (HISTORY, None)
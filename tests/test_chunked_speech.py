@@ -0,0 +1,117 @@
+"""分句与分句语音合成的顺序"""
+
+import threading
+import time
+
+from app import ChunkedSpeechSynthesizer, SentenceSplitter
+
+
+def test_splitter_emits_complete_sentences():
+    splitter = SentenceSplitter(min_chars=2)
+    
+    assert splitter.feed("你好呀。今天") == ["你好呀。"]
+    assert splitter.feed("天气不错！要出门吗") == ["今天天气不错！"]
+    assert splitter.flush() == "要出门吗"
+    assert splitter.flush() is None
+
+
+def test_splitter_merges_short_fragments():
+    splitter = SentenceSplitter(min_chars=6)
+    
+    assert splitter.feed("嗯。好的。我们出发吧！") == ["嗯。好的。我们出发吧！"]
+
+
+def test_splitter_keeps_closing_quotes_with_sentence():
+    splitter = SentenceSplitter(min_chars=2)
+    
+    assert splitter.feed("她说：“走吧。”然后笑了。") == ["她说：“走吧。”", "然后笑了。"]
+
+
+def test_splitter_waits_to_tell_period_from_decimal_point():
+    splitter = SentenceSplitter(min_chars=2)
+    
+    assert splitter.feed("It costs 3.") == []
+    assert splitter.feed("5 dollars. Next") == ["It costs 3.5 dollars."]
+    assert splitter.flush() == "Next"
+
+
+def test_chunks_are_emitted_in_submission_order():
+    # 后提交的句子先合成完
+    delays = {"一": 0.15, "二": 0.05, "三": 0.0}
+    synthesizer = ChunkedSpeechSynthesizer(
+        lambda text: time.sleep(delays[text]) or f"/audio/{text}.mp3", concurrency=3
+    )
+    for text in ("一", "二", "三"):
+        synthesizer.add(text)
+    
+    chunks = []
+    while not synthesizer.finished:
+        chunk = synthesizer.next_ready(5)
+        assert chunk is not None
+        chunks.append(chunk)
+    
+    assert [(c["index"], c["text"], c["audio_url"]) for c in chunks] == [
+        (0, "一", "/audio/一.mp3"), (1, "二", "/audio/二.mp3"), (2, "三", "/audio/三.mp3")
+    ]
+
+
+def test_ready_returns_only_the_completed_prefix():
+    release = threading.Event()
+    
+    def synthesize(text):
+        if text == "一":
+            release.wait(5)
+        return text
+    
+    synthesizer = ChunkedSpeechSynthesizer(synthesize, concurrency=2)
+    synthesizer.add("一")
+    synthesizer.add("二")
+    time.sleep(0.1)
+    
+    assert synthesizer.ready() == []
+    release.set()
+    assert synthesizer.next_ready(5)["text"] == "一"
+    assert [c["text"] for c in synthesizer.ready()] == ["二"]
+    assert synthesizer.finished
+
+
+def test_concurrency_is_limited_per_request():
+    lock = threading.Lock()
+    running = [0, 0]
+    
+    def synthesize(text):
+        with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        time.sleep(0.03)
+        with lock:
+            running[0] -= 1
+        return text
+    
+    synthesizer = ChunkedSpeechSynthesizer(synthesize, concurrency=2)
+    for i in range(6):
+        synthesizer.add(str(i))
+    texts = [synthesizer.next_ready(5)["text"] for _ in range(6)]
+    
+    assert texts == [str(i) for i in range(6)]
+    assert running[1] == 2
+
+
+def test_cancel_skips_sentences_not_yet_submitted():
+    release = threading.Event()
+    calls = []
+    
+    def synthesize(text):
+        calls.append(text)
+        release.wait(5)
+        return text
+    
+    synthesizer = ChunkedSpeechSynthesizer(synthesize, concurrency=1)
+    for text in ("一", "二", "三"):
+        synthesizer.add(text)
+    time.sleep(0.05)
+    
+    assert synthesizer.cancel() == 2
+    release.set()
+    time.sleep(0.05)
+    assert calls == ["一"]
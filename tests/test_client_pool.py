@@ -0,0 +1,98 @@
+"""OpenAI 客户端池的复用、淘汰和关闭"""
+
+import asyncio
+import os
+import time
+
+from app import OpenAIClientPool
+
+
+class FakeClient:
+    def __init__(self, api_key, base_url, **options):
+        self.api_key = api_key
+        self.closed = False
+    
+    def close(self):
+        self.closed = True
+
+
+class FakeAsyncClient(FakeClient):
+    async def close(self):
+        await asyncio.sleep(0)
+        self.closed = True
+
+
+def test_reuses_client_per_key_and_evicts_least_recently_used():
+    pool = OpenAIClientPool(max_size=2, factory=FakeClient, retire_grace=0)
+    a = pool.get("a")
+    pool.get("b")
+    assert pool.get("a") is a
+    
+    pool.get("c")
+    
+    assert len(pool) == 2
+    assert pool.get("a") is a
+    assert pool.get("b") is not a
+
+
+def test_lru_evicted_client_is_closed_after_the_grace_period(monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    pool = OpenAIClientPool(max_size=1, idle_ttl=1000, retire_grace=30, factory=FakeClient)
+    a = pool.get("a")
+    pool.get("b")
+    assert not a.closed
+    
+    now += 31
+    pool.get("b")
+    
+    assert a.closed
+
+
+def test_idle_client_is_closed_and_replaced(monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    pool = OpenAIClientPool(idle_ttl=10, factory=FakeClient)
+    a = pool.get("a")
+    
+    now += 11
+    
+    assert pool.get("a") is not a
+    assert a.closed
+
+
+def test_async_clients_are_closed_without_a_running_loop():
+    pool = OpenAIClientPool(factory=FakeAsyncClient)
+    client = pool.get("a")
+    
+    pool.clear()
+    
+    assert client.closed
+
+
+def test_async_clients_are_closed_on_the_running_loop():
+    pool = OpenAIClientPool(factory=FakeAsyncClient)
+    
+    async def main():
+        client = pool.get("a")
+        pool.clear()
+        assert pool._closing
+        await asyncio.sleep(0.01)
+        return client
+    
+    client = asyncio.run(main())
+    assert client.closed
+    assert not pool._closing
+
+
+def test_forked_child_does_not_reuse_parent_clients():
+    pool = OpenAIClientPool(factory=FakeClient)
+    parent = pool.get("a")
+    
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if len(pool) == 0 and pool.get("a") is not parent else 1)
+    _, status = os.waitpid(pid, 0)
+    
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert pool.get("a") is parent
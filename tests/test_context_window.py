@@ -0,0 +1,104 @@
+"""ContextWindow 的历史裁剪与滚动摘要"""
+
+from app import ContextWindow, estimate_messages_tokens
+
+
+def conversation(turns: int, start: int = 0) -> list:
+    """每条消息 10 个中文字符，约 14 个 token"""
+    history = []
+    for i in range(start, start + turns):
+        history.append({"role": "user", "content": f"问{i:03d}" + "问" * 6})
+        history.append({"role": "assistant", "content": f"答{i:03d}" + "答" * 6})
+    return history
+
+
+class Summarizer:
+    def __init__(self, result="摘要"):
+        self.result = result
+        self.calls = []
+    
+    def __call__(self, previous, messages):
+        self.calls.append((previous, list(messages)))
+        return self.result if self.result is None else f"{self.result}{len(self.calls)}"
+
+
+def test_history_within_budget_is_sent_unchanged():
+    window = ContextWindow(token_budget=1000, keep_turns=2)
+    summarize = Summarizer()
+    history = conversation(3)
+    
+    assert window.fit(history, summarize, "s") == (history, None)
+    assert summarize.calls == []
+
+
+def test_disabled_budget_keeps_history():
+    window = ContextWindow(token_budget=0, keep_turns=2)
+    history = conversation(20)
+    
+    assert window.fit(history, Summarizer(), "s") == (history, None)
+
+
+def test_over_budget_keeps_recent_turns_and_summarizes_the_rest():
+    window = ContextWindow(token_budget=100, keep_turns=2)
+    summarize = Summarizer()
+    history = conversation(6)
+    
+    kept, summary = window.fit(history, summarize, "s")
+    
+    assert kept == history[-4:]
+    assert summary == "摘要1"
+    assert summarize.calls == [(None, history[:-4])]
+
+
+def test_recent_turns_are_trimmed_further_to_fit_budget():
+    window = ContextWindow(token_budget=40, keep_turns=4)
+    history = conversation(6)
+    
+    kept, _ = window.fit(history, Summarizer(), "s")
+    
+    assert estimate_messages_tokens(kept) <= 40
+    assert kept[0]["role"] == "user"
+    assert kept == history[-len(kept):]
+
+
+def test_cached_summary_is_reused_until_window_slides():
+    window = ContextWindow(token_budget=100, keep_turns=2)
+    summarize = Summarizer()
+    history = conversation(6)
+    window.fit(history, summarize, "s")
+    
+    # 新增一轮后保留部分仍在预算内：沿用摘要，不再调用模型
+    grown = history + conversation(1, start=6)
+    kept, summary = window.fit(grown, summarize, "s")
+    assert kept == grown[8:]
+    assert summary == "摘要1"
+    assert len(summarize.calls) == 1
+    
+    # 保留部分再次超出预算：只把新移出窗口的消息合并进已有摘要
+    longer = grown + conversation(2, start=7)
+    kept, summary = window.fit(longer, summarize, "s")
+    assert kept == longer[-4:]
+    assert summary == "摘要2"
+    assert summarize.calls[1] == ("摘要1", longer[8:-4])
+
+
+def test_edited_history_invalidates_cached_summary():
+    window = ContextWindow(token_budget=100, keep_turns=2)
+    summarize = Summarizer()
+    history = conversation(6)
+    window.fit(history, summarize, "s")
+    
+    edited = [{"role": "user", "content": "改过的第一条消息"}] + history[1:]
+    window.fit(edited, summarize, "s")
+    
+    assert summarize.calls[1] == (None, edited[:-4])
+
+
+def test_failed_summary_drops_folded_messages():
+    window = ContextWindow(token_budget=100, keep_turns=2)
+    history = conversation(6)
+    
+    kept, summary = window.fit(history, Summarizer(result=None), "s")
+    
+    assert kept == history[-4:]
+    assert summary is None
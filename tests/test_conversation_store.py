@@ -0,0 +1,41 @@
+"""会话存储的容量与过期淘汰"""
+
+import time
+
+from app import InMemoryConversationStore, SQLiteConversationStore
+
+TURN = [{"role": "user", "content": "你好"}, {"role": "assistant", "content": "你好呀"}]
+
+
+def test_memory_store_evicts_least_recently_used_session():
+    store = InMemoryConversationStore(max_sessions=2)
+    store.append("a", TURN)
+    store.append("b", TURN)
+    store.load("a")
+    
+    store.append("c", TURN)
+    
+    assert store.load("b") is None
+    assert store.load("a") == TURN
+    assert store.load("c") == TURN
+
+
+def test_memory_store_expires_idle_sessions(monkeypatch):
+    store = InMemoryConversationStore(ttl=60)
+    store.append("a", TURN)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    
+    assert store.load("a") is None
+
+
+def test_sqlite_store_prunes_sessions_by_last_message_age(tmp_path):
+    store = SQLiteConversationStore(str(tmp_path / "conversations.db"), ttl=60)
+    store.append("old", TURN)
+    store.append("new", TURN)
+    with store._connect() as conn:
+        conn.execute("UPDATE messages SET created_at = ? WHERE session_id = 'old'", (time.time() - 61,))
+    
+    assert store.cleanup() == 1
+    assert store.load("old") is None
+    assert store.load("new") == TURN
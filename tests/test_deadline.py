@@ -0,0 +1,64 @@
+"""请求期限：请求头解析与流式回复截断"""
+
+import json
+import time
+
+import pytest
+
+import app as app_module
+from app import ChatPipeline, Deadline, UserConfig
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, app_module.REQUEST_DEADLINE),
+    ("abc", app_module.REQUEST_DEADLINE),
+    ("nan", app_module.REQUEST_DEADLINE),
+    ("1e9", app_module.MAX_REQUEST_DEADLINE),
+    ("15", 15.0),
+])
+def test_request_deadline_header_is_parsed_defensively(value, expected):
+    headers = {"X-API-Key": "sk-test"}
+    if value is not None:
+        headers["X-Request-Deadline"] = value
+    
+    assert UserConfig.from_headers(headers).deadline == expected
+
+
+class TricklingService:
+    """每 50 毫秒输出一段文本、永不结束的对话模型"""
+    
+    def __init__(self, config):
+        self.config = config
+        self.deadline = Deadline(config.deadline)
+        self.reference_voice = None
+        self.history_summary = None
+        self.closed = False
+    
+    def stream_chat_response(self, user_message, history):
+        try:
+            while True:
+                time.sleep(0.05)
+                yield "嗯"
+        finally:
+            self.closed = True
+    
+    def summarize_history(self, previous, messages):
+        return None
+
+
+def test_trickling_stream_is_truncated_at_the_deadline():
+    config = UserConfig(api_key="sk-test", tts_chunked=False, deadline=0.3)
+    service = TricklingService(config)
+    pipeline = ChatPipeline(service, "你好", [])
+    
+    started = time.monotonic()
+    events = [
+        json.loads(message.split("data: ", 1)[1])
+        for message in pipeline.events() if message.startswith("data: ")
+    ]
+    
+    assert time.monotonic() - started < 2
+    assert service.closed
+    done = next(event for event in events if event["type"] == "done")
+    assert done["full_response"].startswith("嗯")
+    assert done["skipped"]["chat"] == "deadline"
@@ -0,0 +1,166 @@
+"""ApiKeyPool 的选择、暂停与恢复"""
+
+import json
+import time
+
+import httpx
+import pytest
+from openai import APIStatusError, OpenAI
+
+import app
+from app import AIService, ApiKeyPool, PooledKeyTransport, UserConfig
+
+
+def chat_exchange(model: str, status: int, **headers) -> tuple:
+    request = httpx.Request(
+        "POST", "https://api.siliconflow.cn/v1/chat/completions",
+        content=json.dumps({"model": model}).encode()
+    )
+    return request, httpx.Response(status, headers=headers, request=request)
+
+
+def make_pool(count: int = 3) -> ApiKeyPool:
+    return ApiKeyPool([f"sk-test-{i}" for i in range(count)], throttle_seconds=30)
+
+
+def test_select_prefers_least_outstanding():
+    pool = make_pool()
+    first, second, third = pool.keys
+    first.begin()
+    first.begin()
+    third.begin()
+    
+    assert pool.select("chat") is second
+
+
+def test_select_rotates_between_idle_keys():
+    pool = make_pool()
+    
+    assert [pool.select("chat") for _ in range(3)] == pool.keys
+
+
+def test_select_avoids_keys_below_low_watermark():
+    pool = make_pool(2)
+    low, high = pool.keys
+    low.observe(*chat_exchange("chat", 200, **{"x-ratelimit-limit-requests": "100", "x-ratelimit-remaining-requests": "1"}))
+    high.begin()
+    
+    assert pool.select("chat") is high
+    # 其他模型的额度不受影响
+    assert pool.select("image") is low
+
+
+def test_auth_error_quarantines_whole_key():
+    pool = make_pool(2)
+    bad, good = pool.keys
+    bad.observe(*chat_exchange("chat", 401))
+    
+    assert bad.quarantined(time.monotonic())
+    assert pool.available() == 1
+    assert all(pool.select(model) is good for model in ("chat", "image", "chat"))
+
+
+def test_throttle_only_pauses_that_model():
+    pool = make_pool(2)
+    limited, other = pool.keys
+    limited.observe(*chat_exchange("chat", 429))
+    now = time.monotonic()
+    
+    assert limited.quarantined(now, "chat")
+    assert not limited.quarantined(now, "image")
+    assert not limited.quarantined(now)
+    assert pool.available("chat") == 1
+    assert pool.available("image") == 2
+    assert all(pool.select("chat") is other for _ in range(3))
+    assert {pool.select("image") for _ in range(2)} == {limited, other}
+
+
+def test_throttle_honours_retry_after():
+    pool = make_pool(1)
+    pooled = pool.keys[0]
+    pooled.observe(*chat_exchange("chat", 429, **{"retry-after": "120"}))
+    
+    assert pooled.resumes_at("chat") - time.monotonic() > 100
+
+
+def test_all_throttled_selects_earliest_recovery():
+    pool = make_pool(2)
+    late, early = pool.keys
+    late.throttle("chat", 60)
+    early.throttle("chat", 10)
+    
+    assert pool.available("chat") == 0
+    assert pool.select("chat") is early
+
+
+def test_throttled_key_recovers():
+    pool = make_pool(1)
+    pooled = pool.keys[0]
+    pooled.throttle("chat", 0.05)
+    assert pooled.quarantined(time.monotonic(), "chat")
+    
+    time.sleep(0.06)
+    
+    assert not pooled.quarantined(time.monotonic(), "chat")
+    assert pool.available("chat") == 1
+    assert pooled.throttled_models(time.monotonic()) == []
+    assert pooled.quarantines == 1
+
+
+def test_is_key_error():
+    request = httpx.Request("POST", "https://api.siliconflow.cn/v1/chat/completions")
+    
+    def error(status):
+        return APIStatusError("", response=httpx.Response(status, request=request), body=None)
+    
+    assert ApiKeyPool.is_key_error(error(401))
+    assert ApiKeyPool.is_key_error(error(429))
+    assert not ApiKeyPool.is_key_error(error(500))
+
+
+@pytest.fixture
+def throttled_pool(monkeypatch):
+    """第一个 Key 对所有请求返回 429，第二个 Key 正常"""
+    pool = make_pool(2)
+    used = []
+    for pooled in pool.keys:
+        def handler(request, pooled=pooled):
+            used.append(pooled)
+            if pooled is pool.keys[0]:
+                return httpx.Response(429, json={"message": "rate limited"})
+            if request.url.path.endswith("/audio/speech"):
+                return httpx.Response(200, content=b"ID3audio", headers={"content-type": "audio/mpeg"})
+            return httpx.Response(200, json={
+                "id": "x", "object": "chat.completion", "created": 0, "model": "m",
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "摘要"}}],
+            })
+        
+        pooled._client = OpenAI(
+            api_key=pooled.api_key, 
+            base_url="http://upstream/v1", 
+            http_client=httpx.Client(transport=PooledKeyTransport(pooled, httpx.MockTransport(handler))), 
+            max_retries=0,
+        )
+    monkeypatch.setattr(app, "key_pool", pool)
+    return pool, used
+
+
+def test_summary_retries_with_another_key(throttled_pool):
+    pool, used = throttled_pool
+    service = AIService(UserConfig(api_key=""))
+    
+    assert service.summarize_history(None, [{"role": "user", "content": "你好"}]) == "摘要"
+    assert used == pool.keys
+
+
+def test_speech_retries_with_another_key(throttled_pool, monkeypatch):
+    pool, used = throttled_pool
+    monkeypatch.setattr(app.voice_registry, "lookup", lambda key: None)
+    monkeypatch.setattr(app.voice_registry, "register", lambda *args: None)
+    service = AIService(UserConfig(api_key=""))
+    
+    response = service._request_speech("你好", service.reference_voice)
+    
+    assert response.content == b"ID3audio"
+    assert used == pool.keys
+    assert pool.keys[0].quarantined(time.monotonic(), service.config.tts_model)
@@ -0,0 +1,60 @@
+"""图像镜像的容量淘汰"""
+
+import os
+import time
+
+from app import MediaStore
+
+PNG = b"\x89PNG\r\n\x1a\n"
+
+
+def make_store(directory, max_bytes):
+    return MediaStore(
+        str(directory), max_bytes=max_bytes, max_image_bytes=1 << 20, 
+        thumbnail_size=0, fetch_timeout=1, workers=1,
+    )
+
+
+def test_cleanup_counts_and_removes_thumbnails(tmp_path):
+    store = make_store(tmp_path, max_bytes=2500)
+    items = []
+    for i in range(3):
+        item = store.put(PNG + bytes([i]) * 991)
+        thumbnail = store.thumbnail_path(item.digest)
+        thumbnail.write_bytes(b"w" * 500)
+        stamp = time.time() - 100 + i * 10
+        for path in (store.get_path(item.digest)[0], thumbnail):
+            os.utime(path, (stamp, stamp))
+        items.append(item)
+    
+    store.cleanup()
+    
+    assert store.get_path(items[0].digest) is None
+    assert store.get_thumbnail_path(items[0].digest) is None
+    assert store.get_path(items[2].digest) is not None
+    total = sum(path.stat().st_size for path in tmp_path.glob("**/*.*"))
+    assert total <= 2500
+
+
+def test_maybe_cleanup_runs_once_per_interval(tmp_path, monkeypatch):
+    store = make_store(tmp_path, max_bytes=1)
+    calls = []
+    monkeypatch.setattr(store, "cleanup", lambda: calls.append(1))
+    
+    store._maybe_cleanup()
+    store._maybe_cleanup()
+    
+    assert calls == [1]
+
+
+def test_cleanup_keeps_downloads_in_progress(tmp_path):
+    store = make_store(tmp_path, max_bytes=1)
+    writing = tmp_path / f"{'a' * 64}.0123.tmp"
+    writing.write_bytes(b"partial")
+    thumbnail_writing = store.thumbnail_directory / f"{'a' * 64}.4567.tmp"
+    thumbnail_writing.write_bytes(b"partial")
+    
+    store.cleanup()
+    
+    assert writing.exists()
+    assert thumbnail_writing.exists()
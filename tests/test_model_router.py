@@ -0,0 +1,130 @@
+"""ModelRouter 与 CircuitBreaker 的半开试探"""
+
+import time
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import httpx
+import pytest
+from openai import APIStatusError
+
+from app import CircuitBreaker, DeadlineExceeded, ModelRouter
+
+
+def status_error(status: int) -> APIStatusError:
+    request = httpx.Request("POST", "https://api.siliconflow.cn/v1/chat/completions")
+    return APIStatusError(f"HTTP {status}", response=httpx.Response(status, request=request), body=None)
+
+
+def half_open_router() -> ModelRouter:
+    """primary 已熔断且冷却结束，下一次调用就是试探"""
+    router = ModelRouter(hedge_workers=2)
+    breaker = router.breaker("chat", "base", "primary")
+    breaker.cooldown = 0
+    breaker._trip("test")
+    return router
+
+
+@pytest.mark.parametrize("status", [429, 400])
+def test_probe_without_recorded_outcome_releases_half_open(status):
+    router = half_open_router()
+    calls = []
+    
+    def request(model):
+        calls.append(model)
+        if model == "primary" and len(calls) == 1:
+            raise status_error(status)
+        return model
+    
+    try:
+        router.call("chat", "base", ["primary", "fallback"], request)
+    except APIStatusError:
+        assert status == 400
+    
+    results = [router.call("chat", "base", ["primary", "fallback"], request) for _ in range(5)]
+    assert results == ["primary"] * 5
+    assert router.breaker("chat", "base", "primary").state == CircuitBreaker.CLOSED
+
+
+def test_cancelled_async_probe_releases_half_open():
+    router = half_open_router()
+    
+    async def scenario():
+        started = asyncio.Event()
+        
+        async def slow(model):
+            started.set()
+            await asyncio.sleep(10)
+        
+        task = asyncio.ensure_future(router.call_async("chat", "base", ["primary"], slow))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        
+        async def ok(model):
+            return model
+        
+        return await router.call_async("chat", "base", ["primary", "fallback"], ok)
+    
+    assert asyncio.run(scenario()) == "primary"
+    assert router.breaker("chat", "base", "primary").state == CircuitBreaker.CLOSED
+
+
+class FirstOnlyExecutor:
+    """只执行第一个任务，之后提交的任务一直排队，模拟对冲线程池已满"""
+    
+    def __init__(self):
+        self._inner = ThreadPoolExecutor(max_workers=1)
+        self._submitted = 0
+    
+    def submit(self, fn, *args):
+        self._submitted += 1
+        if self._submitted == 1:
+            return self._inner.submit(fn, *args)
+        return Future()
+
+
+def test_hedge_loser_cancelled_before_start_releases_probe():
+    router = ModelRouter(hedge_workers=1)
+    router._hedge_executor = FirstOnlyExecutor()
+    breaker = router.breaker("chat", "base", "fallback")
+    breaker.cooldown = 0
+    breaker._trip("test")
+    
+    def request(model):
+        time.sleep(0.05)
+        return model
+    
+    assert router.call("chat", "base", ["primary", "fallback"], request, hedge_delay=0.01) == "primary"
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+
+
+def test_repeated_deadline_overruns_trip_breaker():
+    router = ModelRouter(hedge_workers=1)
+    breaker = router.breaker("chat", "base", "slow")
+    breaker.latency_threshold = 0.01
+    
+    def request(model):
+        time.sleep(0.02)
+        raise DeadlineExceeded("chat")
+    
+    for _ in range(breaker.min_calls):
+        with pytest.raises(DeadlineExceeded):
+            router.call("chat", "base", ["slow"], request)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_deadline_exhausted_elsewhere_is_not_counted():
+    router = ModelRouter(hedge_workers=1)
+    breaker = router.breaker("chat", "base", "fast")
+    
+    def request(model):
+        raise DeadlineExceeded("chat")
+    
+    for _ in range(breaker.min_calls * 2):
+        with pytest.raises(DeadlineExceeded):
+            router.call("chat", "base", ["fast"], request)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert not breaker._outcomes
@@ -0,0 +1,134 @@
+"""SingleFlight 合并相同的进行中请求与取消"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight("test")
+    release = threading.Event()
+    executions = []
+    
+    def fn():
+        executions.append(1)
+        release.wait(5)
+        return "ok"
+    
+    results = []
+    callers = [threading.Thread(target=lambda: results.append(flight.do("k", fn))) for _ in range(3)]
+    for caller in callers:
+        caller.start()
+    time.sleep(0.1)
+    release.set()
+    for caller in callers:
+        caller.join(5)
+    
+    assert results == ["ok"] * 3
+    assert len(executions) == 1
+    assert (flight.calls, flight.coalesced) == (3, 2)
+    assert not flight._inflight
+
+
+def test_error_is_shared_and_next_call_runs_again():
+    flight = SingleFlight("test")
+    started = threading.Event()
+    release = threading.Event()
+    
+    def failing():
+        started.set()
+        release.wait(5)
+        raise ValueError("boom")
+    
+    errors = []
+    
+    def call():
+        try:
+            flight.do("k", failing)
+        except ValueError as e:
+            errors.append(e)
+    
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=call)
+    follower.start()
+    time.sleep(0.1)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    
+    assert len(errors) == 2
+    assert flight.do("k", lambda: "ok") == "ok"
+
+
+def test_different_keys_are_not_merged():
+    flight = SingleFlight("test")
+    
+    assert flight.do("a", lambda: 1) == 1
+    assert flight.do("b", lambda: 2) == 2
+    assert flight.coalesced == 0
+
+
+def test_async_calls_share_one_task():
+    flight = SingleFlight("test")
+    executions = []
+    
+    async def fn():
+        executions.append(1)
+        await asyncio.sleep(0.05)
+        return "ok"
+    
+    async def scenario():
+        return await asyncio.gather(*(flight.do_async("k", fn) for _ in range(3)))
+    
+    assert asyncio.run(scenario()) == ["ok"] * 3
+    assert len(executions) == 1
+    assert flight.coalesced == 2
+    assert not flight._tasks
+
+
+def test_async_shared_task_survives_one_waiter_cancelling():
+    flight = SingleFlight("test")
+    
+    async def fn():
+        await asyncio.sleep(0.05)
+        return "ok"
+    
+    async def scenario():
+        first = asyncio.ensure_future(flight.do_async("k", fn))
+        second = asyncio.ensure_future(flight.do_async("k", fn))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+    
+    assert asyncio.run(scenario()) == "ok"
+
+
+def test_async_caller_after_last_waiter_cancels_starts_new_task():
+    flight = SingleFlight("test")
+    executions = []
+    
+    async def fn():
+        executions.append(1)
+        await asyncio.sleep(0.05)
+        return "ok"
+    
+    async def scenario():
+        first = asyncio.ensure_future(flight.do_async("k", fn))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        # 共享任务已取消但尚未结束，新的调用方不能加入它
+        return await flight.do_async("k", fn)
+    
+    assert asyncio.run(scenario()) == "ok"
+    assert len(executions) == 2
+    assert not flight._tasks
@@ -0,0 +1,66 @@
+"""阶段调度在同步和异步入口上的并发与排队限制"""
+
+import json
+
+import anyio
+import pytest
+
+import asgi
+from app import Stage, StageBusy
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+async def test_async_slot_limits_concurrency_and_rejects_when_queue_is_full():
+    stage = Stage("prompt", limit=1, queue_size=1, pooled=False)
+    release = anyio.Event()
+    running = []
+    
+    async def work():
+        async with stage.async_slot():
+            running.append(1)
+            await release.wait()
+    
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(work)
+        tg.start_soon(work)
+        await anyio.wait_all_tasks_blocked()
+        assert len(running) == 1
+        assert stage.pending == 2
+        with pytest.raises(StageBusy):
+            async with stage.async_slot():
+                pass
+        release.set()
+    
+    assert len(running) == 2
+    assert stage.pending == 0
+
+
+async def test_asgi_chat_rejects_with_retry_after_when_chat_stage_is_full(monkeypatch):
+    monkeypatch.setattr(asgi.scheduler.stage("chat"), "is_full", lambda: True)
+    body = json.dumps({"message": "你好"}).encode("utf-8")
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+    
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+    
+    async def send(message):
+        sent.append(message)
+    
+    scope = {
+        "type": "http", "method": "POST", "path": "/chat",
+        "headers": [(b"x-api-key", b"sk-test"), (b"content-type", b"application/json")],
+    }
+    await asgi.app(scope, receive, send)
+    
+    start, payload = sent
+    assert start["status"] == 429
+    assert (b"retry-after", b"1") in start["headers"]
+    event = json.loads(payload["body"].decode("utf-8").split("data: ", 1)[1])
+    assert event["code"] == "busy"
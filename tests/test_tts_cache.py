@@ -0,0 +1,22 @@
+"""语音缓存的磁盘层"""
+
+import os
+import time
+
+from app import ORPHAN_TMP_TTL, TTSCache
+
+
+def test_cleanup_removes_orphaned_tmp_files(tmp_path):
+    cache = TTSCache(str(tmp_path), memory_bytes=0, disk_bytes=1 << 20, ttl=3600)
+    orphan = tmp_path / "abc.0123.tmp"
+    orphan.write_bytes(b"partial")
+    old = time.time() - ORPHAN_TMP_TTL - 1
+    os.utime(orphan, (old, old))
+    writing = tmp_path / "def.4567.tmp"
+    writing.write_bytes(b"in progress")
+    
+    cache.put("k" * 64, b"mp3")
+    
+    assert not orphan.exists()
+    assert writing.exists()
+    assert cache.get("k" * 64) == b"mp3"
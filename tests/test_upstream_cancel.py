@@ -0,0 +1,102 @@
+"""客户端断开时中断同步入口的上游调用"""
+
+import socket
+import threading
+import time
+
+import httpx
+import pytest
+from openai import APIStatusError, OpenAI
+
+from app import CancellableTransport, SingleFlight, UpstreamCancelled, UpstreamScope, bind_upstream, upstream_scope
+
+
+def test_cancelled_scope_does_not_send_or_retry():
+    sent = []
+    transport = CancellableTransport(httpx.MockTransport(lambda request: sent.append(request) or httpx.Response(200)))
+    client = OpenAI(api_key="sk-test", base_url="http://upstream.test/v1", http_client=httpx.Client(transport=transport))
+    scope = UpstreamScope()
+    scope.cancel()
+    
+    with bind_upstream(scope), pytest.raises(APIStatusError) as excinfo:
+        client.chat.completions.create(model="m", messages=[{"role": "user", "content": "hi"}])
+    
+    assert excinfo.value.status_code == 499
+    assert sent == []
+
+
+@pytest.fixture
+def trickling_server():
+    """返回响应头和一段数据后不再发送任何内容的 HTTP 服务"""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    connections = []
+    
+    def serve():
+        conn, _ = server.accept()
+        connections.append(conn)
+        conn.recv(65536)
+        conn.sendall(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n1\r\na\r\n")
+    
+    threading.Thread(target=serve, daemon=True).start()
+    yield f"http://127.0.0.1:{server.getsockname()[1]}/"
+    for conn in connections:
+        conn.close()
+    server.close()
+
+
+def test_cancel_interrupts_a_blocked_read(trickling_server):
+    client = httpx.Client(transport=CancellableTransport(httpx.HTTPTransport()))
+    scope = UpstreamScope()
+    outcome = []
+    
+    def read():
+        with bind_upstream(scope):
+            try:
+                with client.stream("GET", trickling_server, timeout=30) as response:
+                    for _ in response.iter_bytes():
+                        pass
+            except UpstreamCancelled:
+                outcome.append(time.monotonic())
+    
+    reader = threading.Thread(target=read)
+    reader.start()
+    time.sleep(0.3)
+    cancelled_at = time.monotonic()
+    
+    assert scope.cancel() == 1
+    reader.join(timeout=5)
+    assert outcome and outcome[0] - cancelled_at < 1
+
+
+def test_shared_flight_is_cancelled_only_after_every_caller_leaves():
+    flight = SingleFlight("test")
+    started = threading.Event()
+    release = threading.Event()
+    shared = []
+    
+    def fn():
+        shared.append(upstream_scope.get())
+        started.set()
+        release.wait(5)
+        return "ok"
+    
+    first, second = UpstreamScope(), UpstreamScope()
+    leader = threading.Thread(target=lambda: flight.do("k", fn, first))
+    leader.start()
+    started.wait(5)
+    follower_result = []
+    follower = threading.Thread(target=lambda: follower_result.append(flight.do("k", fn, second)))
+    follower.start()
+    time.sleep(0.1)
+    
+    first.cancel()
+    assert not shared[0].cancelled
+    second.cancel()
+    assert shared[0].cancelled
+    
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert follower_result == ["ok"]
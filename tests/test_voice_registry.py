@@ -0,0 +1,77 @@
+"""音色注册与失效后的重新注册，上游使用本地模拟服务"""
+
+import httpx
+import pytest
+from openai import APIStatusError, OpenAI
+
+import app
+import simulator
+
+
+def status_error(status: int, message: str) -> APIStatusError:
+    request = httpx.Request("POST", "https://api.siliconflow.cn/v1/audio/speech")
+    response = httpx.Response(status, request=request)
+    return APIStatusError(message, response=response, body={"message": message})
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    monkeypatch.setenv("SIM_TIME_SCALE", "0")
+    sim_app = simulator.create_app(simulator.SimulatorConfig())
+    client = OpenAI(
+        api_key="sk-test", 
+        base_url="http://simulator/v1", 
+        http_client=httpx.Client(transport=httpx.WSGITransport(app=sim_app)), 
+        max_retries=0,
+    )
+    return sim_app.config["SIMULATOR"], client
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    registry = app.VoiceRegistry(str(tmp_path / "voices.json"))
+    monkeypatch.setattr(app, "voice_registry", registry)
+    return registry
+
+
+def make_service(client) -> app.AIService:
+    service = app.AIService(app.UserConfig(api_key="sk-test", base_url="http://simulator/v1"))
+    service.client = client
+    return service
+
+
+def test_register_uploads_once_and_persists(upstream, registry, tmp_path):
+    sim, client = upstream
+    voice = app.reference_audio_cache.get(app.DEFAULT_VOICE)
+    key = app.VoiceRegistry.make_key("sk-test", "http://simulator/v1", "IndexTeam/IndexTTS-2", voice)
+    
+    uri = registry.register(client, key, "IndexTeam/IndexTTS-2", voice)
+    assert uri in sim.voices
+    assert registry.register(client, key, "IndexTeam/IndexTTS-2", voice) == uri
+    assert len(sim.voices) == 1
+    assert app.VoiceRegistry(str(tmp_path / "voices.json")).lookup(key) == uri
+
+
+def test_stale_uri_is_registered_again(upstream, registry):
+    sim, client = upstream
+    service = make_service(client)
+    voice = service.reference_voice
+    key = app.VoiceRegistry.make_key("sk-test", "http://simulator/v1", service.config.tts_model, voice)
+    registry._uris[key] = "speech:stale:sim:000000000000"
+    
+    response = service._request_speech("你好", voice)
+    
+    assert response.content
+    assert registry.lookup(key) in sim.voices
+
+
+@pytest.mark.parametrize("status, message, stale", [
+    (400, "voice speech:x not found", True),
+    (404, "The voice uri is invalid", True),
+    (400, "input is too long", False),
+    (401, "Invalid token", False),
+    (403, "insufficient balance", False),
+    (429, "voice rate limited", False),
+])
+def test_only_voice_errors_count_as_stale(status, message, stale):
+    assert app._is_stale_voice_error(status_error(status, message)) is stale
@@ -0,0 +1,10 @@
+"""
+生产环境 WSGI 入口
+开发时可直接运行 python app.py；生产环境使用 gunicorn，配置见 gunicorn.conf.py。
+
+运行方式：gunicorn wsgi:app
+"""
+
+from app import create_app
+
+app = create_app()